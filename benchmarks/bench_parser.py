@@ -0,0 +1,184 @@
+# -*- encoding: utf8 -*-
+"""Benchmarks parsing the lines received from an IRC server with
+:class:`bones.parser.Message`, compared to Twisted's :func:`parsemsg`, and
+the whole of :meth:`bones.bot.BonesBot.lineReceived`.
+
+Run it from the root of the repository:
+
+.. code:: sh
+
+    PYTHONPATH=. python benchmarks/bench_parser.py
+    PYTHONPATH=. python benchmarks/bench_parser.py --lines 1000000
+    PYTHONPATH=. python benchmarks/bench_parser.py --log capture.log
+
+The lines replay a busy network: users in a number of channels talking,
+joining, leaving and changing modes, with some lines carrying IRCv3 message
+tags. The same lines are generated on every run.
+
+With :code:`--log`, the lines received in a capture of a real connection are
+replayed instead. The capture is either a file with one protocol line per
+line, or a Bones log written at the :code:`RAW` level, of which only the
+lines received from the server are used.
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.words.protocols import irc
+
+import bones.event
+from bones.bot import BonesBot, BonesBotFactory
+from bones.config import BaseConfiguration
+from bones.parser import Message
+
+# A record of a Bones log, formatted as in config.ini.
+reLogRecord = re.compile(
+    r"\A\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+ - \S+ - (\w+) - (.*)\Z")
+
+
+def generateLines(count, users, channels, seed=0):
+    """Returns the JOINs of all users to their channels, and a list of
+    :code:`count` lines of traffic."""
+    rng = random.Random(seed)
+    nicks = ["user%i" % i for i in range(users)]
+    chans = ["#channel%i" % i for i in range(channels)]
+    homes = dict((nick, rng.choice(chans)) for nick in nicks)
+    joins = [":%s!ident@host-%s.example.net JOIN %s" % (nick, nick, chan)
+             for nick, chan in homes.iteritems()]
+    lines = []
+    for i in xrange(count):
+        nick = rng.choice(nicks)
+        prefix = ":%s!ident@host-%s.example.net" % (nick, nick)
+        kind = rng.random()
+        if kind < 0.7:
+            line = "%s PRIVMSG %s :message number %i with some words in it" \
+                % (prefix, homes[nick], i)
+        elif kind < 0.8:
+            line = "%s NOTICE %s :notice %i" % (prefix, homes[nick], i)
+        elif kind < 0.85:
+            line = "%s PART %s :bye" % (prefix, homes[nick])
+        elif kind < 0.9:
+            line = "%s JOIN %s" % (prefix, homes[nick])
+        elif kind < 0.95:
+            line = ":services.example.net MODE %s +v %s" % (homes[nick], nick)
+        else:
+            line = "PING :irc.example.net"
+        if rng.random() < 0.3:
+            line = "@time=2020-01-01T00:00:00.%03iZ;msgid=%i %s" \
+                % (i % 1000, i, line)
+        lines.append(line)
+    return joins, lines
+
+
+def readLog(path):
+    """Returns the lines received from the server in a capture."""
+    lines = []
+    with open(path) as capture:
+        for line in capture:
+            line = line.rstrip("\r\n")
+            match = reLogRecord.match(line)
+            if match:
+                level, line = match.groups()
+                # Lines sent by the bot are logged too, and never start with
+                # a prefix or tags.
+                if level != "RAW" or (line[:1] not in (":", "@") and
+                                      not line.startswith("PING ")):
+                    continue
+            if line.strip():
+                lines.append(line)
+    return lines
+
+
+def parseTwisted(lines):
+    # What IRCClient.lineReceived and BonesBot.get_user did before
+    # bones.parser. Tags aren't understood, and end up in the command.
+    for line in lines:
+        line = irc.lowDequote(line)
+        prefix, command, params = irc.parsemsg(line)
+        if "!" in prefix:
+            nick, mask = prefix.split("!", 1)
+            mask = mask.split("@")
+
+
+def parseBones(lines):
+    for line in lines:
+        if irc.M_QUOTE in line:
+            line = irc.lowDequote(line)
+        message = Message(line)
+        message.host
+        message.params
+
+
+def parseCommand(lines):
+    for line in lines:
+        Message(line).command
+
+
+def makeBot(directory):
+    path = os.path.join(directory, "bench.ini")
+    with open(path, "w") as config:
+        config.write("[bot]\nnickname = bones\nusername = bones\n"
+                     "capabilities =\n[server.bench]\nhost = localhost\n")
+    bot = BonesBot()
+    bot.factory = BonesBotFactory(BaseConfiguration(path).server("bench"))
+    bot.makeConnection(StringTransport())
+    bot.nickname = "bones"
+    bot.lineReceived(":irc.example.net 001 bones :Welcome")
+    return bot
+
+
+def receive(bot, lines):
+    for line in lines:
+        bot.lineReceived(line)
+
+
+def measure(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=3000)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--log", metavar="FILE",
+                        help="replay the lines received in this capture")
+    args = parser.parse_args()
+
+    if args.log:
+        joins, lines = [], readLog(args.log)
+        print "%i lines from %s" % (len(lines), args.log)
+    else:
+        joins, lines = generateLines(args.lines, args.users, args.channels)
+        print "%i lines, %i users in %i channels" % (len(lines), args.users,
+                                                     args.channels)
+    print
+    print "%-40s %8.3f s" % ("lowDequote, parsemsg, prefix split",
+                             measure(parseTwisted, lines))
+    print "%-40s %8.3f s" % ("Message, prefix and params",
+                             measure(parseBones, lines))
+    print "%-40s %8.3f s" % ("Message, command only",
+                             measure(parseCommand, lines))
+
+    # Handlers aren't part of the parsing, so events go nowhere.
+    bones.event.fire = lambda *args, **kwargs: None
+    directory = tempfile.mkdtemp()
+    try:
+        bot = makeBot(directory)
+        receive(bot, joins)
+        bot.transport.clear()
+        print "%-40s %8.3f s" % ("BonesBot.lineReceived",
+                                 measure(receive, bot, lines))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
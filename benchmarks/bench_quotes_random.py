@@ -0,0 +1,126 @@
+# -*- encoding: utf8 -*-
+"""Benchmarks picking a random logged line of a user, as the
+:code:`quoterandom` trigger of :class:`bones.modules.quotes.UserQuotes`
+does, comparing :code:`ORDER BY random()` with and without the
+:code:`(nickname, id)` index to :class:`bones.modules.quotes.RandomPicker`.
+
+Run it from the root of the repository:
+
+.. code:: sh
+
+    PYTHONPATH=. python benchmarks/bench_quotes_random.py
+    PYTHONPATH=. python benchmarks/bench_quotes_random.py --rows 2000000 \
+        --big 500000
+
+It fills a temporary SQLite database with :code:`--rows` lines spread over
+:code:`--nicks` users, plus one user with :code:`--big` lines, and prints
+the average time per pick in milliseconds.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.expression import func
+
+from bones.modules import storage
+from bones.modules.quotes import RandomPicker, UserQuote
+
+
+def fill(engine, rows, nicks, big):
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    now = datetime.now()
+    batch = []
+    for i in xrange(rows + big):
+        if i < big:
+            nickname = u"big"
+        else:
+            nickname = u"nick%i" % random.randrange(nicks)
+        batch.append((nickname, u"#bones", u"line %i" % i, "privmsg", now))
+        if len(batch) == 10000:
+            cursor.executemany(
+                "INSERT INTO bones_quotes_user "
+                "(nickname, channel, quote, type, timestamp) "
+                "VALUES (?, ?, ?, ?, ?)", batch)
+            batch = []
+    if batch:
+        cursor.executemany(
+            "INSERT INTO bones_quotes_user "
+            "(nickname, channel, quote, type, timestamp) "
+            "VALUES (?, ?, ?, ?, ?)", batch)
+    connection.commit()
+    connection.close()
+
+
+def orderByRandom(session, nickname):
+    return (
+        session.query(UserQuote)
+        .filter(UserQuote.nickname == nickname)
+        .order_by(func.random())
+        .first()
+    )
+
+
+def measure(pick, session, nickname, repeat):
+    # The first pick warms up the caches.
+    pick(session, nickname)
+    start = time.time()
+    for _ in xrange(repeat):
+        pick(session, nickname)
+    return (time.time() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=200000,
+                        help="lines spread over the small users")
+    parser.add_argument("--nicks", type=int, default=100,
+                        help="number of small users")
+    parser.add_argument("--big", type=int, default=50000,
+                        help="lines of the one big user")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="picks per measurement")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        engine = create_engine("sqlite:///%s"
+                               % os.path.join(directory, "bench.db"))
+        storage.Base.metadata.create_all(engine, tables=[UserQuote.__table__])
+        print "Filling the database with %i lines..." % (args.rows + args.big)
+        fill(engine, args.rows, args.nicks, args.big)
+        session = sessionmaker(bind=engine, autocommit=True)()
+        small = "nick0"
+        smallRows = session.query(func.count(UserQuote.id)) \
+            .filter(UserQuote.nickname == small).scalar()
+
+        results = []
+        picker = RandomPicker(UserQuote, UserQuote.nickname)
+        for name, pick in [("ORDER BY random() with index", orderByRandom),
+                           ("RandomPicker", picker.pick)]:
+            for nickname, count in [(small, smallRows), ("big", args.big)]:
+                results.append(("%s, %i rows" % (name, count),
+                                measure(pick, session, nickname,
+                                        args.repeat)))
+        engine.execute("DROP INDEX ix_bones_quotes_user_nickname_id")
+        for nickname, count in [(small, smallRows), ("big", args.big)]:
+            results.append(("ORDER BY random() without index, %i rows"
+                            % count, measure(orderByRandom, session,
+                                             nickname, args.repeat)))
+        session.close()
+
+        print
+        for name, ms in results:
+            print "%-50s %8.2f ms" % (name, ms)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
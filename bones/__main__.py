@@ -1,16 +1,69 @@
 # -*- encoding: utf8 -*-
 import sys
-import logging
 
 from twisted.internet import reactor
 
+import bones.log
 from bones.bot import BonesBotFactory
 from bones.config import BaseConfiguration
 
+usage = """Usage: bones <config file>
+       bones migrate <config file>"""
+
+
+def formatSize(size):
+    if size is None:
+        return "?"
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "%i %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GiB" % size
+
+
+def migrate(file):
+    """Creates and migrates the database tables of all the bundled modules
+    and of the modules in the configuration file, then prints the size of
+    the tables and their indexes.
+    """
+    from bones.modules import storage
+
+    settings = BaseConfiguration(file)
+    modules = []
+    for section in settings._conf.sections():
+        if settings._conf.has_option(section, "modules"):
+            modules.extend(name.strip() for name in
+                           settings._conf.get(section, "modules").split("\n")
+                           if name.strip())
+    for name, ex in storage.loadModels(modules):
+        print "Skipping '%s': %s" % (name, ex)
+
+    config = storage.getConfig(settings.server(None))
+    print "Connecting to '%s'..." % config["sqlalchemy.url"]
+    engine = storage.createEngine(config)
+    changes = storage.migrate(engine)
+    for change in changes:
+        print change
+    if not changes:
+        print "The database is up to date."
+
+    print
+    print "%-32s %10s %10s" % ("Table", "Rows", "Size")
+    for table, rows, size, indexes in storage.report(engine):
+        print "%-32s %10i %10s" % (table, rows, formatSize(size))
+        for index, size in indexes:
+            print "  %-41s %10s" % (index, formatSize(size))
+
 
 def main():
+    if len(sys.argv) < 2 or sys.argv[1] == "migrate" and len(sys.argv) < 3:
+        print usage
+        raise SystemExit(1)
+    if sys.argv[1] == "migrate":
+        migrate(sys.argv[2])
+        return
     try:
-        logging.config.fileConfig(sys.argv[1])
+        bones.log.configure(sys.argv[1])
     except Exception, ex:
         import traceback
         traceback.print_exc()
@@ -18,7 +71,7 @@ def main():
         print "Couldn't load logger configuration:"
         print ex.message
         raise SystemExit()
-    log = logging.getLogger(__package__)
+    log = bones.log.getLogger(__package__)
     settings = BaseConfiguration(sys.argv[1])
 
     # Scan the configuration file for "server.name" sections.
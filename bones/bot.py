@@ -1,20 +1,51 @@
 # -*- encoding: utf8 -*-
 import re
-import logging
-import logging.config
+import socket
+import string
 import urllib2
+from collections import OrderedDict
 
 from twisted.words.protocols import irc
-from twisted.internet import defer, protocol, reactor
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python import threadable
 
 import bones.event
-
-logging.addLevelName(2, "RAW")
-log = logging.getLogger(__name__)
-log.raw = lambda *args: log.log(2, *args)
+import bones.log
+from bones.cache import LRUCache
+from bones.connect import (
+    HappyEyeballs,
+    Resolver,
+    interleave,
+    parseHosts,
+    reconnectDelay,
+)
+from bones.parser import Message, splitPrefix
+from bones.preview import URLPreviewEngine
+from bones.sendqueue import SendQueue
+from bones.web import HTTPClient
+
+log = bones.log.getLogger(__name__)
 
 removeEmptyElementsFromList = lambda x: [e for e in x if e]
 
+# Servers quit the users lost in a netsplit with the names of the two servers
+# that were split as the quit message, like "hub.example.net leaf.example.net".
+# Users can't send such a quit message themselves, as servers prefix theirs
+# with "Quit:".
+reSplitMessage = re.compile(r"\A([\w-]+(?:\.[\w-]+)+) ([\w-]+(?:\.[\w-]+)+)\Z")
+
+# Translation tables for the casemappings servers announce with the
+# CASEMAPPING ISUPPORT option, mapping nicknames and channel names to
+# lowercase. In rfc1459, []\~ are the uppercase versions of {}|^.
+casemappings = {
+    "ascii": string.maketrans(string.ascii_uppercase,
+                              string.ascii_lowercase),
+    "rfc1459": string.maketrans(string.ascii_uppercase + "[]\\~",
+                                string.ascii_lowercase + "{}|^"),
+    "strict-rfc1459": string.maketrans(string.ascii_uppercase + "[]\\",
+                                       string.ascii_lowercase + "{}|"),
+}
+
 
 class InvalidBonesModuleException(Exception):
     pass
@@ -33,9 +64,28 @@ class BonesModuleAlreadyLoadedException(Exception):
 
 
 class BonesBot(irc.IRCClient):
+    # The number of users that aren't in any of our channels, like users
+    # that messaged the bot or left our channels, that are kept around.
+    maxOrphanedUsers = 1000
+    # The number of seconds quits and joins are collected for before a
+    # netsplit or netjoin is reported.
+    netsplitDelay = 2
+    # Users lost in netsplits are remembered for this many seconds, so that
+    # their joins are reported as a netjoin.
+    netsplitMemory = 300
+    # Batches are ended early when this many are open at once, or when one
+    # holds this many messages, in case the server never ends them.
+    maxBatches = 20
+    maxBatchMessages = 10000
+    clock = reactor
+
     def __init__(self, *args, **kwargs):
         self.channels = {}
+        # Users in at least one of our channels. All other users are kept in
+        # orphans until they join one of our channels, or until they're
+        # evicted to make room for other orphans.
         self.users = {}
+        self.orphans = LRUCache(self.maxOrphanedUsers)
         # Prepare some server implementation details, to be filled out later
         # from ISUPPORT options.
         self.channel_types = "#"
@@ -46,50 +96,145 @@ class BonesBot(irc.IRCClient):
             "never": [],
         }
         self.prefixes = [("o", "@"), ("v", "+")]
+        # NAMES replies by casefolded channel name, as lists of (name, modes)
+        # tuples, until RPL_ENDOFNAMES is received. The name is a hostmask
+        # on servers with userhost-in-names.
+        self.pendingNames = {}
+        # IRCv3 capabilities the server supports, by name, and those enabled
+        # for this connection.
+        self.serverCapabilities = {}
+        self.capabilities = set()
+        # Registration waits for CAP END while capabilities are negotiated,
+        # which is sent once every CAP REQ has been answered.
+        self.negotiatingCapabilities = False
+        self.pendingCapabilityRequests = 0
+        # Batches being received, by reference tag in the order they were
+        # opened, as BatchEvents, and the batch whose messages are being
+        # handled.
+        self.batches = OrderedDict()
+        self.currentBatch = None
+        # NetsplitEvents and NetjoinEvents being collected, by the names of
+        # the servers that were split, until netsplitCall reports them.
+        self.netsplits = {}
+        self.netjoins = {}
+        self.netsplitCall = None
+        # The servers each casefolded nickname was lost to in a netsplit,
+        # the time until which its joins are part of a netjoin, and its
+        # user@host, as someone else may have taken the nickname since.
+        self.splitUsers = {}
+        self.casemapping = casemappings["rfc1459"]
+        self.compileSupport()
+        # The handler for each command, filled in as commands are received.
+        self.handlers = {}
+        # The message currently being handled, for handlers that need more
+        # than the prefix and the parameters, like the message tags.
+        self.currentMessage = None
+        self.sendQueue = None
+
+    def compileSupport(self):
+        """Builds the lookup tables used when parsing modes and messages
+        from :attr:`channel_types`, :attr:`channel_modes` and
+        :attr:`prefixes`. Called whenever the server announces new values
+        for them."""
+        # The kind of each channel mode: "list", "always", "set", "never" or
+        # "prefix". Modes that aren't in here are boolean modes.
+        kinds = {}
+        for kind in ("never", "set", "always", "list"):
+            for mode in self.channel_modes[kind]:
+                kinds[mode] = kind
+        for mode, prefix in self.prefixes:
+            kinds[mode] = "prefix"
+        self.modeKinds = kinds
+        # The mode for each nickname prefix, like "@" -> "o".
+        self.prefixModes = dict((p, m) for m, p in self.prefixes)
+        self.prefixModeSet = frozenset(m for m, p in self.prefixes)
+        self.channelTypes = frozenset(self.channel_types)
+
+    def casefold(self, name):
+        """Returns the given nickname or channel name in lowercase,
+        following the server's casemapping. :attr:`users` and
+        :attr:`channels` are keyed by casefolded names."""
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        return name.translate(self.casemapping)
+
+    def setCasemapping(self, casemapping):
+        if casemapping == self.casemapping:
+            return
+        self.casemapping = casemapping
+        # Users and channels seen before the casemapping was known are keyed
+        # by the old casemapping.
+        self.users = dict((self.casefold(user.nickname), user)
+                          for user in self.users.itervalues())
+        self.channels = dict((self.casefold(channel.name), channel)
+                             for channel in self.channels.itervalues())
+        self.orphans.clear()
 
     def get_channel(self, name):
         """Returns the Channel object for the given channel."""
-        if name not in self.channels:
-            self.channels[name] = bones.event.Channel(name, self)
-        return self.channels[name]
+        key = self.casefold(name)
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = bones.event.Channel(name, self)
+        return channel
 
     def get_user(self, target):
         """Returns the User object for the given target if it exists, None if
         otherwise."""
-        if "!" in target:
-            name = target.split("!")[0]
-            semiMask = target.split("!")[1].split("@")
-        else:
-            name = target
-            semiMask = None
-        if name not in self.users:
-            self.users[name] = bones.event.User(target, self)
-        elif semiMask:
-            self.users[name].username = semiMask[0]
-            self.users[name].hostname = semiMask[1]
-        return self.users[name]
+        name, username, hostname = splitPrefix(target)
+        key = self.casefold(name)
+        user = self.users.get(key)
+        if user is None:
+            user = self.orphans.get(key, count=False)
+            if user is None:
+                user = bones.event.User(target, self)
+                self.orphans.set(key, user)
+        if hostname and (user.username != username or
+                         user.hostname != hostname):
+            user._set_host(username, hostname)
+        return user
 
     def create_user(self, target):
         """Prepares a User object for the given target."""
-        if "!" in target:
-            name = target.split("!")[0]
-        else:
-            name = target
-        if name not in self.users:
-            self.users[name] = bones.event.User(target, self)
-        else:
+        key = self.casefold(splitPrefix(target)[0])
+        if key in self.users or key in self.orphans:
             error = "Could not create user \"{}\": user already exists"
             raise Exception(error.format(target))
-        return self.users[name]
+        user = bones.event.User(target, self)
+        self.orphans.set(key, user)
+        return user
+
+    def update_user(self, user):
+        """Moves the user to :attr:`users` if we share a channel with it, or
+        to the orphans if we don't. Called whenever a user joins or leaves a
+        channel."""
+        key = self.casefold(user.nickname)
+        if user.channels:
+            if key not in self.users:
+                self.orphans.delete(key)
+                self.users[key] = user
+        elif self.users.get(key) is user:
+            del self.users[key]
+            self.orphans.set(key, user)
+
+    def remove_user(self, user):
+        """Removes the user from all channels and forgets about it, like
+        when it quits."""
+        for channel in list(user.channels):
+            channel._remove_user(user)
+        key = self.casefold(user.nickname)
+        if self.users.get(key) is user:
+            del self.users[key]
+        if self.orphans.get(key, count=False) is user:
+            self.orphans.delete(key)
 
     def remove_channel(self, name):
-        # TODO: Remove the channel from all user instances.
-        if name not in self.channels:
+        channel = self.channels.pop(self.casefold(name), None)
+        if channel is None:
             return
-        channel = self.channels[name]
-        for user in channel.users:
-            user.channels.remove(channel)
-        del self.channels[name]
+        for user in list(channel.users):
+            channel._remove_user(user)
+            self.update_user(user)
 
     def _get_nickname(self):
         return self.factory.nickname
@@ -129,6 +274,8 @@ class BonesBot(irc.IRCClient):
         # We've connected to the server, reset this so that when we disconnect
         # we'll immediately try to reconnect.
         self.factory.reconnectAttempts = 0
+        # Servers that don't support CAP register us without a CAP END.
+        self.negotiatingCapabilities = False
 
         # InspIRCd mode that shows "user :is a bot" in whois.
         if self.factory.settings.get("server", "setBot", default="false") \
@@ -193,7 +340,7 @@ class BonesBot(irc.IRCClient):
                 data = option[len("PREFIX=("):]
                 data = data.split(")")
                 self.prefixes = zip(data[0], data[1])
-                log.debug("Server prefixes: %s" % self.prefixes)
+                log.debug("Server prefixes: %s", self.prefixes)
 
             elif option.startswith("CHANMODES="):
                 data = option[len("CHANMODES="):]
@@ -202,11 +349,20 @@ class BonesBot(irc.IRCClient):
                 self.channel_modes["always"] = data[1]
                 self.channel_modes["set"] = data[2]
                 self.channel_modes["never"] = data[3]
-                log.debug("Server channel modes: %s" % self.channel_modes)
+                log.debug("Server channel modes: %s", self.channel_modes)
 
             elif option.startswith("CHANTYPES="):
                 self.channel_types = option[len("CHANTYPES="):]
 
+            elif option.startswith("CASEMAPPING="):
+                casemapping = option[len("CASEMAPPING="):].lower()
+                if casemapping in casemappings:
+                    self.setCasemapping(casemappings[casemapping])
+                else:
+                    log.warning("Ignoring unknown casemapping '%s'",
+                                casemapping)
+
+        self.compileSupport()
         event = bones.event.ServerSupportEvent(self, options)
         bones.event.fire(self.tag, event)
 
@@ -244,7 +400,7 @@ class BonesBot(irc.IRCClient):
         # TODO: Ditch this and override irc_MODE
         # TODO: This should be changed as a part of the interface for mode
         # changing we'll make at one point in time.
-        if [True for x in self.channel_types if x is target[0]]:
+        if target[:1] in self.channelTypes:
             target = self.get_channel(target)
             args = [x for x in args if x is not None]
             target._set_modes(modes, args, set)
@@ -259,8 +415,12 @@ class BonesBot(irc.IRCClient):
             "Kicked from channel %s by %s. Reason: %s",
             channel, kicker, message
         )
+
+        def callback(event):
+            self.remove_channel(event.channel.name)
+
         event = bones.event.BotKickedEvent(self, channel, kicker, message)
-        bones.event.fire(self.tag, event)
+        bones.event.fire(self.tag, event, callback=callback)
 
     def nickChanged(self, nick):
         log.info(
@@ -284,7 +444,8 @@ class BonesBot(irc.IRCClient):
         def userPartCleanup(event):
             if event.user in event.channel.users:
                 log.debug("Removing %s from %s", event.user, event.channel)
-                event.channel.users.remove(event.user)
+                event.channel._remove_user(event.user)
+                self.update_user(event.user)
         event = bones.event.UserPartEvent(self, user, channel)
         bones.event.fire(self.tag, event, callback=userPartCleanup)
 
@@ -292,22 +453,93 @@ class BonesBot(irc.IRCClient):
         user = self.get_user(mask)
         if not user:
             user = self.create_user(mask)
+        servers = self.splitServers(quitMessage)
+        if servers:
+            self.splitQuit(user, servers)
+            return
         log.info(
             "User %s quit (Reason: %s)",
             user, quitMessage
         )
 
         def userQuitCleanup(event):
-            for channelName in self.channels:
-                channel = self.get_channel(channelName)
-                if event.user in channel.users:
-                    log.debug("Removing %s from %s", event.user, channel)
-                    channel.users.remove(event.user)
             log.debug("Deleting %s", event.user)
-            del event.user
+            self.remove_user(event.user)
         event = bones.event.UserQuitEvent(self, user, quitMessage)
         bones.event.fire(self.tag, event, callback=userQuitCleanup)
 
+    def splitServers(self, quitMessage):
+        """Returns the names of the two servers that were split if the quit
+        being handled is part of a netsplit, or None if it isn't."""
+        batch = self.currentBatch
+        if batch is not None and batch.type == "netsplit" and \
+                len(batch.params) >= 2:
+            return tuple(batch.params[:2])
+        match = reSplitMessage.match(quitMessage or "")
+        if match and match.group(1) != match.group(2):
+            return match.groups()
+
+    def splitQuit(self, user, servers):
+        event = self.netsplits.get(servers)
+        if event is None:
+            event = self.netsplits[servers] = \
+                bones.event.NetsplitEvent(self, servers)
+            self.scheduleNetsplitReport()
+            now = self.clock.seconds()
+            self.splitUsers = dict(
+                (key, split) for key, split in self.splitUsers.iteritems()
+                if split[1] > now
+            )
+        event.users.add(user)
+        event.channels.update(user.channels)
+        self.splitUsers[self.casefold(user.nickname)] = (
+            servers, self.clock.seconds() + self.netsplitMemory,
+            "%s@%s" % (user.username, user.hostname)
+        )
+
+    def scheduleNetsplitReport(self):
+        if self.netsplitCall is None:
+            self.netsplitCall = self.clock.callLater(self.netsplitDelay,
+                                                     self.reportNetsplits)
+
+    def reportNetsplits(self):
+        """Fires the :class:`~bones.event.NetsplitEvent` and
+        :class:`~bones.event.NetjoinEvent` of every netsplit and netjoin
+        being collected."""
+        if self.netsplitCall is not None and self.netsplitCall.active():
+            self.netsplitCall.cancel()
+        self.netsplitCall = None
+        netsplits, self.netsplits = self.netsplits, {}
+        netjoins, self.netjoins = self.netjoins, {}
+
+        def netsplitCleanup(event):
+            # remove_user for all of the users at once.
+            nicknames = set(user.nickname for user in event.users)
+            for channel in event.channels:
+                channel.users -= event.users
+                for mode in self.prefixModeSet:
+                    if mode in channel.modes:
+                        channel.modes[mode] -= nicknames
+            for user in event.users:
+                user.channels.clear()
+                key = self.casefold(user.nickname)
+                if self.users.get(key) is user:
+                    del self.users[key]
+                if self.orphans.get(key, count=False) is user:
+                    self.orphans.delete(key)
+        for event in netsplits.itervalues():
+            log.info("Netsplit between %s and %s: %i users quit from %i "
+                     "channels", event.servers[0], event.servers[1],
+                     len(event.users), len(event.channels))
+            bones.event.fire(self.tag, event, callback=netsplitCleanup)
+        for event in netjoins.itervalues():
+            for user in event.users:
+                self.splitUsers.pop(self.casefold(user.nickname), None)
+            log.info("Netjoin between %s and %s: %i users joined %i "
+                     "channels", event.servers[0], event.servers[1],
+                     len(event.users), len(event.channels))
+            bones.event.fire(self.tag, event)
+
     def userKicked(self, kickeeNick, channelName, kickerNick, message):
         channel = self.get_channel(channelName)
         kickee = self.get_user(kickeeNick)
@@ -322,14 +554,12 @@ class BonesBot(irc.IRCClient):
         )
 
         def userKickedCleanup(event):
-            if event.user in event.channel.users:
-                event.channel.users.remove(event.user)
-            if event.channel in event.user.channels:
-                event.user.channels.remove(event.channel)
+            event.channel._remove_user(event.kickee)
+            self.update_user(event.kickee)
         event = bones.event.UserKickedEvent(
             self, kickee, channel, kicker, message
         )
-        bones.event.fire(self.tag, event, userKickedCleanup)
+        bones.event.fire(self.tag, event, callback=userKickedCleanup)
 
     def action(self, user, channelName, data):
         channel = self.get_channel(channelName)
@@ -370,21 +600,24 @@ class BonesBot(irc.IRCClient):
         )
         user = self.get_user(oldname)
         if user:
+            # This sets the target name too, which is needed for user.msg and
+            # the like.
             user.nickname = newname
-            # Set the target name too. This is needed for user.msg and the like
-            user.name = newname
             # Fix the prefix mode listings
-            for channelname in self.channels:
-                channel = self.channels[channelname]
-                for (mode, prefix) in self.prefixes:
+            for channel in user.channels:
+                for mode in self.prefixModeSet:
                     if mode in channel.modes and \
                             oldname in channel.modes[mode]:
                         channel.modes[mode].remove(oldname)
                         channel.modes[mode].add(newname)
                         log.debug("Mode refresh in %s: -%s+%s %s %s",
                                   channel, mode, mode, oldname, newname)
-            self.users[newname] = user
-            del self.users[oldname]
+            if self.users.get(self.casefold(oldname)) is user:
+                del self.users[self.casefold(oldname)]
+                self.users[self.casefold(newname)] = user
+            else:
+                self.orphans.delete(self.casefold(oldname))
+                self.orphans.set(self.casefold(newname), user)
         else:
             user = self.create_user(newname)
 
@@ -401,7 +634,7 @@ class BonesBot(irc.IRCClient):
             "Joined channel %s.",
             channel
         )
-        if [True for t in self.channel_types if channel.name.startswith(t)]:
+        if channel.name[:1] in self.channelTypes:
             self.sendLine("MODE %s" % channel.name)
         else:
             self.sendLine("MODE #%s" % channel.name)
@@ -420,25 +653,54 @@ class BonesBot(irc.IRCClient):
 
     def userJoined(self, mask, channel):
         channel = self.get_channel(channel)
+        servers = None
+        if self.currentBatch is not None and \
+                self.currentBatch.type == "netjoin" and \
+                len(self.currentBatch.params) >= 2:
+            servers = tuple(self.currentBatch.params[:2])
+        elif self.splitUsers:
+            nickname, username, hostname = splitPrefix(mask)
+            split = self.splitUsers.get(self.casefold(nickname))
+            if split is not None and split[1] > self.clock.seconds() and \
+                    split[2] == "%s@%s" % (username, hostname):
+                servers = split[0]
+        if servers:
+            if self.netsplits:
+                # The user may be back before its quit was reported.
+                self.reportNetsplits()
+            self.netjoinUser(self.get_user(mask), channel, servers)
+            return
         user = self.get_user(mask)
         if not user:
             user = self.create_user(mask)
         log.debug("Event userJoined: %s %s", user, channel)
         event = bones.event.UserJoinEvent(self, channel, user)
-        user = event.user
-        user.channels.append(channel)
-        channel.users.append(user)
+        channel._add_user(event.user)
+        self.update_user(event.user)
         bones.event.fire(self.tag, event)
 
+    def netjoinUser(self, user, channel, servers):
+        event = self.netjoins.get(servers)
+        if event is None:
+            event = self.netjoins[servers] = \
+                bones.event.NetjoinEvent(self, servers)
+            self.scheduleNetsplitReport()
+        channel._add_user(user)
+        # Only the first channel moves the user out of the orphans.
+        if len(user.channels) == 1:
+            self.update_user(user)
+        event.users.add(user)
+        event.channels.add(channel)
+
     def irc_PRIVMSG(self, prefix, params):
         sender = self.get_user(prefix)
         if not sender:
             sender = self.create_user(prefix)
         # Determine whether this is in a query or a channel
         # This is simply done by checking whether the first char in
-        # the source name is in the `self.channel_types` array.
+        # the source name is in the `self.channelTypes` set.
         target = params[0]
-        if target[0] in self.channel_types:
+        if target[:1] in self.channelTypes:
             target = self.get_channel(target)
             specificEvent = bones.event.ChannelMessageEvent
         else:
@@ -461,29 +723,30 @@ class BonesBot(irc.IRCClient):
             elif not data['normal']:
                 return
         log.debug("Message: %s %s: %s", sender, target, msg)
-        # Send a IrcPrivmsgEvent for this event.
-        event = bones.event.IrcPrivmsgEvent(self, sender, target, msg)
-        bones.event.fire(self.tag, event)
         # Send a UserMessageEvent or ChannelMessageEvent for this event
-        # depending on whether the target is a User or a Channel.
+        # depending on whether the target is a User or a Channel. Handlers
+        # for IrcPrivmsgEvent will receive this as well.
         event = specificEvent(self, sender, target, msg)
         bones.event.fire(self.tag, event)
         # Check if the message contains a trigger call.
         # TODO: Bail if UserMessageEvent
-        data = self.factory.reCommand.match(msg.decode("utf-8"))
-        if data:
-            trigger = data.group(2)
-            args = msg.split(" ")[1:]
+        trigger = self.factory.matchTrigger(msg)
+        if trigger:
+            data = self.factory.reCommand.match(msg.decode("utf-8", "replace"))
+            if data is None:
+                log.warning("Trigger %s doesn't match the trigger regex: %r",
+                            trigger, msg)
+                return
+            args = msg.rstrip(" ").split(" ")[1:]
             log.debug(
                 "Received trigger %s%s.",
-                data.group(1), trigger
+                data.group(1), data.group(2)
             )
             triggerEvent = bones.event.TriggerEvent(
                 self, user=sender, channel=target, msg=msg, args=args,
                 match=data
             )
-            bones.event.fire(self.tag, "<Trigger: %s>" % trigger.lower(),
-                             triggerEvent)
+            bones.event.fire(self.tag, trigger, triggerEvent)
 
     def pong(self, user, secs):
         log.debug(
@@ -502,34 +765,182 @@ class BonesBot(irc.IRCClient):
         log.debug("RPL_CHANNELMODEIS: %s %s %s", channel, modes, args)
         self.get_channel(channel)._set_modes(modes[1:], args, True)
 
-    def irc_RPL_NAMREPLY(self, prefix, params):
-        channel = self.get_channel(params[2])
-        nicks = params[3].split(" ")
-        modes = []
-        args = []
-        for nick in nicks:
-            if nick:
-                # TODO: Iterate over nickname until a character that isn't in
-                # self.prefixes is found.
-                mode = [m for m, p in self.prefixes if p == nick[0]]
-                if mode:
-                    nickname = nick[len(mode):]
+    def irc_CAP(self, prefix, params):
+        if len(params) < 3:
+            return
+        subcommand = params[1].upper()
+        # Long replies are split over several lines, all but the last with
+        # an asterisk before the capabilities.
+        more = len(params) > 3 and params[2] == "*"
+        capabilities = params[-1].split()
+        if subcommand in ("LS", "NEW"):
+            for capability in capabilities:
+                name, _, value = capability.partition("=")
+                self.serverCapabilities[name] = value
+            if more:
+                return
+            if subcommand == "LS":
+                listed = self.serverCapabilities
+            else:
+                listed = [c.partition("=")[0] for c in capabilities]
+            requested = set(c for c in self.factory.capabilities
+                            if c in listed)
+
+            def requestCapabilities(event):
+                self.requestCapabilities(event.requested)
+                self.endCapabilityNegotiation()
+            event = bones.event.ServerCapabilitiesEvent(
+                self, self.serverCapabilities, requested
+            )
+            bones.event.fire(self.tag, event, callback=requestCapabilities)
+        elif subcommand == "ACK":
+            enabled = []
+            for capability in capabilities:
+                if capability[:1] == "-":
+                    self.capabilities.discard(capability[1:])
                 else:
-                    nickname = nick
-                user = self.get_user(nickname)
-                if not user:
-                    user = self.create_user(nickname)
-                user.channels.append(channel)
-                channel.users.append(user)
-                if mode:
-                    for prefixMode in mode:
-                        modes.append(prefixMode)
-                    args.append(nick[len(mode):])
-                    user.nickname = nick[len(mode):]
+                    capability = capability.lstrip("~=")
+                    self.capabilities.add(capability)
+                    enabled.append(capability)
+            log.info("Enabled capabilities: %s", " ".join(enabled))
+            if not more:
+                self.pendingCapabilityRequests -= 1
+            event = bones.event.CapabilitiesAcknowledgedEvent(self, enabled)
+            bones.event.fire(self.tag, event)
+            self.endCapabilityNegotiation()
+        elif subcommand == "NAK":
+            log.warning("Server refused capabilities: %s",
+                        " ".join(capabilities))
+            if not more:
+                self.pendingCapabilityRequests -= 1
+            self.endCapabilityNegotiation()
+        elif subcommand == "DEL":
+            for capability in capabilities:
+                self.serverCapabilities.pop(capability, None)
+                self.capabilities.discard(capability)
+
+    def requestCapabilities(self, capabilities):
+        """Asks the server to enable the given IRCv3 capabilities.
+        Capabilities the server doesn't support, or that are already enabled,
+        are left out. Enabled capabilities are added to :attr:`capabilities`
+        once the server acknowledges them.
+
+        :param capabilities: The names of the capabilities.
+        :type capabilities: list
+        """
+        capabilities = sorted(c for c in capabilities
+                              if c in self.serverCapabilities and
+                              c not in self.capabilities)
+        if capabilities:
+            self.pendingCapabilityRequests += 1
+            self.sendLine("CAP REQ :%s" % " ".join(capabilities))
+
+    def endCapabilityNegotiation(self):
+        if self.negotiatingCapabilities and \
+                self.pendingCapabilityRequests <= 0:
+            self.negotiatingCapabilities = False
+            self.sendLine("CAP END")
+
+    def irc_AWAY(self, prefix, params):
+        user = self.get_user(prefix)
+        user.away = params[-1] if params and params[-1] else None
+        event = bones.event.UserAwayEvent(self, user, user.away)
+        bones.event.fire(self.tag, event)
+
+    def irc_BATCH(self, prefix, params):
+        reference = params[0]
+        if reference[:1] == "+":
+            self.openBatch(params)
+        elif reference[:1] == "-":
+            self.endBatch(reference[1:])
+
+    def openBatch(self, params):
+        """Starts holding back the messages of the batch opened by a
+        :code:`BATCH +reference` message with the given parameters."""
+        reference = params[0][1:]
+        if reference in self.batches:
+            # Batches nested in other batches are opened as soon as they're
+            # received, and again when their parent is handled.
+            return
+        while len(self.batches) >= self.maxBatches:
+            oldest = next(iter(self.batches))
+            log.warning("Too many open batches, ending batch %s early",
+                        oldest)
+            self.endBatch(oldest)
+        self.batches[reference] = bones.event.BatchEvent(
+            self, reference, params[1] if len(params) > 1 else "", params[2:]
+        )
+
+    def endBatch(self, reference):
+        """Fires the :class:`~bones.event.BatchEvent` of the batch and
+        handles its messages."""
+        event = self.batches.pop(reference, None)
+        if event is None:
+            return
+        log.debug("Received %s batch of %i messages", event.type,
+                  len(event.messages))
+
+        def handleBatch(event):
+            previous = self.currentBatch
+            self.currentBatch = event
+            try:
+                for message in event.messages:
+                    self.handleMessage(message)
+            finally:
+                self.currentBatch = previous
+            if event.type in ("netsplit", "netjoin"):
+                self.reportNetsplits()
+        bones.event.fire(self.tag, event, callback=handleBatch)
+
+    def irc_RPL_NAMREPLY(self, prefix, params):
+        key = self.casefold(params[2])
+        names = self.pendingNames.get(key)
+        if names is None:
+            names = self.pendingNames[key] = []
+        prefixModes = self.prefixModes
+        for nick in params[3].split():
+            # Servers with multi-prefix send all the user's prefixes.
+            i = 0
+            while i < len(nick) and nick[i] in prefixModes:
+                i += 1
+            names.append((nick[i:], [prefixModes[p] for p in nick[:i]]))
+
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        channel = self.get_channel(params[1])
+        names = self.pendingNames.pop(self.casefold(params[1]), [])
+        # This is get_user and update_user for a whole channel at once, as
+        # this runs for every channel the bot joins.
+        casemapping = self.casemapping
+        users = []
+        for name, modes in names:
+            if "!" in name:
+                nickname, username, hostname = splitPrefix(name)
+            else:
+                nickname, hostname = name, None
+            key = nickname.translate(casemapping)
+            user = self.users.get(key)
+            if user is None:
+                user = self.orphans.get(key, count=False)
+                if user is None:
+                    user = bones.event.User(name, self)
                 else:
-                    user.nickname = nick
-        if modes:
-            channel._set_modes("".join(modes), args, True)
+                    self.orphans.delete(key)
+                self.users[key] = user
+            if user.name != nickname:
+                user.nickname = nickname
+            if hostname and (user.username != username or
+                             user.hostname != hostname):
+                user._set_host(username, hostname)
+            user.channels.add(channel)
+            for mode in modes:
+                if mode not in channel.modes:
+                    channel.modes[mode] = set()
+                channel.modes[mode].add(nickname)
+            users.append(user)
+        channel.users.update(users)
+        log.debug("Received %i users in %s", len(users), channel)
+        event = bones.event.ChannelNamesReceivedEvent(self, channel, users)
+        bones.event.fire(self.tag, event)
 
     def irc_INVITE(self, prefix, params):
         event = bones.event.BotInviteEvent(self, params[1],
@@ -631,13 +1042,92 @@ class BonesBot(irc.IRCClient):
                 self.tag, event, callback=eventCallback
             )
 
+    def connectionMade(self):
+        self.sendQueue = SendQueue(self._sendQueuedLine,
+                                   **self.factory.sendQueueSettings)
+        if self.factory.capabilities:
+            # Sent before registering, so that the server holds the
+            # registration until the capabilities have been negotiated.
+            self.negotiatingCapabilities = True
+            self.sendLine("CAP LS 302")
+        irc.IRCClient.connectionMade(self)
+
+    def connectionLost(self, reason):
+        if self.sendQueue:
+            self.sendQueue.clear()
+        if self.netsplitCall is not None and self.netsplitCall.active():
+            self.netsplitCall.cancel()
+        # Batches that didn't end before the connection was lost never will.
+        self.batches.clear()
+        irc.IRCClient.connectionLost(self, reason)
+
     def sendLine(self, line):
+        """Queues a line to be sent to the server. Lines are sent right away
+        unless the flood control of :attr:`sendQueue` holds them back.
+
+        This may be called from any thread; lines sent from other threads are
+        handed over to the reactor thread before they're queued."""
+        if reactor.running and not threadable.isInIOThread():
+            reactor.callFromThread(self.sendLine, line)
+            return
+        if self.sendQueue is None:
+            self._sendQueuedLine(line)
+        else:
+            self.sendQueue.put(line)
+
+    def _sendQueuedLine(self, line):
         log.raw(line)
         irc.IRCClient.sendLine(self, line)
 
     def lineReceived(self, line):
         log.raw(line)
-        irc.IRCClient.lineReceived(self, line)
+        if irc.M_QUOTE in line:
+            line = irc.lowDequote(line)
+        try:
+            message = Message(line)
+        except irc.IRCBadMessage:
+            log.warning("Ignoring malformed line %r", line)
+            return
+        self.handleMessage(message)
+
+    def handleMessage(self, message):
+        """Calls the :code:`irc_COMMAND` method handling the message, or
+        :meth:`irc_unknown` if there is none. Messages that are part of a
+        batch are held back until the whole batch has been received."""
+        if self.batches:
+            reference = message.tags.get("batch")
+            batch = self.batches.get(reference)
+            if batch is not None:
+                batch.messages.append(message)
+                if message.command == "BATCH" and message.params and \
+                        message.params[0][:1] == "+":
+                    # The messages of a nested batch are tagged with its own
+                    # reference, so it has to be open before they arrive.
+                    self.openBatch(message.params)
+                elif len(batch.messages) >= self.maxBatchMessages:
+                    log.warning("Batch %s is too long, ending it early",
+                                reference)
+                    self.endBatch(reference)
+                return
+        command = message.command
+        try:
+            name, handler = self.handlers[command]
+        except KeyError:
+            name = irc.numeric_to_symbolic.get(command, command)
+            handler = getattr(self, "irc_%s" % name, None)
+            self.handlers[command] = (name, handler)
+        # Batched messages are handled while the end of the batch is.
+        previous = self.currentMessage
+        self.currentMessage = message
+        try:
+            if handler is not None:
+                handler(message.prefix, message.params)
+            else:
+                self.irc_unknown(message.prefix, name, message.params)
+        except Exception:
+            log.exception("Error while handling %r", message.line)
+        finally:
+            self.currentMessage = previous
 
     def quit(self, message=None):
         event = bones.event.BotPreQuitEvent(self, message)
@@ -673,6 +1163,16 @@ class BonesBotFactory(protocol.ClientFactory):
 
         The release name of the current bot version. Sent to clients
         as a part of a :code:`CTCP VERSION` reply.
+
+    .. attribute:: http
+
+        A :class:`bones.web.HTTPClient` instance that modules should use for
+        HTTP requests.
+
+    .. attribute:: previews
+
+        A :class:`bones.preview.URLPreviewEngine` instance that modules
+        register their link preview extractors with.
     """
 
     sourceURL = "https://github.com/404d/Bones-IRCBot"
@@ -688,10 +1188,49 @@ class BonesBotFactory(protocol.ClientFactory):
         self.tag = settings.server
         self.reconnect = True
 
+        # Blocking URL opener, kept for modules that haven't moved to the
+        # non-blocking client below.
         self.urlopener = urllib2.build_opener()
         self.urlopener.addheaders = [('User-agent', 'urllib/2 BonesIRCBot/%s' % self.versionNum)]
+        self.http = HTTPClient(
+            "BonesIRCBot/%s" % self.versionNum,
+            maxPerHost=int(settings.get("http", "maxPerHost", default="4")),
+            timeout=float(settings.get("http", "timeout", default="30")),
+            connectTimeout=float(settings.get("http", "connectTimeout",
+                                              default="10")),
+            cacheSize=int(settings.get("http", "cache.size", default="1000")),
+            cacheTTL=float(settings.get("http", "cache.ttl", default="300")),
+            negativeTTL=float(settings.get("http", "cache.negativeTTL",
+                                           default="60")),
+            maxCacheTTL=float(settings.get("http", "cache.maxTTL",
+                                           default="86400")),
+            maxExtractBytes=int(settings.get("http", "extract.maxBytes",
+                                             default="524288")),
+        )
+        self.previews = URLPreviewEngine(
+            maxPerMessage=int(settings.get("http", "preview.maxPerMessage",
+                                           default="3")),
+            maxPerChannel=int(settings.get("http", "preview.maxPerChannel",
+                                           default="2")),
+        )
+        bones.event.register(self.previews, self.tag)
 
         self.reconnectAttempts = 0
+        self.reconnectCall = None
+        self.reconnectMinDelay = float(settings.get(
+            "server", "reconnect.minDelay", default="5"))
+        self.reconnectMaxDelay = float(settings.get(
+            "server", "reconnect.maxDelay", default="300"))
+        # The hosts of the server, tried in turn whenever connecting fails.
+        self.hosts = parseHosts(
+            settings.get("server", "host", default=""),
+            int(settings.get("server", "port", default="6667"))
+        )
+        self.hostIndex = 0
+        self.resolver = Resolver(ttl=float(settings.get(
+            "server", "dns.ttl", default="300")))
+        self.happyEyeballs = settings.get(
+            "server", "happyEyeballs", default="false") == "true"
 
         self.settings = settings
         self.channels = settings.get("server", "channel", default="").split("\n")
@@ -721,8 +1260,35 @@ class BonesBotFactory(protocol.ClientFactory):
         # specified in settings
         prefixChars = settings.get("bot", "triggerPrefixes", default="+") \
             .decode("utf-8")
-        regex = "^([%s])([^ ]*)( .+)*?$" % prefixChars
+        # This matches every message that matchTrigger accepts, including
+        # ones with trailing spaces.
+        regex = "^([%s])([^ ]*)( .*)?$" % prefixChars
         self.reCommand = re.compile(regex, re.UNICODE)
+        # Trigger prefixes as they appear in raw messages, grouped by their
+        # first byte so that messages that can't be triggers are skipped by a
+        # single dictionary lookup.
+        self.triggerPrefixes = {}
+        for prefix in set(prefixChars):
+            prefix = prefix.encode("utf-8")
+            self.triggerPrefixes.setdefault(prefix[0], []).append(prefix)
+        self.triggers = {}
+
+        # The IRCv3 capabilities requested from servers that support them.
+        self.capabilities = settings.get(
+            "bot", "capabilities",
+            default="multi-prefix userhost-in-names away-notify server-time "
+                    "batch message-tags"
+        ).split()
+
+        self.sendQueueSettings = {
+            "linesPerSecond": float(settings.get(
+                "bot", "sendqueue.linesPerSecond", default="2")),
+            "bytesPerSecond": float(settings.get(
+                "bot", "sendqueue.bytesPerSecond", default="1024")),
+            "burst": int(settings.get("bot", "sendqueue.burst", default="5")),
+            "maxLines": int(settings.get(
+                "bot", "sendqueue.maxLines", default="1000")),
+        }
 
         modules = settings.get("bot", "modules", default="").split("\n")
         modules = removeEmptyElementsFromList(modules)
@@ -786,6 +1352,7 @@ class BonesBotFactory(protocol.ClientFactory):
             instance = module(settings=self.settings, factory=self)
             self.modules.append(instance)
             bones.event.register(instance, self.tag)
+            self.triggers = bones.event.triggers(self.tag)
             bones.event.fire(self.tag, bones.event.BotModuleLoaded(module))
         else:
             ex = InvalidBonesModuleException(
@@ -797,6 +1364,59 @@ class BonesBotFactory(protocol.ClientFactory):
             log.exception(ex)
             raise ex
 
+    def unloadModule(self, path):
+        """Unloads the specified module and removes all of its event handlers
+        from the bot.
+
+        :param path: The Python dot-notation path to the module that should be
+            unloaded.
+        :type path: str.
+
+        :raises:
+            :class:`~bones.bot.NoSuchBonesModuleException`
+        """
+        for instance in self.modules:
+            klass = instance.__class__
+            if "%s.%s" % (klass.__module__, klass.__name__) == path:
+                break
+        else:
+            ex = NoSuchBonesModuleException(
+                "Could not unload module %s: Module not loaded" % (path,)
+            )
+            log.exception(ex)
+            raise ex
+
+        log.info("Unloading module %s", path)
+        bones.event.unregister(instance, self.tag)
+        self.previews.unregister(instance)
+        self.triggers = bones.event.triggers(self.tag)
+        self.modules.remove(instance)
+
+    def matchTrigger(self, msg):
+        """Checks whether the given message calls a trigger that has handlers
+        registered to it.
+
+        :param msg: The message to look at.
+        :type msg: str.
+
+        :returns: The event identifier of the called trigger, or None if the
+            message doesn't call any known trigger.
+        """
+        if not msg:
+            return None
+        prefixes = self.triggerPrefixes.get(msg[0])
+        if prefixes is None:
+            return None
+        for prefix in prefixes:
+            if msg.startswith(prefix):
+                break
+        else:
+            return None
+        end = msg.find(" ", len(prefix))
+        if end < 0:
+            end = len(msg)
+        return self.triggers.get(msg[len(prefix):end].lower())
+
     def buildProtocol(self, addr):
         if not self.reconnect:
             raise Exception
@@ -809,24 +1429,22 @@ class BonesBotFactory(protocol.ClientFactory):
         time period.
         """
         event_args = (self, connector, reason)
-        bones.event.fire(self.tag,
-                         bones.event.ConnectionClosedEvent(*event_args))
-
         if not self.reconnect:
+            bones.event.fire(self.tag,
+                             bones.event.ConnectionClosedEvent(*event_args))
             reactor.callLater(0.0, self.shutdown_deferred.callback, 1)
             return
         self.client = None
 
+        # Handlers for ConnectionClosedEvent will receive this as well.
         bones.event.fire(self.tag,
                          bones.event.ConnectionLostEvent(*event_args))
 
-        time = 10.0 * self.reconnectAttempts
-        self.reconnectAttempts += 1
+        delay = self.scheduleReconnect()
         log.info(
-            "{%s} Lost connection (%s), reconnecting in %i seconds.",
-            self.tag, reason, time
+            "{%s} Lost connection (%s), reconnecting in %.1f seconds.",
+            self.tag, reason, delay
         )
-        reactor.callLater(time, connector.connect)
 
     def clientConnectionFailed(self, connector, reason):
         """Called when an error occured with the connection. This method
@@ -834,45 +1452,58 @@ class BonesBotFactory(protocol.ClientFactory):
         time period.
         """
         event_args = (self, connector, reason)
-        bones.event.fire(self.tag,
-                         bones.event.ConnectionClosedEvent(*event_args))
-
         if not self.reconnect:
+            bones.event.fire(self.tag,
+                             bones.event.ConnectionClosedEvent(*event_args))
             reactor.callLater(0.0, self.shutdown_deferred.callback, 1)
             return
         self.client = None
 
+        # Handlers for ConnectionClosedEvent will receive this as well.
         bones.event.fire(self.tag,
                          bones.event.ConnectionFailedEvent(*event_args))
 
-        time = 30.0 * self.reconnectAttempts
-        self.reconnectAttempts += 1
+        # The addresses may have changed, and the next host may work.
+        self.resolver.forget(self.hosts[self.hostIndex][0])
+        self.hostIndex = (self.hostIndex + 1) % len(self.hosts)
+        delay = self.scheduleReconnect()
         log.info(
-            "{%s} Could not connect (%s), reconnecting in %i seconds.",
-            self.tag, reason, time
+            "{%s} Could not connect (%s), reconnecting in %.1f seconds.",
+            self.tag, reason, delay
         )
-        reactor.callLater(time, connector.connect)
+
+    def scheduleReconnect(self):
+        """Schedules the next attempt to connect to the server, waiting
+        longer the more attempts have failed. See
+        :func:`bones.connect.reconnectDelay`.
+
+        :returns: The number of seconds until the attempt.
+        """
+        delay = reconnectDelay(self.reconnectAttempts, self.reconnectMinDelay,
+                               self.reconnectMaxDelay)
+        self.reconnectAttempts += 1
+        self.reconnectCall = reactor.callLater(delay, self.connect)
+        return delay
 
     def connect(self):
         """Connects this bot factory to the server it is configured for.
         Gets called automatically by the default manager at boot.
-        """
 
-        serverPort = int(self.settings.get("server", "port", default="6667"))
-        serverHost = self.settings.get("server", "host")
-        if not serverHost:
+        The server's hosts are tried in turn, moving on to the next host
+        whenever connecting fails. Host names are looked up by
+        :attr:`resolver`, and if :code:`happyEyeballs` is enabled for the
+        server, all of their addresses are tried in parallel with
+        :class:`bones.connect.HappyEyeballs`.
+        """
+        if not self.hosts:
             raise InvalidConfigurationException(
                 "Server {} does not contain a `host` option.".format(self.tag)
             )
+        serverHost, serverPort = self.hosts[self.hostIndex]
         log_serverHost = serverHost
-        if ":" in serverHost and not serverHost.startswith("[") \
-                and not serverHost.endswith("]"):
-            # IPv6 address, but not enclosed in brackets
+        if ":" in serverHost:
+            # IPv6 address
             log_serverHost = "[%s]" % serverHost
-        elif ":" in serverHost and (serverHost.startswith("[")
-                                    and serverHost.endswith("]")):
-            # IPv6 address and enclosed in brackets
-            serverHost = serverHost[1:-1]
         if self.settings.get("bot", "bindAddress", default=None):
             bind_address = (self.settings.get("bot", "bindAddress"), 0)
             # Strip brackets if we're getting an IPv6 address
@@ -898,18 +1529,45 @@ class BonesBotFactory(protocol.ClientFactory):
                 )
                 log.exception(ex)
                 raise ex
-            reactor.connectSSL(
-                serverHost, serverPort, self, ssl.ClientContextFactory(),
-                bindAddress=bind_address
-            )
+            contextFactory = ssl.ClientContextFactory()
+
+            def connect(host, port, factory):
+                return reactor.connectSSL(host, port, factory, contextFactory,
+                                          bindAddress=bind_address)
         else:
             log.info("Connecting to server %s:%i", log_serverHost, serverPort)
-            reactor.connectTCP(serverHost, serverPort, self,
-                               bindAddress=bind_address)
+
+            def connect(host, port, factory):
+                return reactor.connectTCP(host, port, factory,
+                                          bindAddress=bind_address)
+
+        def gotAddresses(addresses):
+            if bind_address:
+                # Only addresses of the bind address' family are reachable.
+                family = socket.AF_INET6 if ":" in bind_address[0] \
+                    else socket.AF_INET
+                addresses = [a for a in addresses if a[0] == family]
+            if not addresses:
+                raise error.DNSLookupError(serverHost)
+            if self.happyEyeballs and len(addresses) > 1:
+                HappyEyeballs(
+                    self, [(a, serverPort) for f, a in interleave(addresses)],
+                    connect
+                ).start()
+            else:
+                connect(addresses[0][1], serverPort, self)
+        d = self.resolver.resolve(serverHost, serverPort)
+        d.addCallback(gotAddresses)
+        d.addErrback(lambda failure: self.clientConnectionFailed(None,
+                                                                 failure))
 
     def twisted_shutdown(self):
         self.shutdown_deferred = defer.Deferred()
         self.reconnect = False
+        if self.reconnectCall is not None and self.reconnectCall.active():
+            self.reconnectCall.cancel()
+        bones.event.fire(self.tag, bones.event.BotShutdownEvent(self))
+        self.http.close()
         def shutdown_hook(self):
             if self.client:
                 self.client.quit(self.settings.get("bot", "quitMessage", default="Reactor shutdown"))
@@ -943,4 +1601,4 @@ class Module():
         self.settings = settings
         self.factory = factory
         self.name = "%s.%s" % (self.__module__, self.__class__.__name__)
-        self.log = logging.getLogger(self.name)
+        self.log = bones.log.getLogger(self.name)
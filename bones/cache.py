@@ -0,0 +1,125 @@
+# -*- encoding: utf8 -*-
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A size-bounded mapping that forgets the least recently used entries
+    first, with an optional time to live for each entry.
+
+    :param maxSize: The maximum number of entries kept in the cache.
+    :type maxSize: int
+    :param ttl: The default number of seconds entries are kept, or None if
+        entries shouldn't expire.
+    :type ttl: float
+    :param clock: A callable returning the current time in seconds.
+    :type clock: callable
+
+    .. attribute:: hits
+
+        The number of lookups that found a live entry.
+
+    .. attribute:: misses
+
+        The number of lookups that didn't find a live entry.
+
+    .. attribute:: evictions
+
+        The number of entries that were dropped to make room for new ones.
+
+    .. attribute:: expirations
+
+        The number of entries that were dropped because they expired.
+    """
+
+    def __init__(self, maxSize, ttl=None, clock=time.time):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, _missing, count=False) is not _missing
+
+    def get(self, key, default=None, count=True):
+        """Returns the value stored for the given key and marks it as the most
+        recently used entry, or returns :code:`default` if there's no live
+        entry for the key.
+        """
+        try:
+            value, expires = self.entries.pop(key)
+        except KeyError:
+            if count:
+                self.misses += 1
+            return default
+        if expires is not None and expires <= self.clock():
+            self.expirations += 1
+            if count:
+                self.misses += 1
+            return default
+        self.entries[key] = (value, expires)
+        if count:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None, expires=None):
+        """Stores a value in the cache, evicting the least recently used
+        entry if the cache is full.
+
+        :param ttl: The number of seconds to keep this entry, overriding the
+            cache's default.
+        :type ttl: float
+        :param expires: The time at which this entry expires, overriding
+            :code:`ttl`.
+        :type expires: float
+        """
+        if self.maxSize <= 0:
+            return
+        if expires is None:
+            if ttl is None:
+                ttl = self.ttl
+            if ttl is not None:
+                expires = self.clock() + ttl
+        self.entries.pop(key, None)
+        while len(self.entries) >= self.maxSize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self.entries[key] = (value, expires)
+
+    def delete(self, key):
+        """Removes the entry for the given key, if there is one."""
+        self.entries.pop(key, None)
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        self.entries.clear()
+
+    def items(self):
+        """Returns a list of :code:`(key, value, expires)` tuples for all live
+        entries, from the least to the most recently used."""
+        now = self.clock()
+        return [(key, value, expires)
+                for key, (value, expires) in self.entries.items()
+                if expires is None or expires > now]
+
+    def stats(self):
+        """Returns a dictionary with the current size of the cache and the
+        :attr:`hits`, :attr:`misses`, :attr:`evictions` and
+        :attr:`expirations` counters."""
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+_missing = object()
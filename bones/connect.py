@@ -0,0 +1,235 @@
+# -*- encoding: utf8 -*-
+import random
+import socket
+
+from twisted.internet import defer, error, protocol, reactor, threads
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+
+import bones.log
+from bones.cache import LRUCache
+
+log = bones.log.getLogger(__name__)
+
+
+def reconnectDelay(attempt, minDelay=5.0, maxDelay=300.0,
+                   random=random.random):
+    """Returns the number of seconds to wait before reconnecting.
+
+    The first reconnect happens right away. After that the delay doubles
+    with every attempt, starting at :code:`minDelay` and never exceeding
+    :code:`maxDelay`. Only half of the delay is fixed and the other half is
+    random, so that bots that lost their connections at the same time, like
+    when a whole network restarts, don't all reconnect at the same time.
+
+    :param attempt: The number of reconnects attempted since the bot was
+        last connected.
+    :type attempt: int
+    :param minDelay: The delay before the second attempt.
+    :type minDelay: float
+    :param maxDelay: The longest delay.
+    :type maxDelay: float
+    """
+    if attempt <= 0:
+        return 0.0
+    delay = float(min(maxDelay, minDelay * 2 ** min(attempt - 1, 32)))
+    return delay / 2 + delay / 2 * random()
+
+
+def parseHosts(value, defaultPort):
+    """Parses the :code:`host` option of a server section, which may list
+    several hosts on separate lines, like :code:`irc.example.net`,
+    :code:`irc.example.net:6697` or :code:`[2001:db8::1]:6697`.
+
+    :param value: The value of the option.
+    :type value: str.
+    :param defaultPort: The port of hosts without a port.
+    :type defaultPort: int
+
+    :returns: A list of :code:`(host, port)` tuples, with the brackets
+        removed from IPv6 addresses.
+    """
+    hosts = []
+    for line in value.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        port = defaultPort
+        if line.startswith("["):
+            host, _, rest = line[1:].partition("]")
+            if rest.startswith(":"):
+                port = int(rest[1:])
+        elif line.count(":") == 1:
+            host, port = line.split(":")
+            port = int(port)
+        else:
+            # A host name, or an IPv6 address without brackets.
+            host = line
+        hosts.append((host, port))
+    return hosts
+
+
+def interleave(addresses):
+    """Orders the addresses so that the address families alternate,
+    starting with the family of the first address, as happy eyeballs
+    connection attempts should be made.
+
+    :param addresses: A list of :code:`(family, address)` tuples.
+    :type addresses: list
+    """
+    if not addresses:
+        return []
+    first = [a for a in addresses if a[0] == addresses[0][0]]
+    other = [a for a in addresses if a[0] != addresses[0][0]]
+    ordered = []
+    for i in range(max(len(first), len(other))):
+        for group in (first, other):
+            if i < len(group):
+                ordered.append(group[i])
+    return ordered
+
+
+class Resolver(object):
+    """Looks up the addresses of host names with :func:`socket.getaddrinfo`
+    in the reactor's thread pool, and remembers them for a while so that
+    reconnecting doesn't have to wait for DNS.
+
+    :param ttl: The number of seconds addresses are remembered for.
+    :type ttl: float
+    :param maxSize: The maximum number of host names remembered.
+    :type maxSize: int
+    """
+
+    def __init__(self, ttl=300.0, maxSize=100):
+        self.cache = LRUCache(maxSize, ttl=ttl)
+
+    def resolve(self, host, port):
+        """Looks up the addresses of a host.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` firing with a
+            list of :code:`(family, address)` tuples, in the order the
+            system prefers them.
+        """
+        if isIPAddress(host):
+            return defer.succeed([(socket.AF_INET, host)])
+        if isIPv6Address(host):
+            return defer.succeed([(socket.AF_INET6, host)])
+        addresses = self.cache.get(host)
+        if addresses is not None:
+            return defer.succeed(addresses)
+        d = threads.deferToThread(socket.getaddrinfo, host, port,
+                                  socket.AF_UNSPEC, socket.SOCK_STREAM)
+        d.addCallback(self.gotAddresses, host)
+        return d
+
+    def gotAddresses(self, results, host):
+        addresses = []
+        for family, socktype, proto, canonname, sockaddr in results:
+            address = (family, sockaddr[0])
+            if family in (socket.AF_INET, socket.AF_INET6) and \
+                    address not in addresses:
+                addresses.append(address)
+        if not addresses:
+            raise error.DNSLookupError(host)
+        self.cache.set(host, addresses)
+        return addresses
+
+    def forget(self, host):
+        """Forgets the addresses of a host, like when connecting to them
+        failed."""
+        self.cache.delete(host)
+
+
+class HappyEyeballs(object):
+    """Connects to the first of several addresses of a server that accepts
+    the connection, as described in :rfc:`8305`. A connection attempt to
+    the next address is started every :code:`delay` seconds, or as soon as
+    an attempt fails, and all other attempts are abandoned once one of them
+    succeeds.
+
+    The factory is used as if it had connected to the winning address
+    directly. If every attempt fails, its :code:`clientConnectionFailed`
+    is called with the reason the last attempt failed.
+
+    :param factory: The factory to build the protocol with.
+    :type factory: :class:`twisted.internet.protocol.ClientFactory`
+    :param addresses: The :code:`(address, port)` tuples to connect to, in
+        the order they should be tried.
+    :type addresses: list
+    :param connect: A callable taking an address, a port and a factory,
+        like :meth:`reactor.connectTCP`, that returns a connector.
+    :type connect: callable
+    :param delay: The number of seconds between connection attempts.
+    :type delay: float
+    """
+
+    def __init__(self, factory, addresses, connect, delay=0.25,
+                 clock=reactor):
+        self.factory = factory
+        self.addresses = list(addresses)
+        self.connect = connect
+        self.delay = delay
+        self.clock = clock
+        self.attempts = []
+        self.failures = 0
+        self.winner = None
+        self.nextCall = None
+
+    def start(self):
+        self.attemptNext()
+
+    def attemptNext(self):
+        if self.nextCall is not None and self.nextCall.active():
+            self.nextCall.cancel()
+        self.nextCall = None
+        if self.winner is not None or not self.addresses:
+            return
+        address, port = self.addresses.pop(0)
+        attempt = _Attempt(self)
+        self.attempts.append(attempt)
+        attempt.connector = self.connect(address, port, attempt)
+        if self.addresses:
+            self.nextCall = self.clock.callLater(self.delay,
+                                                 self.attemptNext)
+
+    def connected(self, attempt, addr):
+        if self.winner is not None:
+            return None
+        self.winner = attempt
+        if self.nextCall is not None and self.nextCall.active():
+            self.nextCall.cancel()
+        self.nextCall = None
+        for other in self.attempts:
+            if other is not attempt:
+                try:
+                    other.connector.stopConnecting()
+                except error.NotConnectingError:
+                    pass
+        log.debug("Connected to %s first", addr)
+        return self.factory.buildProtocol(addr)
+
+    def failed(self, attempt, connector, reason):
+        if self.winner is not None:
+            return
+        self.failures += 1
+        if self.addresses:
+            self.attemptNext()
+        elif self.failures == len(self.attempts):
+            self.factory.clientConnectionFailed(connector, reason)
+
+
+class _Attempt(protocol.ClientFactory):
+    noisy = False
+
+    def __init__(self, eyeballs):
+        self.eyeballs = eyeballs
+        self.connector = None
+
+    def buildProtocol(self, addr):
+        return self.eyeballs.connected(self, addr)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.eyeballs.failed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if self.eyeballs.winner is self:
+            self.eyeballs.factory.clientConnectionLost(connector, reason)
@@ -1,11 +1,20 @@
 import inspect
-import logging
+import itertools
 
-from twisted.internet import threads
+from twisted.internet import reactor, threads
+from twisted.python import threadable
 
-log = logging.getLogger(__name__)
+import bones.log
+
+log = bones.log.getLogger(__name__)
 
 eventHandlers = {}
+# Compiled dispatch tables, keyed by (server tag, event identifier). Each value
+# is a tuple of (inline handlers, threaded handlers), both being tuples of
+# bound methods. This is emptied whenever handlers are registered or
+# unregistered and gets filled in again as events are fired.
+dispatchTables = {}
+_registrations = itertools.count()
 
 
 def fire(server, event, *args, **kwargs):
@@ -14,6 +23,12 @@ def fire(server, event, *args, **kwargs):
 
     This may be called in your :term:`Bones module` to fire custom events.
 
+    Event handlers are called inline on the reactor thread, in the order they
+    were registered. Handlers that were marked with :code:`threaded=True` in
+    :func:`~bones.event.handler` are called afterwards in the reactor's thread
+    pool. If this is called from another thread, the event is handed over to
+    the reactor thread before any handlers are called.
+
     .. note::
 
         You should create a class that inherits from
@@ -34,32 +49,87 @@ def fire(server, event, *args, **kwargs):
         have been triggered
     :type callback: callable
     """
-    def threadedFire(server, event, *args, **kwargs):
-        callback = None
-        if "callback" in kwargs:
-            callback = kwargs["callback"]
-            del kwargs["callback"]
-        if isinstance(event, Event):
-            args = (event,) + args
-            event = event.__class__
-        if server.lower() in eventHandlers:
-            if event in eventHandlers[server.lower()]:
-                for h in eventHandlers[server.lower()][event]:
-                    try:
-                        h['f'](h['c'], *args, **kwargs)
-                    except Exception as ex:
-                        log.exception(ex)
+    callback = kwargs.pop("callback", None)
+    if isinstance(event, Event):
+        args = (event,) + args
+        event = event.__class__
+    if reactor.running and not threadable.isInIOThread():
+        reactor.callFromThread(_dispatch, server, event, callback, args,
+                               kwargs)
+    else:
+        _dispatch(server, event, callback, args, kwargs)
+
+
+def _dispatch(server, event, callback, args, kwargs):
+    try:
+        inline, threaded = dispatchTables[(server, event)]
+    except KeyError:
+        inline, threaded = _compile(server, event)
+    for f in inline:
+        try:
+            f(*args, **kwargs)
+        except Exception as ex:
+            log.exception(ex)
+    if threaded:
+        d = threads.deferToThread(_callAll, threaded, args, kwargs)
         if callback:
-            callback(*args, **kwargs)
-    threads.deferToThread(threadedFire, server, event, *args, **kwargs)
-
-
-def handler(event=None, trigger=None):
+            d.addCallback(lambda _: _callback(callback, args, kwargs))
+    elif callback:
+        _callback(callback, args, kwargs)
+
+
+def _compile(server, event):
+    """Builds the dispatch table for the given event identifier. Handlers
+    registered for any of the event's base classes are included, each handler
+    only being listed once and in the order they were registered."""
+    handlers = eventHandlers.get(server.lower(), {})
+    if inspect.isclass(event):
+        keys = inspect.getmro(event)
+    else:
+        keys = (event,)
+    found = {}
+    for key in keys:
+        for h in handlers.get(key, ()):
+            found[h['b']] = h
+    found = sorted(found.values(), key=lambda h: h['n'])
+    table = (
+        tuple(h['b'] for h in found if not h['t']),
+        tuple(h['b'] for h in found if h['t']),
+    )
+    dispatchTables[(server, event)] = table
+    return table
+
+
+def _callAll(handlers, args, kwargs):
+    for f in handlers:
+        try:
+            f(*args, **kwargs)
+        except Exception as ex:
+            log.exception(ex)
+
+
+def _callback(callback, args, kwargs):
+    try:
+        callback(*args, **kwargs)
+    except Exception as ex:
+        log.exception(ex)
+
+
+def handler(event=None, trigger=None, threaded=False):
     """Marks the decorated callable as an event handler for the given type of
     :term:`event`, or as a trigger handler for the given :term:`trigger`.
 
+    Handlers are called on the reactor thread and should return quickly. Pass
+    :code:`threaded=True` for handlers that block, for example on database
+    queries or HTTP requests, to have them called in the reactor's thread pool
+    instead.
+
     .. note:: For all events that are tied to Bones core, the event identifier
-        is the class definition of an event.
+        is the class definition of an event. Handlers for an event class will
+        also be called for all events that inherit from it, so a handler for
+        :class:`~bones.event.IrcPrivmsgEvent` will receive both
+        :class:`~bones.event.ChannelMessageEvent` and
+        :class:`~bones.event.UserMessageEvent`.
 
     .. warning:: You are free to use one callable for multiple events or
         multiple triggers, but it is not supported to use the same callable for
@@ -69,11 +139,14 @@ def handler(event=None, trigger=None):
     :type event: object
     :param trigger: the trigger command to react to
     :type trigger: str
+    :param threaded: whether the handler should be called in the thread pool
+    :type threaded: bool
     """
     def realHandler(func):
         if event is not None or trigger is not None:
             if getattr(func, '_event', None) is None:
                 func._event = []
+            func._threaded = threaded or getattr(func, '_threaded', False)
             if event and not trigger:
                 func._event.append(event)
             if trigger and not event:
@@ -112,10 +185,57 @@ def register(obj, server):
                 eventHandlers[server.lower()][event].append({
                     "c": obj,
                     "f": method,
+                    "b": getattr(obj, name),
+                    "t": getattr(method, "_threaded", False),
+                    "n": next(_registrations),
                 })
+    dispatchTables.clear()
+
 
+def unregister(obj, server):
+    """Remove all event handlers belonging to the given module from the event
+    handler list.
 
-class Target():
+    This is an internal function automatically called by the server bot
+    factory while unloading a module. **Do not** call this in your modules!
+
+    :param obj: the :class:`Module` instance to remove.
+    :type obj: :class:`bones.bot.Module`
+    :param server: the server tag that the supplied module runs under.
+    :type server: str
+    """
+    handlers = eventHandlers.get(server.lower(), {})
+    for event in handlers.keys():
+        handlers[event] = [h for h in handlers[event] if h['c'] is not obj]
+        if not handlers[event]:
+            del handlers[event]
+    dispatchTables.clear()
+
+
+def triggers(server):
+    """Returns all the triggers that have handlers registered to the given
+    server.
+
+    :param server: the server tag to look up triggers for.
+    :type server: str
+    :returns: a dictionary mapping lowercase trigger names to the event
+        identifiers their handlers are registered with.
+    """
+    found = {}
+    for event in eventHandlers.get(server.lower(), {}):
+        if isinstance(event, basestring) and event.startswith("<Trigger: "):
+            found[event[len("<Trigger: "):-1]] = event
+    return found
+
+
+def _intern(string):
+    # Only byte strings can be interned.
+    if type(string) is str:
+        return intern(string)
+    return string
+
+
+class Target(object):
     """Utility class providing easy access to methods commonly used against
     targets.
 
@@ -136,6 +256,8 @@ class Target():
         :class:`~bones.bot.BonesBot` instance that will be used to send the
         messages to the target.
     """
+    __slots__ = ("name", "server")
+
     def __init__(self, name, server):
         self.name = name
         self.server = server
@@ -190,20 +312,37 @@ class User(Target):
         the hostmask above, the username will be :code:`bot`.
         If the provided hostmask is missing the username part, this will
         be :code:`None`.
+
+    .. attribute:: channels
+
+        A set of the :class:`~bones.event.Channel` instances of the channels
+        the bot has seen this user in.
+
+    .. attribute:: away
+
+        The away message of the user, or None if the user isn't away or the
+        server hasn't told us. Only kept up to date on servers supporting the
+        :code:`away-notify` capability.
     """
+    __slots__ = ("mask", "username", "hostname", "channels", "user_modes",
+                 "away")
+
     def __init__(self, mask, server):
         self.mask = mask
         tmp = mask.split("!")
-        Target.__init__(self, tmp[0], server)
+        # Nicknames and hosts are repeated across every channel and message,
+        # so only one copy of each is kept.
+        Target.__init__(self, _intern(tmp[0]), server)
         if len(tmp) > 1:
             tmp = tmp[1].split("@")
-            self.username = tmp[0]
-            self.hostname = tmp[1]
+            self.username = _intern(tmp[0])
+            self.hostname = _intern(tmp[1])
         else:
             self.username = None
             self.hostname = None
-        self.channels = []
+        self.channels = set()
         self.user_modes = {}
+        self.away = None
 
     def __repr__(self):
         return "<User %s!%s@%s{%s}>" % (
@@ -215,7 +354,14 @@ class User(Target):
 
     def _get_nickname(self):
         return self.name
-    nickname = property(_get_nickname)
+
+    def _set_nickname(self, nickname):
+        self.name = _intern(nickname)
+    nickname = property(_get_nickname, _set_nickname)
+
+    def _set_host(self, username, hostname):
+        self.username = _intern(username) if username else None
+        self.hostname = _intern(hostname) if hostname else None
 
     def kick(self, channel, reason=None):
         """
@@ -249,7 +395,7 @@ class Channel(Target):
 
     .. attribute:: users
 
-        A list of user instances representing all the users in the
+        A set of user instances representing all the users in the
         channel.
 
     .. attribute:: topic
@@ -257,10 +403,12 @@ class Channel(Target):
         An :class:`~bones.event.Topic` instance containing the current
         topic and the user that wrote it.
     """
+    __slots__ = ("modes", "users", "topic")
+
     def __init__(self, name, server):
         Target.__init__(self, name, server)
         self.modes = {}
-        self.users = []
+        self.users = set()
         self.topic = None
 
     def __repr__(self):
@@ -268,52 +416,60 @@ class Channel(Target):
 
     def _cleanup(self):
         for user in self.users:
-            if self in user.channels:
-                user.channels.remove(self)
+            user.channels.discard(self)
         del self.users
         self.server = None
 
+    def _add_user(self, user):
+        self.users.add(user)
+        user.channels.add(self)
+
     def _remove_user(self, user):
-        if user in self.users:
-            self.users.remove(user)
-        if self in user.channels:
-            user.channels.remove(self)
-        for m, p in self.server.prefixes:
-            if m in self.modes and user.nickname in self.modes[m]:
-                self.modes[m].remove(user.nickname)
+        self.users.discard(user)
+        user.channels.discard(self)
+        for m in self.server.prefixModeSet:
+            if m in self.modes:
+                self.modes[m].discard(user.nickname)
 
     def _set_modes(self, modes, args, set):
+        # The mode kinds are looked up in the table compiled from ISUPPORT,
+        # and arguments are consumed in order without copying the list.
+        kinds = self.server.modeKinds
+        args = iter(args)
         for mode in modes:
             if set:
-                self._set_mode(mode, args)
+                self._set_mode(mode, kinds.get(mode), args)
             else:
-                self._unset_mode(mode, args)
+                self._unset_mode(mode, kinds.get(mode), args)
 
-    def _set_mode(self, mode, args):
-        if mode in self.server.channel_modes["list"] or \
-                [True for m, p in self.server.prefixes if m == mode]:
+    def _set_mode(self, mode, kind, args):
+        if kind == "list" or kind == "prefix":
+            arg = next(args, None)
+            if arg is None:
+                return
             if mode not in self.modes:
                 log.debug("Creating modelist '%s' for %s", mode, self)
                 self.modes[mode] = set()
-            log.debug("Adding element '%s' to modelist '%s' in %s", args[0],
+            log.debug("Adding element '%s' to modelist '%s' in %s", arg,
                       mode, self)
-            self.modes[mode].add(args.pop(0))
-        elif mode in self.server.channel_modes["always"]:
+            self.modes[mode].add(arg)
+        elif kind == "always":
+            arg = next(args, None)
             log.debug("Setting value-mode '%s' with argument '%s' in %s", mode,
-                      args[0], self)
-            self.modes[mode] = args.pop(0)
-        elif mode in self.server.channel_modes["set"]:
+                      arg, self)
+            self.modes[mode] = arg
+        elif kind == "set":
+            arg = next(args, None)
             log.debug("Setting option-mode '%s' with argument '%s' in %s",
-                      mode, args[0], self)
-            self.modes[mode] = args.pop(0)
+                      mode, arg, self)
+            self.modes[mode] = arg
         else:
             log.debug("Setting boolean mode '%s' in %s", mode, self)
             self.modes[mode] = True
 
-    def _unset_mode(self, mode, args):
-        if mode in self.server.channel_modes["list"] or \
-                [True for m, p in self.server.prefixes if m == mode]:
-            arg = args.pop(0)
+    def _unset_mode(self, mode, kind, args):
+        if kind == "list" or kind == "prefix":
+            arg = next(args, None)
             if mode in self.modes and arg in self.modes[mode]:
                 log.debug("Removing element '%s' from modelist '%s' in %s",
                           arg, mode, self)
@@ -321,8 +477,8 @@ class Channel(Target):
             else:
                 log.debug("Ignoring modelist '%s' removal of '%s' in %s",
                           mode, arg, self)
-        elif mode in self.server.channel_modes["always"]:
-            arg = args.pop(0)
+        elif kind == "always":
+            arg = next(args, None)
             if mode in self.modes and arg:
                 log.debug("Removing value-mode '%s' ('%s') from channel %s",
                           mode, arg, self)
@@ -330,7 +486,7 @@ class Channel(Target):
             else:
                 log.debug("Ignoring value-mode removal of '%s' ('%s') in %s",
                           mode, arg, self)
-        elif mode in self.server.channel_modes["set"]:
+        elif kind == "set":
             if mode in self.modes:
                 log.debug("Removing option-mode '%s' from %s", mode, self)
                 del self.modes[mode]
@@ -378,7 +534,7 @@ class Channel(Target):
         self.server.topic(self.name, topic)
 
 
-class Topic():
+class Topic(object):
     """Utility class representing a topic in a channel.
 
     .. attribute:: text
@@ -391,6 +547,8 @@ class Topic():
         An instance of :class:`~bones.event.User` that represents
         the user that wrote the topic.
     """
+    __slots__ = ("text", "user")
+
     def __init__(self, topic, user):
         self.text = topic
         self.user = user
@@ -606,6 +764,23 @@ class BotPreQuitEvent(Event):
         self.quitMessage = quitMessage
 
 
+class BotShutdownEvent(Event):
+    """
+    An event that is fired when the reactor is shutting down, before the bot
+    disconnects from the server. Handlers of this event should save any state
+    they want to keep. Events may still be fired while the bot disconnects,
+    up to the :class:`ConnectionClosedEvent` that is fired once the connection
+    has been closed.
+
+    .. attribute:: factory
+
+        The :class:`~bones.bot.BonesBotFactory` instance which is shutting
+        down.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+
+
 class ConnectionClosedEvent(Event):
     """
     Called by a bot factory whenever its connection gets closed.
@@ -751,6 +926,117 @@ class BounceEvent(Event):
         self.info = info
 
 
+class BatchEvent(Event):
+    """An event that is fired when the server has finished sending a batch
+    of messages that belong together, like the quits of a netsplit, on
+    servers supporting the :code:`batch` capability.
+
+    The messages in a batch are held back until the whole batch has been
+    received, and handled as usual right after this event, which lets
+    handlers prepare for the whole batch at once. A batch nested in another
+    batch is fired while the messages of the outer batch are handled, when
+    its end is reached. Batches are ended early if the server opens too many
+    of them at once or sends too many messages in one.
+
+    :param client: The bot instance where this event occured.
+    :type client: :class:`bones.bot.BonesBot`
+    :param reference: The reference tag of the batch.
+    :type reference: str.
+    :param type: The type of the batch, like :code:`netsplit`.
+    :type type: str.
+    :param params: The parameters of the batch.
+    :type params: list
+
+    .. attribute:: client
+
+        The :class:`bones.bot.BonesBot` instance representing the connection
+        to the server that this event originated from.
+
+    .. attribute:: messages
+
+        A list of the :class:`bones.parser.Message` instances in the batch, in
+        the order they were received.
+
+    .. attribute:: params
+
+        A list of the parameters of the batch. For :code:`netsplit` and
+        :code:`netjoin` batches these are the names of the two servers.
+
+    .. attribute:: reference
+
+        The reference tag the server identifies the batch with.
+
+    .. attribute:: type
+
+        A string of the type of the batch, like :code:`netsplit` or
+        :code:`netjoin`.
+    """
+    def __init__(self, client, reference, type, params):
+        self.client = client
+        self.reference = reference
+        self.type = type
+        self.params = params
+        self.messages = []
+
+
+class CapabilitiesAcknowledgedEvent(Event):
+    """An event that is fired whenever the server enables capabilities the
+    bot requested.
+
+    :param client: The bot instance where this event occured.
+    :type client: :class:`bones.bot.BonesBot`
+    :param capabilities: The capabilities that were enabled.
+    :type capabilities: list
+
+    .. attribute:: capabilities
+
+        A list of the names of the capabilities that were enabled. All
+        capabilities enabled for the connection are in
+        :attr:`bones.bot.BonesBot.capabilities`.
+
+    .. attribute:: client
+
+        The :class:`bones.bot.BonesBot` instance representing the connection
+        to the server that this event originated from.
+    """
+    def __init__(self, client, capabilities):
+        self.client = client
+        self.capabilities = capabilities
+
+
+class ChannelNamesReceivedEvent(Event):
+    """An event that is fired once the bot has received the list of users in
+    a channel, usually right after joining it. By the time this event is
+    fired, :attr:`Channel.users` and the prefix modes of the channel have
+    been updated.
+
+    :param client: The bot instance where this event occured.
+    :type client: :class:`bones.bot.BonesBot`
+    :param channel: The channel the list of users is for.
+    :type channel: :class:`Channel`
+    :param users: The users in the list.
+    :type users: list
+
+    .. attribute:: channel
+
+        A :class:`Channel` instance representing the channel.
+
+    .. attribute:: client
+
+        The :class:`bones.bot.BonesBot` instance representing the connection
+        to the server that this event originated from.
+
+    .. attribute:: users
+
+        A list of :class:`User` instances representing the users in the
+        list, in the order the server sent them.
+    """
+    def __init__(self, client, channel, users):
+        self.client = client
+        self.channel = channel
+        self.users = users
+
+
 class ChannelTopicChangedEvent(Event):
     def __init__(self, client, user, channel, newTopic):
         self.client = client
@@ -909,6 +1195,85 @@ class ModeChangedEvent(Event):
         self.args = args
 
 
+class NetjoinEvent(Event):
+    """An event that is fired once users that were lost in a netsplit have
+    rejoined the bot's channels, instead of a :class:`UserJoinEvent` for
+    every join. The joins are collected for a couple of seconds, or until the
+    end of a :code:`netjoin` batch, and the users have been added to the
+    channels by the time this event is fired.
+
+    :param client: The bot instance where this event occured.
+    :type client: :class:`bones.bot.BonesBot`
+    :param servers: The names of the two servers that were split.
+    :type servers: tuple
+
+    .. attribute:: channels
+
+        A set of the :class:`Channel` instances of the channels the users
+        joined.
+
+    .. attribute:: client
+
+        The :class:`bones.bot.BonesBot` instance representing the connection
+        to the server that this event originated from.
+
+    .. attribute:: servers
+
+        A tuple of the names of the two servers that were split.
+
+    .. attribute:: users
+
+        A set of :class:`User` instances representing the users that
+        rejoined.
+    """
+    def __init__(self, client, servers):
+        self.client = client
+        self.servers = servers
+        self.users = set()
+        self.channels = set()
+
+
+class NetsplitEvent(Event):
+    """An event that is fired once for a netsplit, instead of a
+    :class:`UserQuitEvent` for every user lost in it. Quits are recognized
+    as part of a netsplit by their message, which is the names of the two
+    servers that were split, or by being in a :code:`netsplit` batch, and
+    they are collected for a couple of seconds or until the end of the batch.
+
+    The users are removed from all channels once every handler has been
+    called, so :attr:`User.channels` still tells what channels each user was
+    in.
+
+    :param client: The bot instance where this event occured.
+    :type client: :class:`bones.bot.BonesBot`
+    :param servers: The names of the two servers that were split.
+    :type servers: tuple
+
+    .. attribute:: channels
+
+        A set of the :class:`Channel` instances of the channels the users
+        were in.
+
+    .. attribute:: client
+
+        The :class:`bones.bot.BonesBot` instance representing the connection
+        to the server that this event originated from.
+
+    .. attribute:: servers
+
+        A tuple of the names of the two servers that were split.
+
+    .. attribute:: users
+
+        A set of :class:`User` instances representing the users that quit.
+    """
+    def __init__(self, client, servers):
+        self.client = client
+        self.servers = servers
+        self.users = set()
+        self.channels = set()
+
+
 class PrivmsgEvent(Event):
     """Event fired when the bot receives a message from another user,
     either over a query or from a channel.
@@ -954,6 +1319,40 @@ class PrivmsgEvent(Event):
         self.msg = msg
 
 
+class ServerCapabilitiesEvent(Event):
+    """An event that is fired when the server has listed the IRCv3
+    capabilities it supports, before the bot requests any of them. Your
+    :term:`Bones module` may add the capabilities it needs to
+    :attr:`requested`.
+
+    :param client: The bot instance where this event occured.
+    :type client: :class:`bones.bot.BonesBot`
+    :param capabilities: The capabilities the server supports.
+    :type capabilities: dict
+    :param requested: The capabilities the bot is about to request.
+    :type requested: set
+
+    .. attribute:: capabilities
+
+        A dictionary of the values of the capabilities the server supports
+        by name. Capabilities without a value are set to an empty string.
+
+    .. attribute:: client
+
+        The :class:`bones.bot.BonesBot` instance representing the connection
+        to the server that this event originated from.
+
+    .. attribute:: requested
+
+        A set of the names of the capabilities the bot will request. Only
+        capabilities the server supports are requested.
+    """
+    def __init__(self, client, capabilities, requested):
+        self.client = client
+        self.capabilities = capabilities
+        self.requested = requested
+
+
 class ServerChannelCountEvent(Event):
     """
     Fired when the bot receives the :code:`RPL_LUSERCHANNELS` numeric.
@@ -1213,6 +1612,39 @@ class UserActionEvent(Event):
         self.data = data
 
 
+class UserAwayEvent(Event):
+    """An event that is fired whenever a user in one of the bot's channels
+    marks themselves as away or back, on servers supporting the
+    :code:`away-notify` capability. :attr:`User.away` has been updated by
+    the time this event is fired.
+
+    :param client: The bot instance where this event occured.
+    :type client: :class:`bones.bot.BonesBot`
+    :param user: The user who went away or came back.
+    :type user: :class:`bones.event.User`
+    :param message: The away message, or None if the user came back.
+    :type message: str.
+
+    .. attribute:: client
+
+        The :class:`bones.bot.BonesBot` instance representing the connection
+        to the server that this event originated from.
+
+    .. attribute:: message
+
+        A string of the away message of the user, or None if the user is no
+        longer away.
+
+    .. attribute:: user
+
+        A :class:`User` instance representing the user.
+    """
+    def __init__(self, client, user, message):
+        self.client = client
+        self.user = user
+        self.message = message
+
+
 class UserJoinEvent(Event):
     """An event that is fired whenever another user joins one
     of the channels the bot is in.
@@ -0,0 +1,259 @@
+# -*- encoding: utf8 -*-
+import re
+from HTMLParser import HTMLParser, HTMLParseError
+from htmlentitydefs import name2codepoint
+
+# Elements that never have a closing tag.
+_voidElements = frozenset([
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen",
+    "link", "meta", "param", "source", "track", "wbr",
+])
+# Elements that may only appear in the document head.
+_headElements = frozenset(["html", "head", "title", "meta", "link", "base"])
+
+_reStep = re.compile(r"""
+    (?P<tag>[a-zA-Z][a-zA-Z0-9]*|\*)?
+    (?P<rest>(?:\#[^\s.#\[]+|\.[^\s.#\[]+|\[[^\]=]+=[^\]]*\])*)$
+""", re.VERBOSE)
+_reQualifier = re.compile(r"""
+    \#(?P<id>[^\s.#\[]+)
+    |\.(?P<cls>[^\s.#\[]+)
+    |\[(?P<attr>[^\]=]+)=["']?(?P<value>[^\]"']*)["']?\]
+""", re.VERBOSE)
+
+
+class Element(object):
+    """An element matched by a :class:`Field`.
+
+    .. attribute:: tag
+
+        The name of the element, in lowercase.
+
+    .. attribute:: attrs
+
+        A dictionary of the element's attributes.
+
+    .. attribute:: text
+
+        All text contained by the element and its children as a unicode
+        string, with entities decoded.
+    """
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.attrs = attrs
+        self.text = u""
+        self.parts = []
+
+
+class Field(object):
+    """Describes an element to extract from a document.
+
+    The selector is a simplified CSS selector: a whitespace separated list of
+    steps, each matching a descendant of the element matched by the previous
+    step. A step consists of an optional tag name followed by any number of
+    :code:`#id`, :code:`.class` and :code:`[attribute=value]` qualifiers,
+    like :code:`div.tweet p.tweet-text` or :code:`meta[property=og:title]`.
+
+    :param selector: The selector matching the element.
+    :type selector: str.
+    :param many: If True, all matching elements are extracted. Otherwise only
+        the first matching element is.
+    :type many: bool
+    """
+    def __init__(self, selector, many=False):
+        self.selector = selector
+        self.many = many
+        self.steps = []
+        for step in selector.split():
+            match = _reStep.match(step)
+            if not match:
+                raise ValueError("Invalid selector: %r" % selector)
+            tag = match.group("tag")
+            if tag == "*":
+                tag = None
+            classes = []
+            attrs = []
+            for qualifier in _reQualifier.finditer(match.group("rest")):
+                if qualifier.group("id"):
+                    attrs.append(("id", qualifier.group("id")))
+                elif qualifier.group("cls"):
+                    classes.append(qualifier.group("cls"))
+                else:
+                    attrs.append((qualifier.group("attr").strip().lower(),
+                                  qualifier.group("value")))
+            self.steps.append((tag and tag.lower(), frozenset(classes),
+                               tuple(attrs)))
+        if not self.steps:
+            raise ValueError("Empty selector")
+        self.inHead = all(step[0] in _headElements for step in self.steps)
+
+    @staticmethod
+    def matches(step, tag, attrs):
+        stepTag, classes, stepAttrs = step
+        if stepTag is not None and stepTag != tag:
+            return False
+        for name, value in stepAttrs:
+            if attrs.get(name) != value:
+                return False
+        if classes and not classes.issubset(attrs.get("class", "").split()):
+            return False
+        return True
+
+
+class StreamingExtractor(HTMLParser):
+    """Extracts elements from an HTML document as it is being received,
+    without building a tree of the whole document.
+
+    Feed the document to the extractor in chunks with :meth:`feed`, and stop
+    feeding it as soon as :attr:`done` is True, which happens once all the
+    fields have been found. If all the fields are in the document head, the
+    extractor is done at the end of the head.
+
+    :param fields: A dictionary mapping names to the :class:`Field` (or just
+        the selector) of the elements to extract.
+    :type fields: dict
+
+    .. attribute:: done
+
+        Whether the extractor has found everything it's looking for.
+    """
+    def __init__(self, fields):
+        HTMLParser.__init__(self)
+        self.fields = {}
+        for name, field in fields.iteritems():
+            if not isinstance(field, Field):
+                field = Field(field)
+            self.fields[name] = field
+        self.headOnly = all(f.inHead for f in self.fields.values())
+        self.results = dict((name, [] if field.many else None)
+                            for name, field in self.fields.iteritems())
+        self.pending = set(name for name, field in self.fields.iteritems()
+                           if not field.many)
+        self.single = not any(field.many for field in self.fields.values())
+        self.progress = dict((name, []) for name in self.fields)
+        self.captures = []
+        self.stack = []
+        self.done = False
+
+    def feed(self, data):
+        if self.done:
+            return
+        try:
+            HTMLParser.feed(self, data)
+        except HTMLParseError:
+            self.finish()
+
+    def close(self):
+        """Finishes extraction and returns the results.
+
+        :returns: A dictionary mapping the field names to the matching
+            :class:`Element`, or None if no element matched. For fields where
+            :code:`many` is True, a list of all matching elements is returned
+            instead.
+        """
+        if not self.done:
+            try:
+                HTMLParser.close(self)
+            except HTMLParseError:
+                pass
+        self.finish()
+        return self.results
+
+    def finish(self):
+        for name, element, depth in self.captures:
+            self.completeElement(name, element)
+        self.captures = []
+        self.done = True
+
+    def completeElement(self, name, element):
+        element.text = u"".join(element.parts)
+        del element.parts
+        if self.fields[name].many:
+            self.results[name].append(element)
+        else:
+            self.results[name] = element
+            self.pending.discard(name)
+
+    def checkDone(self):
+        if self.single and not self.pending and not self.captures:
+            self.done = True
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if self.headOnly and tag == "body":
+            self.finish()
+            return
+        attrs = dict((name, value or u"") for name, value in attrs)
+        depth = len(self.stack)
+        void = tag in _voidElements
+        for name, field in self.fields.iteritems():
+            if not field.many and (name not in self.pending or
+                                   any(c[0] == name for c in self.captures)):
+                continue
+            progress = self.progress[name]
+            step = len(progress)
+            if not field.matches(field.steps[step], tag, attrs):
+                continue
+            if step < len(field.steps) - 1:
+                if not void:
+                    progress.append(depth)
+                continue
+            element = Element(tag, attrs)
+            if void:
+                self.completeElement(name, element)
+            else:
+                self.captures.append((name, element, depth))
+        if not void:
+            self.stack.append(tag)
+        self.checkDone()
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in _voidElements:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if self.headOnly and tag == "head":
+            self.finish()
+            return
+        # Closing a tag implicitly closes any unclosed tags inside it.
+        for depth in range(len(self.stack) - 1, -1, -1):
+            if self.stack[depth] == tag:
+                break
+        else:
+            return
+        del self.stack[depth:]
+        for name, progress in self.progress.iteritems():
+            while progress and progress[-1] >= depth:
+                progress.pop()
+        captures = []
+        for capture in self.captures:
+            if capture[2] >= depth:
+                self.completeElement(capture[0], capture[1])
+            else:
+                captures.append(capture)
+        self.captures = captures
+        self.checkDone()
+
+    def handle_data(self, data):
+        for name, element, depth in self.captures:
+            element.parts.append(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+        else:
+            self.handle_data(u"&%s;" % name)
+
+    def handle_charref(self, name):
+        try:
+            if name[0] in "xX":
+                codepoint = int(name[1:], 16)
+            else:
+                codepoint = int(name)
+            self.handle_data(unichr(codepoint))
+        except (ValueError, OverflowError):
+            self.handle_data(u"&#%s;" % name)
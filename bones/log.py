@@ -0,0 +1,175 @@
+# -*- encoding: utf8 -*-
+import logging
+import logging.config
+import Queue
+import threading
+
+# Every line sent to and received from the server is logged at this level.
+RAW = 2
+logging.addLevelName(RAW, "RAW")
+
+
+def reset():
+    """Makes all :class:`BonesLogger` instances look up which levels are
+    enabled again. This is done whenever logging is configured with
+    :func:`configure`, the level of any logger is changed with
+    :meth:`~logging.Logger.setLevel` or :func:`logging.disable` is called,
+    but has to be called after assigning to the :code:`level` attribute of a
+    logger directly.
+    """
+    for logger in logging.Logger.manager.loggerDict.values():
+        if isinstance(logger, BonesLogger):
+            logger._enabledLevels = {}
+
+
+# The levels enabled for a Bones logger depend on the levels of its parents,
+# like the root logger, which aren't Bones loggers themselves.
+_setLevel = logging.Logger.setLevel
+_disable = logging.disable
+
+
+def _setLevelAndReset(self, level):
+    _setLevel(self, level)
+    reset()
+
+
+def _disableAndReset(level):
+    _disable(level)
+    reset()
+
+
+logging.Logger.setLevel = _setLevelAndReset
+logging.disable = _disableAndReset
+
+
+def configure(file):
+    """Configures logging from the given configuration file, like
+    :func:`logging.config.fileConfig`.
+
+    :param file: The path to the configuration file.
+    :type file: str.
+    """
+    logging.config.fileConfig(file)
+    reset()
+
+
+class BonesLogger(logging.Logger):
+    """A logger that remembers which levels are enabled, so that logging
+    at a disabled level, like :code:`RAW` or :code:`DEBUG` in production,
+    costs next to nothing.
+
+    Use :func:`getLogger` to get one.
+    """
+
+    def isEnabledFor(self, level):
+        try:
+            return self._enabledLevels[level]
+        except KeyError:
+            enabled = logging.Logger.isEnabledFor(self, level)
+            self._enabledLevels[level] = enabled
+            return enabled
+
+    def raw(self, msg, *args, **kwargs):
+        """Logs a message at the :code:`RAW` level."""
+        try:
+            enabled = self._enabledLevels[RAW]
+        except KeyError:
+            enabled = self.isEnabledFor(RAW)
+        if enabled:
+            self._log(RAW, msg, args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        try:
+            enabled = self._enabledLevels[logging.DEBUG]
+        except KeyError:
+            enabled = self.isEnabledFor(logging.DEBUG)
+        if enabled:
+            self._log(logging.DEBUG, msg, args, **kwargs)
+
+
+def getLogger(name):
+    """Returns the :class:`BonesLogger` with the given name.
+
+    :param name: The name of the logger, usually the :code:`__name__` of
+        the calling module.
+    :type name: str.
+    """
+    logger = logging.getLogger(name)
+    # Loggers may have been created by the logging configuration before
+    # Bones got to them; they only need their class changed.
+    if not isinstance(logger, BonesLogger):
+        logger.__class__ = BonesLogger
+        logger._enabledLevels = {}
+    return logger
+
+
+class AsyncFileHandler(logging.FileHandler):
+    """A file handler that writes to the file in a thread of its own, so
+    that the thread logging a message never waits for the disk.
+
+    Records are put in a queue and written in the order they were logged.
+    If the queue is full, new records are dropped and counted in
+    :attr:`dropped` rather than blocking the caller. It may be used in the
+    logging configuration like any other handler:
+
+    .. code:: ini
+
+        [handler_fileHandler]
+        class=bones.log.AsyncFileHandler
+        formatter=bonesFormatter
+        args=("bones.log",)
+
+    :param filename: The file to log to.
+    :type filename: str.
+    :param mode: The mode the file is opened with.
+    :type mode: str.
+    :param maxQueued: The maximum number of records waiting to be written.
+    :type maxQueued: int
+
+    .. attribute:: dropped
+
+        The number of records that were dropped because the queue was full.
+    """
+
+    def __init__(self, filename, mode="a", encoding=None, maxQueued=10000):
+        logging.FileHandler.__init__(self, filename, mode, encoding)
+        self.queue = Queue.Queue(maxQueued)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write,
+                                       name="bones.log.AsyncFileHandler")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        try:
+            # Format the message now, as the arguments may change or be
+            # gone by the time the record is written.
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                self.format(record)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            logging.FileHandler.emit(self, record)
+
+    def flush(self):
+        # Only the writer thread writes to the file, so flushing it doesn't
+        # take the lock that is held while the handler is being closed.
+        if self.stream and hasattr(self.stream, "flush"):
+            self.stream.flush()
+
+    def close(self):
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        logging.FileHandler.close(self)
@@ -3,9 +3,8 @@ import re
 import random
 import logging
 from datetime import datetime
-import urllib2
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from sqlalchemy import (
     Column,
     Integer,
@@ -14,29 +13,20 @@ from sqlalchemy import (
 
 from bones.bot import Module
 import bones.event
+from bones.cache import LRUCache
+from bones.extract import Field
 from bones.modules import storage
+from bones.web import HTTPError
 
 
 class QDB(Module):
-    try:
-        from bs4 import BeautifulSoup
-    except ImportError:
-        BeautifulSoup = None
-
     quotesCache = []
 
+    quoteFields = {"quote": "span.qt"}
+    randomFields = {"quotes": Field("span.qt", many=True)}
+
     def __init__(self, settings, factory):
         Module.__init__(self, settings, factory)
-        if not self.BeautifulSoup:
-            ex = Exception(
-                "Unmet dependency: BeautifulSoup 4 not installed. This "
-                "dependency needs to be installed before you can use the "
-                "module %s" %
-
-                (".".join([__name__, "QDB"],))
-            )
-            self.log.error(ex)
-            raise ex
         self.settings = settings
         self.maxLinesPerQuote = int(
             self.settings.get("module.qdb", "maxLinesPerQuote", default=5))
@@ -50,42 +40,46 @@ class QDB(Module):
             else:
                 id = int(event.args[1])
             self.log.debug("Fetching qdb.us/%i", id)
-            try:
-                data = event.client.factory.urlopener.open("http://qdb.us/%i" % id)
-            except urllib2.HTTPError, ex:
-                if ex.code == 404:
+
+            def gotQuote(fields):
+                if not fields["quote"]:
                     event.channel.msg(str("[QDB #%s] Quote not found." % id))
                     return
-                self.log.exception(ex)
-                self.log.error("Unable to fetch quote #%i because of an HTTP error." % id)
+                self.sendQuote(event.channel, (id, fields["quote"].text))
+
+            def failed(failure):
+                if failure.check(HTTPError):
+                    code = failure.value.response.code
+                    if code == 404:
+                        event.channel.msg(
+                            str("[QDB #%s] Quote not found." % id))
+                        return
+                    self.log.error(
+                        "Got unknown HTTP error code %i when fetching "
+                        "qdb.us/%i", code, id
+                    )
+                    event.channel.msg(str(
+                        "[QDB] An unknown exception occurred. Please notify "
+                        "the bot master and try again later."
+                    ))
+                    return
+                self.log.error("Unable to fetch quote #%i: %s", id,
+                               failure.getErrorMessage())
                 event.channel.msg("Unable to fetch new quotes")
-                return
-            if data.getcode() == 404:
-                event.channel.msg(str("[QDB #%s] Quote not found." % id))
-                return
-            if data.getcode() == 200:
-                html = data.read()
-                soup = self.BeautifulSoup(html)
-                quote = soup.find("span", {"class": "qt"}).text
-                self.sendQuote(event.channel, (id, quote))
-                return
-            self.log.error(
-                "Got unknown HTTP error code %i when fetching qdb.us/%i",
-                data.getcode(), id
-            )
-            event.channel.msg(str(
-                "[QDB] An unknown exception occurred. Please notify the bot "
-                "master and try again later."
-            ))
+            d = self.factory.http.extract("http://qdb.us/%i" % id,
+                                          self.quoteFields)
+            d.addCallback(gotQuote)
+            d.addErrback(failed)
             return
 
         if len(event.args) <= 0 or event.args[0].lower() == "random":
-            self.cacheIfNeeded(event.client.factory)
-            if len(self.quotesCache) < 1:
-                event.channel.msg("Unable to fetch new quotes.")
-                return
-            quote = self.quotesCache.pop()
-            self.sendQuote(event.channel, quote)
+            def sendRandomQuote(_):
+                if len(self.quotesCache) < 1:
+                    event.channel.msg("Unable to fetch new quotes.")
+                    return
+                quote = self.quotesCache.pop()
+                self.sendQuote(event.channel, quote)
+            self.cacheIfNeeded(self.factory).addCallback(sendRandomQuote)
             return
 
     def sendQuote(self, channel, quote):
@@ -107,29 +101,43 @@ class QDB(Module):
         """
         Ensures that the quote cache is not empty, and will fetch new quotes
         once the cache is empty.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires once
+            the cache has been filled, or right away if it wasn't empty.
         """
-        if not self.quotesCache:
-            self.log.debug("Fetching new quotes from qdb.us/random")
-            try:
-                html = factory.urlopener.open("http://qdb.us/random").read()
-            except urllib2.HTTPError:
-                self.log.error("Unable to fetch new quotes because of an HTTP error.")
+        if self.quotesCache:
+            return defer.succeed(None)
+        self.log.debug("Fetching new quotes from qdb.us/random")
+
+        def gotQuotes(fields):
+            quotes = [(item.attrs.get("id", "").split("qt")[-1], item.text)
+                      for item in fields["quotes"]]
+            if not quotes:
                 return
-            soup = self.BeautifulSoup(html)
-            data = soup.findAll("span", {"class": "qt"})
-            for item in data:
-                id = item["id"].split("qt")[1]
-                self.quotesCache.append((id, item.text))
+            self.quotesCache.extend(quotes)
             self.log.debug("Got %i new quotes", len(self.quotesCache))
             random.shuffle(self.quotesCache, random.random)
 
+        def failed(failure):
+            if failure.check(HTTPError):
+                self.log.error("Unable to fetch new quotes because of an HTTP "
+                               "error (%i).", failure.value.response.code)
+                return
+            self.log.error("Unable to fetch new quotes: %s",
+                           failure.getErrorMessage())
+        d = factory.http.extract("http://qdb.us/random", self.randomFields,
+                                 cache=False)
+        d.addCallback(gotQuotes)
+        d.addErrback(failed)
+        return d
+
 
 class Factoid(storage.Base):
     __tablename__ = "bones_factoids"
 
     id = Column(Integer, primary_key=True)
     submitter = Column(Text)
-    topic = Column(Text)
+    topic = Column(Text, index=True)
     fact = Column(Text)
 
     def __init__(self, topic, fact, submitter):
@@ -138,50 +146,124 @@ class Factoid(storage.Base):
         self.fact = fact
 
 class Factoids(Module):
+    """Remembers facts taught with the :code:`learn` trigger, as in
+    :code:`learn topic is fact`, and repeats them when someone says
+    :code:`?topic`.
+
+    The topics that have facts are loaded into memory when the database is
+    ready, so asking about an unknown topic never touches the database. The
+    facts of recently asked topics are kept in an LRU cache with room for
+    :code:`cacheSize` topics.
+    """
     reLearn = re.compile("(.+) is (.+)")
 
+    def __init__(self, *args, **kwargs):
+        Module.__init__(self, *args, **kwargs)
+        self.db = None
+        self.topics = set()
+        self.topicsLoaded = False
+        # Bumped whenever a fact is learned, so that facts loaded before
+        # that aren't cached.
+        self.generation = 0
+        self.facts = LRUCache(int(self.settings.get(
+            "module.factoids", "cacheSize", default="1000")))
+
     @bones.event.handler(event=storage.DatabaseInitializedEvent)
     def gotDB(self, event):
         self.db = event.module
+        d = self.db.run(self.loadTopics)
+        d.addCallback(self.gotTopics)
+        d.addErrback(lambda failure: self.log.error(
+            "Unable to load factoid topics: %s", failure.getErrorMessage()))
+
+    def loadTopics(self):
+        session = self.db.new_session()
+        try:
+            return set(topic for topic,
+                       in session.query(Factoid.topic).distinct())
+        finally:
+            session.close()
+
+    def gotTopics(self, topics):
+        # Topics learned while loading are already in the set.
+        self.topics.update(topics)
+        self.topicsLoaded = True
+        self.log.debug("Loaded %i factoid topics", len(topics))
+
+    def loadFacts(self, topic):
+        session = self.db.new_session()
+        try:
+            return [fact for fact, in session.query(Factoid.fact)
+                    .filter(Factoid.topic == topic)
+                    .order_by(Factoid.id)]
+        finally:
+            session.close()
 
     @bones.event.handler(trigger="learn")
     def cmdLearnFactoid(self, event):
         match = self.reLearn.match(" ".join(event.args))
-        if match:
-            session = self.db.new_session()
+        if not match:
+            return
+        topic = match.group(1).decode("utf-8", "ignore")
+        fact = match.group(2).decode("utf-8", "ignore")
+        d = self.db.run(self.saveFactoid,
+                        Factoid(topic, fact, event.user.nickname))
+        d.addCallback(self.learnedFactoid, event, topic, fact)
+        d.addErrback(self.log.error)
+
+    def saveFactoid(self, factoid):
+        session = self.db.new_session()
+        try:
             session.begin()
-            topic = match.group(1)
-            fact = match.group(2)
-            factoid = Factoid(
-                topic,
-                fact,
-                event.user.nickname
-            )
             session.add(factoid)
             session.commit()
+        finally:
             session.close()
-            event.reply("I understand")
+
+    def learnedFactoid(self, result, event, topic, fact):
+        self.generation += 1
+        self.topics.add(topic)
+        facts = self.facts.get(topic, count=False)
+        if facts is not None:
+            facts.append(fact)
+        event.reply("I understand")
 
     @bones.event.handler(event=bones.event.IrcPrivmsgEvent)
     def queryFactoid(self, event):
-        if event.message.startswith("?"):
-            topic = event.message[1:]
-            session = self.db.new_session()
-            factoids = session.query(Factoid).filter(Factoid.topic == topic).all()
-            if not factoids:
-                return
-            msg = "%s is" % topic.decode("utf-8")
-            i = 0
-            if len(factoids) > 1:
-                for factoid in factoids:
-                    if i > 0:
-                        msg = msg + ", or"
-                    i += 1
-                    msg = msg + " (#%d) %s" % (i, factoid.fact)
-            else:
-                msg = msg + " %s" % factoids[0].fact
-            event.reply(msg.encode("utf-8"))
-            session.close()
+        if not event.message.startswith("?"):
+            return
+        topic = event.message[1:].decode("utf-8", "ignore")
+        if self.topicsLoaded and topic not in self.topics:
+            return
+        facts = self.facts.get(topic)
+        if facts is not None:
+            self.sendFactoid(event, topic, facts)
+            return
+        if self.db is None:
+            return
+
+        generation = self.generation
+
+        def gotFacts(facts):
+            if generation == self.generation:
+                self.facts.set(topic, facts)
+            self.sendFactoid(event, topic, facts)
+        d = self.db.run(self.loadFacts, topic)
+        d.addCallback(gotFacts)
+        d.addErrback(self.log.error)
+
+    def sendFactoid(self, event, topic, facts):
+        if not facts:
+            return
+        msg = "%s is" % topic
+        if len(facts) > 1:
+            for i, fact in enumerate(facts):
+                if i > 0:
+                    msg = msg + ", or"
+                msg = msg + " (#%d) %s" % (i + 1, fact)
+        else:
+            msg = msg + " %s" % facts[0]
+        event.reply(msg.encode("utf-8"))
 
 
 class UselessResponses(Module):
@@ -1,31 +1,243 @@
+import re
+
+from twisted.internet import defer
+from sqlalchemy import (
+    Column,
+    Integer,
+    Text,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import func
+
 import bones.bot
 import bones.event
-import sqlite3
-import re
+from bones.modules import storage
 
 NICK_RE = "[a-zA-Z_\-\[\]\\^{}|`][a-zA-Z0-9_\-\[\]\\^{}|`]{1,15}"
-# DB table created using
-# CREATE TABLE stats(Id INTEGER PRIMARY KEY , source TEXT, dest TEXT, type INT)
+# All karma operations in a message: "nick: ++" or "== nick" at the start of
+# the message, and "nick++" or "==nick" anywhere in it. The name of the group
+# that matched tells the kind of karma.
+reKarma = re.compile(
+    "^(?P<lead>%(nick)s):? ?\+\+"
+    "|(?P<plus>%(nick)s)\+\+"
+    "|^== ?(?P<leadneutral>%(nick)s)"
+    "|==(?P<neutral>%(nick)s)" % {"nick": NICK_RE}
+)
+reCommand = re.compile("\A\.karma (%s)" % NICK_RE)
+
+# The KarmaScores of each database, by database URL.
+sharedScores = {}
+
+
+class KarmaScores(object):
+    """The karma scores of one database, kept in memory and shared by the
+    :class:`Karmabot` instances of all servers using that database, so that
+    karma given on one server counts on the others right away.
+
+    The scores in the database are loaded once, by the first instance to
+    attach. The write buffers of all instances are held until then, so that
+    no karma is counted twice.
+
+    .. attribute:: scores
+
+        Scores by lowercase nickname, including karma that's still in the
+        write buffers.
+
+    .. attribute:: loaded
+
+        Whether the scores in the database have been loaded. If loading them
+        failed, this stays False, and scores are read from the database
+        instead.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self.loaded = False
+        self.loading = False
+        self.failed = False
+        self.buffers = []
+
+    def attach(self, bot):
+        """Starts sharing the scores with a :class:`Karmabot`, adding the
+        karma it was given before its database was ready."""
+        for dest, score in bot.scores.iteritems():
+            self.scores[dest] = self.scores.get(dest, 0) + score
+        bot.scores = self.scores
+        self.buffers.append(bot.buffer)
+        if self.loading:
+            return
+        elif self.loaded or self.failed:
+            bot.buffer.resume()
+            return
+        self.loading = True
+        d = bot.db.run(bot.loadScores)
+        d.addCallback(self.gotScores, bot)
+        d.addErrback(self.loadFailed, bot)
+
+    def detach(self, bot):
+        if bot.buffer in self.buffers:
+            self.buffers.remove(bot.buffer)
+
+    def gotScores(self, scores, bot):
+        # Karma given before the scores were loaded is already counted.
+        for dest, score in scores.iteritems():
+            self.scores[dest] = self.scores.get(dest, 0) + score
+        bot.log.debug("Loaded karma scores for %i users", len(scores))
+        self.loading = False
+        self.loaded = True
+        self.resume()
+
+    def loadFailed(self, failure, bot):
+        bot.log.error("Unable to load karma scores, reading them from the "
+                      "database instead: %s", failure.getErrorMessage())
+        self.loading = False
+        self.failed = True
+        # Karma keeps being written, it's only the totals in memory that
+        # are incomplete.
+        self.resume()
+
+    def resume(self):
+        for buffer in self.buffers:
+            buffer.resume()
+
+    def pending(self):
+        """Returns the karma that's still in the write buffers, by lowercase
+        nickname."""
+        scores = {}
+        for buffer in self.buffers:
+            for source, dest, kind in buffer.rows:
+                scores[dest] = scores.get(dest, 0) + 1
+        return scores
+
 
 class Karmabot(bones.bot.Module):
+    """Keeps track of karma given with :code:`nick++` and :code:`==nick`.
+    Requires :class:`bones.modules.storage.Database`.
+
+    Karma is written to the database in batches by a
+    :class:`~bones.modules.storage.WriteBuffer`, while scores are kept in
+    memory by a :class:`KarmaScores` shared with the other servers using the
+    same database, so that looking up a score never touches the database.
+    """
 
-    def __init__(self, factory, settings):
-        self.conn = sqlite3.connect('stats.db', check_same_thread = False)
-        self.cursor = self.conn.cursor()
+    # The number of times a batch is written before giving up, when another
+    # server adds the same user to the scores at the same time.
+    writeAttempts = 3
+
+    def __init__(self, *args, **kwargs):
+        bones.bot.Module.__init__(self, *args, **kwargs)
+        self.db = None
+        # Scores by lowercase nickname, including karma that's still in the
+        # write buffer. Replaced by the shared scores once the database is
+        # ready.
+        self.scores = {}
+        self.shared = None
+        self.buffer = storage.WriteBuffer(
+            self.writeEntries,
+            interval=float(self.settings.get(
+                "module.karma", "flushInterval", default="5")),
+            batchSize=int(self.settings.get(
+                "module.karma", "batchSize", default="100")),
+            paused=True,
+        )
+
+    @bones.event.handler(event=storage.DatabaseInitializedEvent)
+    def gotDB(self, event):
+        self.db = event.module
+        self.buffer.run = self.db.run
+        key = str(self.db.engine.url)
+        self.shared = sharedScores.get(key)
+        if self.shared is None:
+            self.shared = sharedScores[key] = KarmaScores()
+        self.shared.attach(self)
+
+    @bones.event.handler(event=bones.event.BotShutdownEvent)
+    def shutdown(self, event):
+        if self.db:
+            self.buffer.close()
+            self.shared.detach(self)
+
+    def loadScores(self, dest=None):
+        session = self.db.new_session()
+        try:
+            query = session.query(KarmaScore.dest, KarmaScore.score)
+            if dest is not None:
+                query = query.filter(KarmaScore.dest == dest)
+            return dict(query)
+        finally:
+            session.close()
+
+    def writeEntries(self, entries):
+        counts = {}
+        for source, dest, kind in entries:
+            counts[dest] = counts.get(dest, 0) + 1
+        for attempt in range(self.writeAttempts):
+            session = self.db.new_session()
+            try:
+                with session.begin():
+                    self.writeEntriesInSession(session, entries, counts)
+                return
+            except IntegrityError:
+                # Another server inserted the score of one of the users
+                # between our update and insert. The whole batch was rolled
+                # back, so it can be written again, updating that score.
+                if attempt == self.writeAttempts - 1:
+                    raise
+            finally:
+                session.close()
+
+    def writeEntriesInSession(self, session, entries, counts):
+        session.execute(KarmaEntry.__table__.insert(), [
+            {"source": source, "dest": dest, "type": kind}
+            for source, dest, kind in entries
+        ])
+        for dest, count in counts.iteritems():
+            updated = session.execute(
+                KarmaScore.__table__.update()
+                .where(KarmaScore.dest == dest)
+                .values(score=KarmaScore.score + count)
+            ).rowcount
+            if not updated:
+                session.execute(KarmaScore.__table__.insert(),
+                                {"dest": dest, "score": count})
 
     def getUserScore(self, user):
+        """Returns a :class:`~twisted.internet.defer.Deferred` firing with
+        the score of a user. It has already fired unless the scores couldn't
+        be loaded into memory."""
         user = user.lower()
-        self.cursor.execute("SELECT count(*) FROM stats WHERE dest LIKE '%s'" % (user))
-        return self.cursor.fetchone()[0]
+        if self.shared is None or self.shared.loaded:
+            return defer.succeed(self.scores.get(user, 0))
+        d = self.db.run(self.loadScores, user)
+        d.addCallback(lambda scores: scores.get(user, 0) +
+                      self.shared.pending().get(user, 0))
+        return d
 
     def getAllScores(self):
-        self.cursor.execute("SELECT dest, count(*) FROM stats GROUP BY dest ORDER BY count(*) DESC")
-        return self.cursor.fetchall()
+        """Returns a :class:`~twisted.internet.defer.Deferred` firing with a
+        list of :code:`(nickname, score)` tuples, highest score first."""
+        if self.shared is None or self.shared.loaded:
+            d = defer.succeed(self.scores)
+        else:
+            def addPending(scores):
+                for dest, score in self.shared.pending().iteritems():
+                    scores[dest] = scores.get(dest, 0) + score
+                return scores
+            d = self.db.run(self.loadScores).addCallback(addPending)
+        return d.addCallback(
+            lambda scores: sorted(scores.iteritems(), key=lambda s: -s[1]))
 
     def getUserScoreByPerson(self, user):
         user = user.lower()
-        self.cursor.execute("SELECT source, count(*) FROM stats WHERE dest LIKE '%s' GROUP BY source ORDER BY count(*) DESC" % user)
-        return self.cursor.fetchall()
+        session = self.db.new_session()
+        try:
+            return dict(
+                session.query(KarmaEntry.source, func.count(KarmaEntry.id))
+                .filter(KarmaEntry.dest == user)
+                .group_by(KarmaEntry.source)
+            )
+        finally:
+            session.close()
 
     def addKarmaEntry(self, source, dest, kind, event):
         source = source.lower()
@@ -33,51 +245,148 @@ class Karmabot(bones.bot.Module):
         if(source == dest):
             event.channel.msg("You can't karma yourself")
         else:
-            self.cursor.execute("INSERT INTO stats VALUES (NULL, '%s', '%s', %d)" % (source, dest, kind))
-            self.conn.commit()
+            self.scores[dest] = self.scores.get(dest, 0) + 1
+            self.buffer.add((source, dest, kind))
 
     # registers an event handler for whenever somebody speaks in channel
     @bones.event.handler(event=bones.event.ChannelMessageEvent)
     def publicMessage(self, event):
-        # various ++ and == rules
-        search = re.search("^(%s):? ?\+\+" % (NICK_RE), event.message)
-        if(search):
-            self.addKarmaEntry(event.user.name, search.group(1), 0, event)
-            return
-        search = re.search("(%s)\+\+" % (NICK_RE), event.message)
-        if(search):
-            self.addKarmaEntry(event.user.name, search.group(1), 0, event)
-            return
-        search = re.search("^== ?(%s)" % (NICK_RE), event.message)
-        if(search):
-            self.addKarmaEntry(event.user.name, search.group(1), 1, event)
-            return
-        search = re.search("==(%s)" % (NICK_RE), event.message)
-        if(search):
-            self.addKarmaEntry(event.user.name, search.group(1), 1, event)
-            return
+        msg = event.message
+        # Most lines contain neither, so they skip the regex entirely.
+        if "++" in msg or "==" in msg:
+            given = set()
+            for match in reKarma.finditer(msg):
+                kind = 0 if match.lastgroup in ("lead", "plus") else 1
+                dest = match.group(match.lastgroup)
+                if dest.lower() in given:
+                    continue
+                given.add(dest.lower())
+                self.addKarmaEntry(event.user.name, dest, kind, event)
+            if given:
+                return
 
         # commands
-        search = re.search("\A\.karma (%s)" % (NICK_RE), event.message)
-        if(search):
-            user = search.group(1).lower()
-            val = self.getUserScore(user)
-            #slightly vulnerable to sql injection
-            event.channel.msg("%s has %d karma" % (user, val))
+        if msg.startswith(".karma "):
+            search = reCommand.match(msg)
+            if(search):
+                user = search.group(1).lower()
+                d = self.getUserScore(user)
+                d.addCallback(lambda val: event.channel.msg(
+                    "%s has %d karma" % (user, val)))
+                d.addErrback(lambda failure: self.log.error(
+                    "Unable to look up the karma of %s: %s", user,
+                    failure.getErrorMessage()))
 
     # registers an event handler for whenever somebody private messages the bot
     @bones.event.handler(event=bones.event.UserMessageEvent)
     def privMessage(self, event):
         if(event.message == "totals"):
-            result = "List of Karmas:\r"
-            for person in self.getAllScores():
-                result += str(person[0]) + ": " + str(person[1]) + "\r" 
-            event.user.msg(result)
+            def gotScores(scores):
+                result = "List of Karmas:\r"
+                for person in scores:
+                    result += str(person[0]) + ": " + str(person[1]) + "\r"
+                event.user.msg(result)
+            d = self.getAllScores()
+            d.addCallback(gotScores)
+            d.addErrback(lambda failure: self.log.error(
+                "Unable to look up karma totals: %s",
+                failure.getErrorMessage()))
         elif(event.message == "breakdown"):
-            result = "You have "
-            for person in self.getUserScoreByPerson(event.user.name):
-                result += str(person[1]) + " from " + str(person[0]) + ", "
-            result = result[:-2]
-            event.channel.msg(result)
+            if not self.db:
+                return
+            user = event.user.name.lower()
+            # Karma that hasn't been written yet isn't in the database.
+            pending = {}
+            for source, dest, kind in self.buffer.rows:
+                if dest == user:
+                    pending[source] = pending.get(source, 0) + 1
+
+            def gotBreakdown(counts):
+                for source, count in pending.iteritems():
+                    counts[source] = counts.get(source, 0) + count
+                result = "You have "
+                for person in sorted(counts.iteritems(), key=lambda s: -s[1]):
+                    result += str(person[1]) + " from " + str(person[0]) + ", "
+                result = result[:-2]
+                event.channel.msg(result)
+            d = self.db.run(self.getUserScoreByPerson, user)
+            d.addCallback(gotBreakdown)
+            d.addErrback(self.log.error)
         else:
             event.user.msg("I don't support any private commands besides 'totals' and 'breakdown' right now")
+
+
+class KarmaEntry(storage.Base):
+    __tablename__ = "bones_karma"
+
+    id = Column(Integer, primary_key=True)
+    source = Column(Text)
+    dest = Column(Text, index=True)
+    type = Column(Integer)
+
+
+class KarmaScore(storage.Base):
+    __tablename__ = "bones_karma_scores"
+
+    dest = Column(Text, primary_key=True)
+    score = Column(Integer, default=0)
+
+
+def importLegacyDatabase(engine, path):
+    """Copies the karma from the :code:`stats.db` SQLite database used by
+    earlier versions of this module."""
+    import sqlite3
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT source, dest, type FROM stats").fetchall()
+    conn.close()
+    counts = {}
+    for source, dest, kind in rows:
+        dest = dest.lower()
+        counts[dest] = counts.get(dest, 0) + 1
+    with engine.begin() as connection:
+        if rows:
+            connection.execute(KarmaEntry.__table__.insert(), [
+                {"source": source.lower(), "dest": dest.lower(), "type": kind}
+                for source, dest, kind in rows
+            ])
+        for dest, count in counts.iteritems():
+            updated = connection.execute(
+                KarmaScore.__table__.update()
+                .where(KarmaScore.dest == dest)
+                .values(score=KarmaScore.score + count)
+            ).rowcount
+            if not updated:
+                connection.execute(KarmaScore.__table__.insert(),
+                                   {"dest": dest, "score": count})
+    return len(rows)
+
+
+if __name__ == "__main__":
+    from ConfigParser import SafeConfigParser
+    from sqlalchemy import engine_from_config
+    import sys
+    settings = SafeConfigParser()
+    if len(sys.argv) < 2:
+        print "Error: You need to provide a config file!"
+        print "Usage: %s <config file> [legacy stats.db]" % sys.argv[0]
+        sys.exit(1)
+    settings.read(sys.argv[1])
+    if "storage" not in settings._sections:
+        print "Error: Config file does not contain a 'storage' section."
+        sys.exit(1)
+    elif "sqlalchemy.url" not in settings._sections["storage"]:
+        print ("Error: Section 'storage' does not contain an 'sqlalchemy.url' "
+               "key.")
+        sys.exit(1)
+    print ("Connecting to '%s'..."
+           % settings._sections["storage"]["sqlalchemy.url"])
+    engine = engine_from_config(settings._sections["storage"], "sqlalchemy.")
+    print "Creating tables '%s' and '%s'..." % (KarmaEntry.__tablename__,
+                                               KarmaScore.__tablename__)
+    from bones.modules.storage import Base
+    Base.metadata.create_all(engine)
+    if len(sys.argv) > 2:
+        print "Importing karma from '%s'..." % sys.argv[2]
+        print "Imported %i entries." % importLegacyDatabase(engine,
+                                                            sys.argv[2])
+    print "Have a nice day!"
@@ -1,6 +1,5 @@
 # -*- encoding: utf-8 -*-
 from datetime import datetime
-import json
 import urllib
 
 from sqlalchemy import (
@@ -46,7 +45,7 @@ class Lastfm(Module):
         elif action == "-d":
             return self.deleteUser(event)
 
-    def api(self, method, **args):
+    def api(self, method, cache=True, **args):
         params = {
             "method": method,
             "api_key": self.apikey,
@@ -55,60 +54,61 @@ class Lastfm(Module):
         params.update(args)
         querystring = urllib.urlencode(params)
 
-        data = self.factory.urlopener.open(
-            "http://ws.audioscrobbler.com/2.0/?%s" % querystring).read()
-        data = json.loads(data)
-        return data
+        return self.factory.http.getJSON(
+            "http://ws.audioscrobbler.com/2.0/?%s" % querystring, cache=cache)
 
     def showTrack(self, event, nickname, username):
-        session = self.db.new_session()
-        user = self.getUser(session, nickname, username)
-        if not user:
-            event.channel.msg(
-                str("%s: No user registered for nick '%s'"
-                    % (event.user.nickname, nickname))
-            )
-            return
-
-        try:
-            data = self.api("user.getRecentTracks", user=user.username, extended=1)
-        except ValueError:
-            event.channel.msg(
-                "[Last.fm] Last.fm returned an invalid response. Please "
-                "try again later."
-            )
-            self.log.exception(
-                "An error occurred while fetching user.getRecentTracks for"
-                "user %s", nickname)
-            return
-        except Exception:
-            event.channel.msg(
-                "[Last.fm] An unexpected error occurred. Please tell the "
-                "bot manager to file a bug report."
-            )
-            self.log.exception(
-                "An error occurred while fetching user.getRecentTracks for"
-                "user %s", nickname)
-            return
-
-        if "error" in data:
-            self.log.error("API error %i: %s", data["error"],
-                           data["message"])
-            event.channel.msg(
-                "[Last.fm] An error occurred while processing your "
-                "request. Please notify the bot manager"
-            )
-            return
-
-        if "track" not in data["recenttracks"] \
-                or len(data['recenttracks']['track']) < 1:
-            event.channel.msg(str(
-                "%s: No scrobbles found for user '%s'."
-                % (event.user.nickname, user.username)
-            ))
-            return
-
-        return self.sendTrackToChannel(event, user, data)
+        def gotUser(user):
+            if not user:
+                event.channel.msg(
+                    str("%s: No user registered for nick '%s'"
+                        % (event.user.nickname, nickname))
+                )
+                return
+            d = self.api("user.getRecentTracks", cache=False,
+                         user=user.username, extended=1)
+            d.addCallback(gotTracks, user)
+            return d
+
+        def gotTracks(data, user):
+            if "error" in data:
+                self.log.error("API error %i: %s", data["error"],
+                               data["message"])
+                event.channel.msg(
+                    "[Last.fm] An error occurred while processing your "
+                    "request. Please notify the bot manager"
+                )
+                return
+
+            if "track" not in data["recenttracks"] \
+                    or len(data['recenttracks']['track']) < 1:
+                event.channel.msg(str(
+                    "%s: No scrobbles found for user '%s'."
+                    % (event.user.nickname, user.username)
+                ))
+                return
+
+            return self.sendTrackToChannel(event, user, data)
+
+        def failed(failure):
+            if failure.check(ValueError):
+                event.channel.msg(
+                    "[Last.fm] Last.fm returned an invalid response. Please "
+                    "try again later."
+                )
+            else:
+                event.channel.msg(
+                    "[Last.fm] An unexpected error occurred. Please tell the "
+                    "bot manager to file a bug report."
+                )
+            self.log.error(
+                "An error occurred while fetching user.getRecentTracks for "
+                "user %s: %s", nickname, failure.getTraceback())
+
+        d = self.getUser(nickname, username)
+        d.addCallback(gotUser)
+        d.addErrback(failed)
+        return d
 
     def sendTrackToChannel(self, event, user, data):
         track = data['recenttracks']['track'][0]
@@ -147,33 +147,40 @@ class Lastfm(Module):
         event.channel.msg(str(msg.encode("utf-8")))
 
     def registerUser(self, event, username):
-        session = self.db.new_session()
         if not username:
             event.user.notice(str(
                 "[Last.fm] You need to provide a Last.fm username."))
             return
 
-        user = self.getUser(session, event.user.nickname, username)
-        user.username = username
-        session.begin()
-        session.add(user)
-        session.commit()
-        event.user.notice(str(
-            "[Last.fm] Registered '%s' to your nick." % username))
+        def gotUser(user):
+            if not user:
+                event.user.notice(str(
+                    "[Last.fm] No Last.fm user named '%s'." % username))
+                return
+            d = self.db.run(self.saveUser, event.user.nickname, username)
+            d.addCallback(lambda _: event.user.notice(str(
+                "[Last.fm] Registered '%s' to your nick." % username)))
+            return d
+
+        d = self.getUser(event.user.nickname, username)
+        d.addCallback(gotUser)
+        d.addErrback(self.log.error)
+        return d
 
     def deleteUser(self, event):
-        session = self.db.new_session()
-        user = self.getUser(session, event.user.nickname)
-        if not user:
+        def deleted(username):
+            if not username:
+                event.user.notice(str(
+                    "[Last.fm] No user registered for nick '%s'."
+                    % event.user.nickname))
+                return
             event.user.notice(str(
-                "[Last.fm] No user registered for nick '%s'." % event.user.nickname))
-            return
+                "[Last.fm] Unregistered your nick from '%s'." % username))
 
-        session.begin()
-        session.delete(user)
-        session.commit()
-        event.user.notice(str(
-            "[Last.fm] Unregistered your nick from '%s'." % user.username))
+        d = self.db.run(self.removeUser, event.user.nickname)
+        d.addCallback(deleted)
+        d.addErrback(self.log.error)
+        return d
 
     def parseargs(self, event):
         argc = len(event.args)
@@ -192,33 +199,77 @@ class Lastfm(Module):
             username = nickname
         return (nickname, username, action)
 
-    def getUser(self, session, nickname, username=None):
-        user = session.query(User).filter(User.nickname == nickname) \
-            .first()
+    def getUser(self, nickname, username=None):
+        """Looks up the Last.fm user registered to the given nickname. If no
+        user is registered and a username is given, the username is looked up
+        on Last.fm and registered to the nickname if it exists.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` firing with the
+            :class:`User`, or None if no user could be found.
+        """
+        def gotUser(user):
+            if user or not username:
+                return user
+            d = self.api("user.getInfo", user=username)
+            d.addCallback(gotInfo)
+            return d
+
+        def gotInfo(data):
+            if "error" in data:
+                return None
+            self.log.info("Found account for unknown user '%s', saving.",
+                          nickname)
+            return self.db.run(self.saveUser, nickname, username)
+
+        d = self.db.run(self.findUser, nickname)
+        d.addCallback(gotUser)
+        return d
+
+    def findUser(self, nickname):
+        session = self.db.new_session()
+        try:
+            return session.query(User).filter(User.nickname == nickname) \
+                .first()
+        finally:
+            session.close()
 
-        if user or not username:
+    def saveUser(self, nickname, username):
+        session = self.db.new_session()
+        try:
+            user = session.query(User).filter(User.nickname == nickname) \
+                .first()
+            if not user:
+                user = User(nickname)
+            user.username = username
+            session.begin()
+            session.add(user)
+            session.commit()
+            session.refresh(user)
             return user
+        finally:
+            session.close()
 
-        if not username:
-            username = nickname
-        data = self.api("user.getInfo", user=username)
-        if "error" in data:
-            return None
-
-        self.log.info("Found account for unknown user '%s', saving.", nickname)
-        user = User(nickname)
-        user.username = username
-        session.begin()
-        session.add(user)
-        session.commit()
-        return user
+    def removeUser(self, nickname):
+        session = self.db.new_session()
+        try:
+            user = session.query(User).filter(User.nickname == nickname) \
+                .first()
+            if not user:
+                return None
+            username = user.username
+            session.begin()
+            session.delete(user)
+            session.commit()
+            return username
+        finally:
+            session.close()
 
 
 class User(storage.Base):
     __tablename__ = "bones_lastfm"
 
     id = Column(Integer, primary_key=True)
-    nickname = Column(Text)
+    nickname = Column(Text, index=True)
     username = Column(Text)
 
     def __init__(self, nickname):
@@ -1,39 +1,266 @@
 from datetime import datetime
+import math
+import random
+import re
+import threading
 
+from twisted.internet import reactor
 from sqlalchemy import (
     Column,
     Integer,
     Text,
     Enum,
     DateTime,
+    Index,
 )
-from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import func, text
 
 import bones.event
 import bones.bot
+from bones.cache import LRUCache
 from bones.modules import storage
 
 
+class RandomPicker(object):
+    """Picks random rows matching a value of an indexed column, without
+    sorting all matching rows like :code:`ORDER BY random()` does.
+
+    The number of rows matching each value is cached. A random offset below
+    that number is picked, and the row at that offset is looked up by walking
+    the :code:`(column, id)` index, so every matching row is equally likely to
+    be picked regardless of gaps in the id sequence.
+
+    :param model: The model to pick rows from.
+    :param column: The column to filter on, which should be indexed
+        together with the id.
+    """
+
+    def __init__(self, model, column, cacheSize=1000, ttl=600.0):
+        self.model = model
+        self.column = column
+        self.counts = LRUCache(cacheSize, ttl)
+        # Pickers are used from handlers running in the thread pool.
+        self.lock = threading.Lock()
+
+    def invalidate(self, value):
+        """Forgets the cached row count for a value, after rows matching it
+        were added or deleted."""
+        with self.lock:
+            self.counts.delete(value)
+
+    def count(self, session, value):
+        """Returns the number of rows where the column equals the given
+        value, from the cache if possible."""
+        with self.lock:
+            count = self.counts.get(value)
+        if count is None:
+            count = (
+                session.query(func.count(self.model.id))
+                .filter(self.column == value)
+                .scalar()
+            )
+            with self.lock:
+                self.counts.set(value, count)
+        return count
+
+    def pick(self, session, value):
+        """Returns a random row where the column equals the given value, or
+        None if there are no such rows."""
+        query = (
+            session.query(self.model)
+            .filter(self.column == value)
+            .order_by(self.model.id)
+        )
+        for attempt in range(2):
+            count = self.count(session, value)
+            if not count:
+                return None
+            row = query.offset(random.randrange(count)).first()
+            if row is not None:
+                return row
+            # Rows have been deleted since they were counted.
+            self.invalidate(value)
+        return None
+
+
+def tokenize(quote):
+    """Splits a quote into the lowercase words used for searching."""
+    return re.findall(r"\w+", quote.lower(), re.UNICODE)
+
+
+class InvertedIndex(object):
+    """Full-text index of the channel quotes kept in memory, used when the
+    database doesn't support SQLite's FTS5. Results are ranked by the
+    frequency of the search words in each quote, weighted by how rare the
+    words are.
+    """
+
+    def __init__(self):
+        # Quote ids and word counts by word, and the words of each quote.
+        self.postings = {}
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def build(self, session):
+        rows = session.query(ChannelQuote.id, ChannelQuote.quote).all()
+        with self.lock:
+            self.postings = {}
+            self.documents = {}
+            for id, quote in rows:
+                self._add(id, quote)
+
+    def add(self, id, quote):
+        with self.lock:
+            self._add(id, quote)
+
+    def _add(self, id, quote):
+        words = tokenize(quote or u"")
+        self.documents[id] = set(words)
+        for word in words:
+            counts = self.postings.setdefault(word, {})
+            counts[id] = counts.get(id, 0) + 1
+
+    def remove(self, id):
+        with self.lock:
+            for word in self.documents.pop(id, ()):
+                counts = self.postings.get(word)
+                if counts is not None:
+                    counts.pop(id, None)
+                    if not counts:
+                        del self.postings[word]
+
+    def search(self, session, words, limit):
+        with self.lock:
+            matches = [self.postings.get(word, {}) for word in set(words)]
+            if not matches or not all(matches):
+                return []
+            matches.sort(key=len)
+            ids = set(matches[0]).intersection(*matches[1:])
+            total = float(len(self.documents))
+            scores = {}
+            for counts in matches:
+                idf = math.log(1 + total / len(counts))
+                for id in ids:
+                    scores[id] = scores.get(id, 0.0) + counts[id] * idf
+        return sorted(ids, key=lambda id: (-scores[id], id))[:limit]
+
+
+class FTS5Index(object):
+    """Full-text index of the channel quotes in an SQLite FTS5 table, which
+    is kept up to date by triggers on the quote table. Results are ranked by
+    FTS5's bm25 ranking.
+    """
+
+    def build(self, session):
+        with session.begin():
+            exists = session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE name = "
+                "'bones_quotes_channel_fts'")).first()
+            session.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS bones_quotes_channel_fts "
+                "USING fts5(quote, content='bones_quotes_channel', "
+                "content_rowid='id')"))
+            session.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS bones_quotes_channel_fts_ai "
+                "AFTER INSERT ON bones_quotes_channel BEGIN "
+                "INSERT INTO bones_quotes_channel_fts(rowid, quote) "
+                "VALUES (new.id, new.quote); END"))
+            session.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS bones_quotes_channel_fts_ad "
+                "AFTER DELETE ON bones_quotes_channel BEGIN "
+                "INSERT INTO bones_quotes_channel_fts"
+                "(bones_quotes_channel_fts, rowid, quote) "
+                "VALUES ('delete', old.id, old.quote); END"))
+            session.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS bones_quotes_channel_fts_au "
+                "AFTER UPDATE ON bones_quotes_channel BEGIN "
+                "INSERT INTO bones_quotes_channel_fts"
+                "(bones_quotes_channel_fts, rowid, quote) "
+                "VALUES ('delete', old.id, old.quote); "
+                "INSERT INTO bones_quotes_channel_fts(rowid, quote) "
+                "VALUES (new.id, new.quote); END"))
+            if not exists:
+                session.execute(text(
+                    "INSERT INTO bones_quotes_channel_fts"
+                    "(bones_quotes_channel_fts) VALUES ('rebuild')"))
+
+    def add(self, id, quote):
+        pass
+
+    def remove(self, id):
+        pass
+
+    def search(self, session, words, limit):
+        query = u" AND ".join(u'"%s"' % word.replace(u'"', u'""')
+                              for word in words)
+        rows = session.execute(text(
+            "SELECT rowid FROM bones_quotes_channel_fts "
+            "WHERE bones_quotes_channel_fts MATCH :query "
+            "ORDER BY rank LIMIT :limit"), {"query": query, "limit": limit})
+        return [row[0] for row in rows]
+
+
+def supportsFTS5(engine):
+    if engine.dialect.name != "sqlite":
+        return False
+    connection = engine.raw_connection()
+    try:
+        connection.execute("CREATE VIRTUAL TABLE temp.bones_fts5_check "
+                           "USING fts5(x)")
+        connection.execute("DROP TABLE temp.bones_fts5_check")
+        return True
+    except Exception:
+        return False
+    finally:
+        connection.close()
+
+
 class UserQuotes(bones.bot.Module):
 
+    def __init__(self, *args, **kwargs):
+        bones.bot.Module.__init__(self, *args, **kwargs)
+        self.db = None
+        self.picker = RandomPicker(UserQuote, UserQuote.nickname)
+        # Logged lines are written in batches rather than in a transaction
+        # per line.
+        self.buffer = storage.WriteBuffer(
+            self.writeQuotes,
+            interval=float(self.settings.get(
+                "module.quotes", "log.flushInterval", default="2")),
+            batchSize=int(self.settings.get(
+                "module.quotes", "log.batchSize", default="200")),
+            maxRows=int(self.settings.get(
+                "module.quotes", "log.maxBuffered", default="10000")),
+            overflow=self.settings.get(
+                "module.quotes", "log.overflow", default="oldest"),
+            paused=True,
+        )
+
     @bones.event.handler(event=storage.DatabaseInitializedEvent)
     def gotDB(self, event):
         self.db = event.module
+        self.buffer.run = self.db.run
+        self.buffer.resume()
+
+    @bones.event.handler(event=bones.event.BotShutdownEvent)
+    def shutdown(self, event):
+        if self.db:
+            self.buffer.close()
 
     @bones.event.handler(trigger="quoterandom")
     def trigger(self, event):
-        session = self.db.new_session()
+        d = self.db.run(self.cmdQuoteRandom, event)
+        d.addErrback(self.log.error)
+
+    def cmdQuoteRandom(self, event):
         nick = event.user.nickname
         if len(event.args) > 0:
             nick = event.args[0]
-        quote = (
-            session.query(UserQuote)
-
-            .filter(UserQuote.nickname == nick)
-            .order_by(func.random())
-            .limit(1)
-            .first()
-        )
+        session = self.db.new_session()
+        try:
+            quote = self.picker.pick(session, nick)
+        finally:
+            session.close()
         if not quote:
             event.channel.msg(str("%s: The specified user is very quiet!"
                                   % event.user.nickname))
@@ -55,24 +282,78 @@ class UserQuotes(bones.bot.Module):
             msg = event.message
         tmp = msg.strip()
         if tmp[1:].lower() != "quoterandom":
-            session = self.db.new_session()
-            quote = UserQuote(
-                event.user.nickname,
-                event.channel.name,
-                msg.decode("utf-8", "ignore"),
-                eventtype
-            )
-            session.begin()
-            session.add(quote)
-            session.commit()
+            self.buffer.add({
+                "nickname": event.user.nickname,
+                "channel": event.channel.name,
+                "quote": msg.decode("utf-8", "ignore"),
+                "type": eventtype,
+                "timestamp": datetime.now(),
+            })
+
+    def writeQuotes(self, rows):
+        session = self.db.new_session()
+        try:
+            with session.begin():
+                session.execute(UserQuote.__table__.insert(), rows)
+        finally:
             session.close()
+        for nickname in set(row["nickname"] for row in rows):
+            self.picker.invalidate(nickname)
 
 
 class ChannelQuotes(bones.bot.Module):
 
+    def __init__(self, *args, **kwargs):
+        bones.bot.Module.__init__(self, *args, **kwargs)
+        self.picker = RandomPicker(ChannelQuote, ChannelQuote.channel)
+        self.maxResults = int(self.settings.get(
+            "module.quotes", "search.maxResults", default="20"))
+        # Seconds to wait before building the search index again, after
+        # building it failed.
+        self.indexRetryDelay = float(self.settings.get(
+            "module.quotes", "search.retryDelay", default="60"))
+        self.index = None
+        self.indexCall = None
+        self.clock = reactor
+
     @bones.event.handler(event=storage.DatabaseInitializedEvent)
     def gotDB(self, event):
         self.db = event.module
+        self.startBuildingIndex()
+
+    @bones.event.handler(event=bones.event.BotShutdownEvent)
+    def shutdown(self, event):
+        if self.indexCall is not None and self.indexCall.active():
+            self.indexCall.cancel()
+
+    def startBuildingIndex(self):
+        self.indexCall = None
+        d = self.db.run(self.buildIndex)
+        d.addErrback(self.buildingIndexFailed)
+
+    def buildingIndexFailed(self, failure):
+        self.log.error("Unable to build the quote search index, trying "
+                       "again in %i seconds: %s", self.indexRetryDelay,
+                       failure.getErrorMessage())
+        self.indexCall = self.clock.callLater(self.indexRetryDelay,
+                                              self.startBuildingIndex)
+
+    def buildIndex(self):
+        # The quote table may not exist yet in a database that hasn't been
+        # migrated, and the index can't be built without it.
+        ChannelQuote.__table__.create(self.db.engine, checkfirst=True)
+        if supportsFTS5(self.db.engine):
+            index = FTS5Index()
+        else:
+            index = InvertedIndex()
+        session = self.db.new_session()
+        try:
+            index.build(session)
+        finally:
+            session.close()
+        self.index = index
+        self.log.debug("Quote search index ready (%s)",
+                       index.__class__.__name__)
 
     @bones.event.handler(trigger="quote")
     def trigger(self, event):
@@ -90,7 +371,8 @@ class ChannelQuotes(bones.bot.Module):
                 (", ".join(["'%s'" % cmd for cmd in cmds]))
             ))
             return
-        cmds[event.args[0].lower()](event)
+        d = self.db.run(cmds[event.args[0].lower()], event)
+        d.addErrback(self.log.error)
 
     def cmdQuoteDelete(self, event):
         """Deletes the quote matching the given ID."""
@@ -102,37 +384,45 @@ class ChannelQuotes(bones.bot.Module):
             return
 
         session = self.db.new_session()
-        quote = (
-            session.query(ChannelQuote)
-
-            .filter(ChannelQuote.id == event.args[1])
-            .limit(1)
-            .first()
-        )
-
-        if not quote:
-            event.channel.notice("[Quote] No such quote '%s'"
-                                 % event.args[1])
-            return
+        try:
+            quote = (
+                session.query(ChannelQuote)
 
-        dateThen = quote.timestamp.replace(tzinfo=None)
-        dateNow = datetime.now()
-        diff = dateNow - dateThen
-        if quote.submitter != event.user.nickname:
-            event.user.notice(
-                "[Quote] You do not have permission do delete this quote."
-            )
-            return
-        if diff.seconds > 3600:
-            event.user.notice(
-                "[Quote] This quote has been archived and thus cannot be "
-                "removed."
+                .filter(ChannelQuote.id == event.args[1])
+                .limit(1)
+                .first()
             )
-            return
 
-        session.begin()
-        session.delete(quote)
-        session.commit()
+            if not quote:
+                event.channel.notice("[Quote] No such quote '%s'"
+                                     % event.args[1])
+                return
+
+            dateThen = quote.timestamp.replace(tzinfo=None)
+            dateNow = datetime.now()
+            diff = dateNow - dateThen
+            if quote.submitter != event.user.nickname:
+                event.user.notice(
+                    "[Quote] You do not have permission do delete this "
+                    "quote."
+                )
+                return
+            if diff.seconds > 3600:
+                event.user.notice(
+                    "[Quote] This quote has been archived and thus cannot "
+                    "be removed."
+                )
+                return
+
+            channel = quote.channel
+            id = quote.id
+            with session.begin():
+                session.delete(quote)
+        finally:
+            session.close()
+        self.picker.invalidate(channel)
+        if self.index is not None:
+            self.index.remove(id)
         event.channel.msg("[Quote] Quote #%s deleted." % event.args[1])
 
     def cmdQuoteAdd(self, event):
@@ -142,56 +432,60 @@ class ChannelQuotes(bones.bot.Module):
             event.user.notice(str("[Quote] That quote is empty!"))
             return
 
-        cquote = ChannelQuote(
-            event.user.nickname,
-            event.channel.name,
-            quote.decode("utf-8", "ignore"),
-        )
+        quote = quote.decode("utf-8", "ignore")
+        cquote = ChannelQuote(event.user.nickname, event.channel.name, quote)
         session = self.db.new_session()
-        session.begin()
-        session.add(cquote)
-        session.commit()
-        event.channel.msg("Quote #%i saved." % cquote.id)
+        try:
+            with session.begin():
+                session.add(cquote)
+            id = cquote.id
+        finally:
+            session.close()
+        self.picker.invalidate(event.channel.name)
+        if self.index is not None:
+            self.index.add(id, quote)
+        event.channel.msg("Quote #%i saved." % id)
 
     def cmdQuoteRandom(self, event):
         """Sends a random quote from the current channel's quote database."""
         session = self.db.new_session()
-        quote = (
-            session.query(ChannelQuote)
-
-            .filter(ChannelQuote.channel == event.channel.name)
-            .order_by(func.random())
-            .limit(1)
-            .first()
-        )
+        try:
+            quote = self.picker.pick(session, event.channel.name)
+        finally:
+            session.close()
         self.sendQuote(event, quote)
 
     def cmdQuoteSearch(self, event):
-        """Searches for a quote matching the given string and returns results
-        from all channels' quote database."""
+        """Searches all channels' quote database for quotes containing all
+        the given words, best matches first."""
         if len(event.args) < 2:
             event.user.notice("[Quote] You need to provide a search term!")
             return
-        term = " ".join(event.args[1:])
+        words = tokenize(" ".join(event.args[1:]).decode("utf-8", "ignore"))
+        if not words:
+            event.user.notice("[Quote] You need to provide a search term!")
+            return
+        if self.index is None:
+            event.user.notice("[Quote] The search index isn't ready yet, "
+                              "try again in a moment.")
+            return
 
         session = self.db.new_session()
-        quotes = (
-            session.query(ChannelQuote)
-
-            .filter(ChannelQuote.quote.like("%%%s%%" % term))
-            .order_by(ChannelQuote.id.asc())
-            .all()
-        )
-        if len(quotes) > 1:
-            results = ""
-            for result in quotes:
-                if results != "":
-                    results = results + ", "
-                results = results + ("#%d" % result.id)
+        try:
+            ids = self.index.search(session, words, self.maxResults + 1)
+            quote = None
+            if len(ids) == 1:
+                quote = session.query(ChannelQuote).get(ids[0])
+        finally:
+            session.close()
+        if len(ids) > 1:
+            results = ", ".join("#%d" % id for id in ids[:self.maxResults])
+            if len(ids) > self.maxResults:
+                results += " and more"
             event.channel.msg("[Quote] Results found: %s" % results)
             return
-        if len(quotes) == 1:
-            self.sendQuote(event, quotes.pop())
+        if len(ids) == 1:
+            self.sendQuote(event, quote)
             return
         event.channel.msg("[Quote] No results found")
 
@@ -205,13 +499,16 @@ class ChannelQuotes(bones.bot.Module):
             return
 
         session = self.db.new_session()
-        quote = (
-            session.query(ChannelQuote)
+        try:
+            quote = (
+                session.query(ChannelQuote)
 
-            .filter(ChannelQuote.id == event.args[1])
-            .limit(1)
-            .first()
-        )
+                .filter(ChannelQuote.id == event.args[1])
+                .limit(1)
+                .first()
+            )
+        finally:
+            session.close()
         self.sendQuote(event, quote)
 
     def sendQuote(self, event, quote):
@@ -253,6 +550,9 @@ class ChannelQuotes(bones.bot.Module):
 
 class UserQuote(storage.Base):
     __tablename__ = "bones_quotes_user"
+    __table_args__ = (
+        Index("ix_bones_quotes_user_nickname_id", "nickname", "id"),
+    )
 
     id = Column(Integer, primary_key=True)
     nickname = Column(Text)
@@ -282,6 +582,9 @@ class UserQuote(storage.Base):
 
 class ChannelQuote(storage.Base):
     __tablename__ = "bones_quotes_channel"
+    __table_args__ = (
+        Index("ix_bones_quotes_channel_channel_id", "channel", "id"),
+    )
 
     id = Column(Integer, primary_key=True)
     submitter = Column(Text)
@@ -1,46 +1,387 @@
-from sqlalchemy import engine_from_config
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+from sqlalchemy import engine_from_config, func, inspect, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import (
     sessionmaker,
 )
+from sqlalchemy.util import asbool
 
 import bones.event
+import bones.log
 from bones.bot import Module
 
 Base = declarative_base()
 
+# The Python modules bundled with Bones that keep tables in the database.
+# They're imported by :func:`loadModels` so that :func:`migrate` knows about
+# their tables even if the bot doesn't load them.
+bundledModels = [
+    "bones.modules.funserv",
+    "bones.modules.karma",
+    "bones.modules.lastfm",
+    "bones.modules.quotes",
+    "bones.modules.webcache",
+]
+
 
 class Database(Module):
+    """Connects to the database configured in the :code:`[storage]` section
+    and fires :class:`DatabaseInitializedEvent` once it's ready.
+
+    Database work should be done through :meth:`run`, which runs it in a
+    thread pool of its own instead of the reactor's thread pool. The pool
+    has as many threads as the engine's connection pool has connections, or
+    the number of threads given by the :code:`threads` option.
+    """
+
+    # The number of threads used when the connection pool doesn't limit the
+    # number of connections, like the pool SQLite databases use.
+    defaultThreads = 4
 
     def __init__(self, **args):
         Module.__init__(self, **args)
         self.sessionmaker = None
         self.engine = None
+        self.threadpool = None
 
     def new_session(self):
         return self.sessionmaker()
 
     def get_config(self):
-        config = {}
-        if "storage" in self.settings.data:
-            config = self.settings.data["storage"]
-        if "sqlalchemy.url" not in config:
-            config["sqlalchemy.url"] = "sqlite:///bones.db"
-        if "sqlalchemy.encoding" not in config:
-            config["sqlalchemy.encoding"] = "utf-8"
-        if "sqlalchemy.convert_unicode" not in config:
-            config["sqlalchemy.convert_unicode"] = "true"
-        return config
+        return getConfig(self.settings)
+
+    def run(self, fn, *args, **kwargs):
+        """Calls a function in the database thread pool.
+
+        :param fn: The function to call. Any additional arguments are passed
+            along to it.
+        :type fn: callable
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` firing with the
+            return value of the function.
+        """
+        return threads.deferToThreadPool(reactor, self.threadpool, fn,
+                                         *args, **kwargs)
+
+    def poolThreads(self):
+        pool = self.engine.pool
+        if isinstance(pool, QueuePool):
+            # The pool doesn't tell how many overflow connections it may
+            # open, so it's taken from the configuration, defaulting to
+            # SQLAlchemy's default. A negative overflow means there's no
+            # limit on overflow connections.
+            overflow = int(self.get_config().get("sqlalchemy.max_overflow",
+                                                 10))
+            return pool.size() + max(overflow, 0)
+        return self.defaultThreads
 
     @bones.event.handler(event=bones.event.BotInitializedEvent)
     def botReady(self, event):
-        self.engine = engine_from_config(self.get_config(), "sqlalchemy.")
+        self.engine = createEngine(self.get_config())
         self.log.debug("Connected to database")
+        count = self.settings.get("storage", "threads", default=None)
+        count = int(count) if count else self.poolThreads()
+        self.threadpool = ThreadPool(1, count, "bones.storage")
+        self.threadpool.start()
+        reactor.addSystemEventTrigger("during", "shutdown",
+                                      self.threadpool.stop)
+        self.log.debug("Started %i database threads", count)
+        self.sessionmaker = sessionmaker(bind=self.engine, autocommit=True)
         dbInitEvent = DatabaseInitializedEvent(self)
         bones.event.fire(event.factory.tag, dbInitEvent)
-        self.sessionmaker = sessionmaker(bind=self.engine, autocommit=True)
 
 
 class DatabaseInitializedEvent(bones.event.Event):
     def __init__(self, module):
         self.module = module
+
+
+class WriteBuffer(object):
+    """Collects rows in memory and writes them to the database in batches, so
+    that modules that write on every message don't need a transaction per
+    message.
+
+    Rows are written once :code:`batchSize` rows have been buffered, or
+    :code:`interval` seconds after the first row was buffered, whichever
+    comes first. Writes are done in a thread, one batch at a time, by
+    :attr:`run`. If the database can't keep up and :code:`maxRows` rows are
+    buffered, what happens to new rows depends on :code:`overflow`. A buffer
+    that is created paused doesn't write anything until :meth:`resume` is
+    called.
+
+    :param write: Callable that writes a list of rows to the database. It is
+        called in a thread, and should write all the rows in a single
+        transaction.
+    :type write: callable
+    :param interval: Time in seconds rows may be kept in the buffer.
+    :type interval: float
+    :param batchSize: The number of rows that triggers a write right away.
+    :type batchSize: int
+    :param maxRows: The maximum number of rows kept in the buffer.
+    :type maxRows: int
+    :param overflow: What to do when the buffer is full: :code:`"oldest"`
+        drops the oldest buffered row, :code:`"newest"` drops the new row and
+        :code:`"block"` writes all buffered rows right away, blocking the
+        caller until they have been written.
+    :type overflow: str.
+    :param paused: Whether to hold on to all rows until :meth:`resume` is
+        called, for example until the module has loaded its data.
+    :type paused: bool
+
+    .. attribute:: dropped
+
+        The number of rows that were dropped because the buffer was full or
+        a write failed.
+
+    .. attribute:: run
+
+        The function used to call :code:`write` in a thread, which defaults
+        to the reactor's thread pool. Modules set it to
+        :meth:`Database.run` once the database is ready.
+    """
+
+    def __init__(self, write, interval=5.0, batchSize=100, maxRows=10000,
+                 overflow="oldest", paused=False, clock=reactor):
+        if overflow not in ("oldest", "newest", "block"):
+            raise ValueError("Unknown overflow policy %r" % (overflow,))
+        self.write = write
+        self.interval = interval
+        self.batchSize = batchSize
+        self.maxRows = maxRows
+        self.overflow = overflow
+        self.clock = clock
+        self.paused = paused
+        self.rows = []
+        self.writing = None
+        self.pending = None
+        self.dropped = 0
+        self.run = threads.deferToThread
+        self.log = bones.log.getLogger(__name__)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, row):
+        """Adds a row to the buffer."""
+        if len(self.rows) >= self.maxRows:
+            if self.overflow == "block" and not self.paused:
+                self.log.warning("Write buffer full, writing %i rows "
+                                 "right away", len(self.rows))
+                self.writeNow()
+            elif self.overflow == "newest":
+                self.dropped += 1
+                self.log.warning("Write buffer full, dropped a row (%i "
+                                 "dropped so far)", self.dropped)
+                return
+            else:
+                del self.rows[0]
+                self.dropped += 1
+                self.log.warning("Write buffer full, dropped a row (%i "
+                                 "dropped so far)", self.dropped)
+        self.rows.append(row)
+        if len(self.rows) >= self.batchSize:
+            self.flush()
+        elif self.pending is None:
+            self.pending = self.clock.callLater(self.interval, self.flush)
+
+    def flush(self):
+        """Writes the buffered rows in the thread pool.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` firing once the
+            rows have been written, or None if there was nothing to write or
+            a write was already in progress. In the latter case the rows are
+            written once that write is done.
+        """
+        if self.pending is not None:
+            if self.pending.active():
+                self.pending.cancel()
+            self.pending = None
+        if not self.rows or self.writing is not None or self.paused:
+            return
+        rows, self.rows = self.rows, []
+        self.writing = self.run(self.write, rows)
+
+        def failed(failure):
+            self.dropped += len(rows)
+            self.log.error("Unable to write %i rows: %s", len(rows),
+                           failure.getErrorMessage())
+
+        def done(_):
+            self.writing = None
+            if len(self.rows) >= self.batchSize:
+                self.flush()
+            elif self.rows and self.pending is None:
+                self.pending = self.clock.callLater(self.interval,
+                                                    self.flush)
+        self.writing.addErrback(failed)
+        self.writing.addCallback(done)
+        return self.writing
+
+    def resume(self):
+        """Starts writing rows to the database, including the rows that were
+        buffered while the buffer was paused."""
+        self.paused = False
+        if len(self.rows) >= self.batchSize:
+            self.flush()
+        elif self.rows and self.pending is None:
+            self.pending = self.clock.callLater(self.interval, self.flush)
+
+    def close(self):
+        """Writes all buffered rows right away, blocking until they have been
+        written. Meant to be called when the bot is shutting down, for
+        example from a :class:`~bones.event.BotShutdownEvent` handler.
+        """
+        self.writeNow()
+
+    def writeNow(self):
+        if self.pending is not None:
+            if self.pending.active():
+                self.pending.cancel()
+            self.pending = None
+        rows, self.rows = self.rows, []
+        if rows:
+            try:
+                self.write(rows)
+            except Exception as e:
+                self.dropped += len(rows)
+                self.log.error("Unable to write %i rows: %s", len(rows), e)
+
+
+def getConfig(settings):
+    """Returns the :code:`[storage]` section of a
+    :class:`~bones.config.ServerConfiguration`, with defaults filled in for
+    the options that aren't set.
+    """
+    config = {}
+    if "storage" in settings.data:
+        config = settings.data["storage"]
+    if "sqlalchemy.url" not in config:
+        config["sqlalchemy.url"] = "sqlite:///bones.db"
+    if "sqlalchemy.encoding" not in config:
+        config["sqlalchemy.encoding"] = "utf-8"
+    if "sqlalchemy.convert_unicode" not in config:
+        config["sqlalchemy.convert_unicode"] = "true"
+    return config
+
+
+def createEngine(config):
+    """Creates an engine from the :code:`sqlalchemy.` options in a
+    configuration section like the one returned by :func:`getConfig`.
+    """
+    options = {}
+    # SQLAlchemy doesn't convert this one from a string by itself.
+    if "sqlalchemy.pool_pre_ping" in config:
+        options["pool_pre_ping"] = asbool(config["sqlalchemy.pool_pre_ping"])
+    return engine_from_config(config, "sqlalchemy.", **options)
+
+
+def loadModels(names=()):
+    """Imports the Python modules with the given names, along with
+    :data:`bundledModels`, so that their tables are registered with
+    :data:`Base`. Modules that can't be imported are skipped.
+
+    :param names: The names of Python modules or of :term:`Bones modules`,
+        like :code:`bones.modules.karma.Karmabot`.
+    :type names: list
+
+    :returns: A list of :code:`(name, exception)` tuples for the modules that
+        couldn't be imported.
+    """
+    failed = []
+    for name in list(bundledModels) + list(names):
+        try:
+            __import__(name)
+        except ImportError as e:
+            # Bones modules are given as "package.module.Class".
+            if "." not in name:
+                failed.append((name, e))
+                continue
+            try:
+                __import__(name.rsplit(".", 1)[0])
+            except ImportError as e:
+                failed.append((name, e))
+    return failed
+
+
+def migrate(engine):
+    """Brings the database up to date with the tables registered with
+    :data:`Base`: missing tables are created, missing columns are added to
+    existing tables and missing indexes are created. Existing columns are
+    never changed or removed.
+
+    :param engine: The engine of the database to migrate.
+    :type engine: :class:`sqlalchemy.engine.Engine`
+
+    :returns: A list of messages describing the changes that were made.
+    """
+    changes = []
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            table.create(engine)
+            changes.append("Created table %s" % table.name)
+            continue
+        columns = set(c["name"] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            if column.primary_key or (not column.nullable and
+                                      column.server_default is None):
+                changes.append("Unable to add column %s.%s: it has to be "
+                               "added by hand" % (table.name, column.name))
+                continue
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            engine.execute("ALTER TABLE %s ADD COLUMN %s"
+                           % (preparer.format_table(table), ddl))
+            changes.append("Added column %s.%s" % (table.name, column.name))
+        indexes = set(i["name"] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+                changes.append("Created index %s on %s"
+                               % (index.name, table.name))
+    return changes
+
+
+def report(engine):
+    """Reports the size of the tables registered with :data:`Base` and of
+    their indexes. Sizes are only known for SQLite databases with the
+    :code:`dbstat` table and for PostgreSQL databases.
+
+    :param engine: The engine of the database.
+    :type engine: :class:`sqlalchemy.engine.Engine`
+
+    :returns: A list of :code:`(table, rows, size, indexes)` tuples, where
+        :code:`indexes` is a list of :code:`(index, size)` tuples. Sizes are
+        in bytes, or None if they aren't known.
+    """
+    sizes = {}
+    if engine.dialect.name == "sqlite":
+        try:
+            sizes = dict(engine.execute(
+                "SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"
+            ).fetchall())
+        except DBAPIError:
+            pass
+    existing = set(inspect(engine).get_table_names())
+    tables = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        rows = engine.execute(
+            select([func.count()]).select_from(table)).scalar()
+        names = [table.name] + sorted(index.name for index in table.indexes)
+        if engine.dialect.name == "postgresql":
+            for name in names:
+                sizes[name] = engine.execute(
+                    "SELECT pg_relation_size(%s)",
+                    engine.dialect.identifier_preparer.quote(name)).scalar()
+        tables.append((table.name, rows, sizes.get(table.name),
+                       [(name, sizes.get(name)) for name in names[1:]]))
+    return tables
@@ -1,8 +1,9 @@
 # -*- encoding: utf8 -*-
-import json
 import re
 import urllib
 
+from twisted.internet import defer
+
 import bones.event
 from bones.bot import Module
 
@@ -15,18 +16,21 @@ class NickFix(Module):
 
     @bones.event.handler(event=bones.event.UserQuitEvent)
     @bones.event.handler(event=bones.event.UserNickChangedEvent)
+    @bones.event.handler(event=bones.event.NetsplitEvent)
     def somethingHappened(self, myEvent):
-        user = None
+        users = None
         if self.nickIWant is None:
             self.nickIWant = \
                 self.settings.get("bot", "nickname").split("\n")[0]
 
         if isinstance(myEvent, bones.event.UserNickChangedEvent) is True:
-            user = myEvent.oldname
+            users = [myEvent.oldname]
+        elif isinstance(myEvent, bones.event.NetsplitEvent) is True:
+            users = [user.nickname for user in myEvent.users]
         else:
-            user = myEvent.user.nickname
+            users = [myEvent.user.nickname]
 
-        if user.lower() == self.nickIWant.lower():
+        if self.nickIWant.lower() in [user.lower() for user in users]:
             myEvent.client.factory.nicknames = \
                 self.settings.get("bot", "nickname").split("\n")[1:]
             self.isRecovering = True
@@ -72,66 +76,63 @@ class Ping(Module):
 
 
 class Twitter(Module):
-    bs = None
-    urlopener = None
-
     reTweetLink = re.compile("(https?\:\/\/)?twitter\.com\/[a-zA-Z0-9\-\_]+\/status\/\d+", re.IGNORECASE)  # NOQA
 
+    tweetFields = {
+        "tweet": "div.permalink-tweet-container p.tweet-text",
+        "user": "div.permalink-tweet-container span.username.js-action-profile-name",  # NOQA
+    }
+
     def __init__(self, *args, **kwargs):
         Module.__init__(self, *args, **kwargs)
-        try:
-            from bs4 import BeautifulSoup
-            self.bs = BeautifulSoup
-        except ImportError:
-            self.log.warn(
-                "Unmet dependency BeautifulSoup4: The URL checkers will be "
-                "disabled."
-            )
+        self.factory.previews.register(
+            ["twitter.com", "mobile.twitter.com"], self.previewTweet)
 
-    @bones.event.handler(event=bones.event.ChannelMessageEvent)
-    def eventURLInfo_Twitter(self, event):
-        if self.bs is not None:
-            if "twitter" in event.message and "http" in event.message:
-                data = self.reTweetLink.search(event.message)
-                if data:
-                    url = data.group(0)
-                    html = event.client.factory.urlopener.open(url).read()
-                    soup = self.bs(html)
-                    tweet = soup \
-                        .find("div", {"class": "permalink-inner permalink-tweet-container"}) \
-                        .find("p", {"class": "tweet-text"}) \
-                        .text
-                    tweet = u"↵ ".join(tweet.split("\n"))
-                    user = soup \
-                        .find("div", {"class": "permalink-inner permalink-tweet-container"}) \
-                        .find("span", {"class": "username js-action-profile-name"}) \
-                        .text
-
-                    # shitty fix for pic.twitter.com links
-                    # could be improved by going through all links, check
-                    # whether they start with http and if not replace the
-                    # nodeText with the href attribute.
-                    out = []
-                    for word in tweet.split(" "):
-                        if word.startswith("pic.twitter.com"):
-                            word = "https://%s" % word
-                        out.append(word)
-                    tweet = " ".join(out)
-
-                    msg = (u"\x0310Twitter\x03 \x0311::\x03 %s \x0311––\x03 %s"
-                           % (tweet, user))
-                    event.channel.msg(msg.encode("utf-8"))
+    def previewTweet(self, event, url):
+        data = self.reTweetLink.search(url)
+        if not data:
+            return
+        url = data.group(0)
+        if not url.startswith("http"):
+            url = "https://%s" % url
+        d = self.factory.http.extract(url, self.tweetFields)
+        d.addCallback(self.formatTweet)
+        return d
+
+    def formatTweet(self, fields):
+        if not fields["tweet"] or not fields["user"]:
+            raise ValueError("Unable to find the tweet in the page")
+        tweet = fields["tweet"].text
+        tweet = u"↵ ".join(tweet.split("\n"))
+        user = fields["user"].text
+
+        # shitty fix for pic.twitter.com links
+        # could be improved by going through all links, check
+        # whether they start with http and if not replace the
+        # nodeText with the href attribute.
+        out = []
+        for word in tweet.split(" "):
+            if word.startswith("pic.twitter.com"):
+                word = "https://%s" % word
+            out.append(word)
+        tweet = " ".join(out)
+
+        msg = (u"\x0310Twitter\x03 \x0311::\x03 %s \x0311––\x03 %s"
+               % (tweet, user))
+        return msg.encode("utf-8")
 
 
 class YouTube(Module):
-    bs = None
-    __fetchData = lambda x: {"template": "html", "title": "Something went wrong"}
+    __fetchData = lambda x: defer.succeed({"template": "html", "title": "Something went wrong"})
 
     reVideoLink = re.compile("(https?\:\/\/)?(m\.|www\.)?(youtube\.com\/watch\?(.+)?v\=|youtu\.be\/)(?P<id>[a-zA-Z-0-9\_\-]*)")  # NOQA
     __template_simple = u"\x0314You\x035Tube \x0314::\x03 {title} \x034::\x03 http://youtu.be/{id}"  # NOQA
     __template_api = u"\x0314You\x035Tube \x034::\x03 {title}\x0314, {snippet[channelTitle]} \x034::\x0314 {duration} {definition} \x034::\x03 http://youtu.be/{id}"  # NOQA
 
     apiEndpoint = "https://www.googleapis.com/youtube/v3/%s?%s"
+    # The OpenGraph title is in the document head, so the download is
+    # aborted as soon as the head has been read.
+    pageFields = {"title": "meta[property=og:title]"}
 
     def __init__(self, *args, **kwargs):
         Module.__init__(self, *args, **kwargs)
@@ -148,28 +149,24 @@ class YouTube(Module):
             self.fetchData = self.fetchData_Html
         else:
             self.fetchData = self.fetchData_YouTubeApi
-
-        if not self.apikey:
-            try:
-                from bs4 import BeautifulSoup
-                self.bs = BeautifulSoup
-            except ImportError:
-                self.log.warn(
-                    "Unmet dependency BeautifulSoup4: The URL checkers will "
-                    "be disabled."
-                )
+        self.factory.previews.register(
+            ["youtube.com", "m.youtube.com", "youtu.be"], self.previewVideo)
 
     def api_request(self, method, **args):
         args["key"] = self.apikey
         url = self.apiEndpoint % (method, urllib.urlencode(args))
-        result = self.factory.urlopener.open(url).read()
-        return json.loads(result)
+        return self.factory.http.getJSON(url)
 
     def fetchData_Html(self, video):
         url = "http://youtube.com/watch?%s" % urllib.urlencode({"v": video})
-        html = self.factory.urlopener.open(url).read()
-        soup = self.bs(html)
-        title = soup.find("span", {"id": "eow-title"}).text.strip()
+        d = self.factory.http.extract(url, self.pageFields)
+        d.addCallback(self.parseVideoPage, video)
+        return d
+
+    def parseVideoPage(self, fields, video):
+        if not fields["title"]:
+            return
+        title = fields["title"].attrs.get("content", u"").strip()
         return {
             "template": "html",
             "id": video,
@@ -182,25 +179,31 @@ class YouTube(Module):
                                 id=video)
 
     def api_videoSearch(self, term):
-        data = self.api_request("search", part="id", safeSearch="none",
-                                order="relevance", type="video",
-                                maxResults="1", q=term)
-        if not data or "items" not in data or len(data["items"]) < 1:
-            return None
-        return self.fetchData_YouTubeApi(data["items"][0]["id"]["videoId"])
+        d = self.api_request("search", part="id", safeSearch="none",
+                             order="relevance", type="video",
+                             maxResults="1", q=term)
+
+        def gotResults(data):
+            if not data or "items" not in data or len(data["items"]) < 1:
+                return None
+            return self.fetchData_YouTubeApi(data["items"][0]["id"]["videoId"])
+        return d.addCallback(gotResults)
 
     def fetchData_YouTubeApi(self, video):
-        data = self.api_videoDetails(video)
-        if not data["items"]:
+        def gotDetails(data):
+            if not data["items"]:
+                return
+            output = data["items"][0]
+            output.update(output["snippet"])
+            output["duration"] = output["contentDetails"]["duration"].lower()[2:]
+            output["definition"] = output["contentDetails"]["definition"].upper()
+            output["template"] = "api"
+            return output
+        return self.api_videoDetails(video).addCallback(gotDetails)
+
+    def formatVideo(self, data):
+        if not data:
             return
-        output = data["items"][0]
-        output.update(output["snippet"])
-        output["duration"] = output["contentDetails"]["duration"].lower()[2:]
-        output["definition"] = output["contentDetails"]["definition"].upper()
-        output["template"] = "api"
-        return output
-
-    def sendToChannel(self, channel, data):
         if data["template"] == "api":
             output = self.template_api
         else:
@@ -208,23 +211,13 @@ class YouTube(Module):
 
         output = output.format(**data)
         output = u"↵ ".join(output.split("\n"))
-        channel.msg(output.encode("utf-8"))
-
-    @bones.event.handler(event=bones.event.ChannelMessageEvent)
-    def checkMessageForUrl(self, event):
-        if not self.bs and not self.apikey:
-            return
-        if not ("youtu" in event.message and "http" in event.message):
-            return
+        return output.encode("utf-8")
 
-        data = self.reVideoLink.search(event.message)
-        if not data:
+    def previewVideo(self, event, url):
+        data = self.reVideoLink.search(url)
+        if not data or not data.group("id"):
             return
-
-        video_data = self.fetchData(data.group("id"))
-        if not video_data:
-            return
-        self.sendToChannel(event.channel, video_data)
+        return self.fetchData(data.group("id")).addCallback(self.formatVideo)
 
     @bones.event.handler(trigger="yt")
     @bones.event.handler(trigger="youtube")
@@ -232,7 +225,16 @@ class YouTube(Module):
         if not self.apikey:
             return
         term = " ".join(event.args)
-        video = self.api_videoSearch(term)
-        if not video:
-            event.reply("No such results.")
-        self.sendToChannel(event.channel, video)
+
+        def gotVideo(video):
+            if not video:
+                event.reply("No such results.")
+                return
+            event.channel.msg(self.formatVideo(video))
+
+        def failed(failure):
+            self.log.error("Unable to search YouTube for %r: %s", term,
+                           failure.getTraceback())
+        d = self.api_videoSearch(term)
+        d.addCallback(gotVideo)
+        d.addErrback(failed)
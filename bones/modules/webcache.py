@@ -0,0 +1,153 @@
+# -*- encoding: utf-8 -*-
+import json
+
+from sqlalchemy import (
+    Column,
+    Float,
+    Index,
+    Integer,
+    LargeBinary,
+    Text,
+)
+
+import bones.event
+from bones.bot import Module
+from bones.modules import storage
+from bones.web import HTTPResponse
+
+
+class HTTPCache(Module):
+    """Saves the responses cached by the factory's
+    :class:`~bones.web.HTTPClient` to the database when the bot shuts down,
+    and loads them back into the cache when the bot starts, so that the cache
+    doesn't start out cold after a restart. Requires
+    :class:`bones.modules.storage.Database`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Module.__init__(self, *args, **kwargs)
+        self.db = None
+
+    @bones.event.handler(event=storage.DatabaseInitializedEvent)
+    def gotDB(self, event):
+        self.db = event.module
+        now = self.factory.http.reactor.seconds()
+        d = self.db.run(self.loadEntries, now)
+        d.addCallback(self.restoreEntries)
+        d.addErrback(lambda failure: self.log.error(
+            "Unable to load cached HTTP responses: %s",
+            failure.getErrorMessage()))
+
+    @bones.event.handler(event=bones.event.BotShutdownEvent)
+    def shutdown(self, event):
+        if not self.db:
+            return
+        try:
+            self.saveEntries(self.factory.http.cache.items())
+        except Exception as e:
+            self.log.error("Unable to save cached HTTP responses: %s", e)
+
+    def loadEntries(self, now):
+        session = self.db.new_session()
+        try:
+            return (
+                session.query(CachedResponse)
+                .filter(CachedResponse.server == self.factory.tag)
+                .filter(CachedResponse.expires > now)
+                .order_by(CachedResponse.id)
+                .all()
+            )
+        finally:
+            session.close()
+
+    def restoreEntries(self, entries):
+        cache = self.factory.http.cache
+        restored = 0
+        for entry in entries:
+            key = entry.url.encode("utf-8")
+            if key in cache:
+                continue
+            headers = dict((name.encode("utf-8"), value.encode("utf-8"))
+                           for name, value
+                           in json.loads(entry.headers).iteritems())
+            response = HTTPResponse(entry.finalUrl.encode("utf-8"),
+                                    entry.code, headers, entry.body)
+            cache.set(key, response, expires=entry.expires)
+            restored += 1
+        self.log.debug("Restored %i cached HTTP responses", restored)
+
+    def saveEntries(self, items):
+        saved = 0
+        session = self.db.new_session()
+        try:
+            with session.begin():
+                session.query(CachedResponse) \
+                    .filter(CachedResponse.server == self.factory.tag) \
+                    .delete(synchronize_session=False)
+                for key, response, expires in items:
+                    # Only whole responses are saved, not the results of
+                    # HTTPClient.extract.
+                    if expires is None or not isinstance(key, str) \
+                            or not isinstance(response, HTTPResponse):
+                        continue
+                    try:
+                        headers = json.dumps(response.headers)
+                    except UnicodeDecodeError:
+                        continue
+                    session.add(CachedResponse(self.factory.tag, key,
+                                               response, headers, expires))
+                    saved += 1
+        finally:
+            session.close()
+        self.log.debug("Saved %i of %i cached HTTP responses", saved,
+                       len(items))
+
+
+class CachedResponse(storage.Base):
+    __tablename__ = "bones_http_cache"
+    __table_args__ = (
+        Index("ix_bones_http_cache_server_expires", "server", "expires"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    server = Column(Text)
+    url = Column(Text)
+    finalUrl = Column(Text)
+    code = Column(Integer)
+    headers = Column(Text)
+    body = Column(LargeBinary)
+    expires = Column(Float)
+
+    def __init__(self, server, url, response, headers, expires):
+        self.server = server
+        self.url = url
+        self.finalUrl = response.url
+        self.code = response.code
+        self.headers = headers
+        self.body = response.body
+        self.expires = expires
+
+
+if __name__ == "__main__":
+    from ConfigParser import SafeConfigParser
+    from sqlalchemy import engine_from_config
+    import sys
+    settings = SafeConfigParser()
+    if len(sys.argv) < 2:
+        print "Error: You need to provide a config file!"
+        sys.exit(1)
+    settings.read(sys.argv[1])
+    if "storage" not in settings._sections:
+        print "Error: Config file does not contain a 'storage' section."
+        sys.exit(1)
+    elif "sqlalchemy.url" not in settings._sections["storage"]:
+        print ("Error: Section 'storage' does not contain an 'sqlalchemy.url' "
+               "key.")
+        sys.exit(1)
+    print ("Connecting to '%s'..."
+           % settings._sections["storage"]["sqlalchemy.url"])
+    engine = engine_from_config(settings._sections["storage"], "sqlalchemy.")
+    print "Creating table '%s'..." % CachedResponse.__tablename__
+    from bones.modules.storage import Base
+    Base.metadata.create_all(engine)
+    print "Have a nice day!"
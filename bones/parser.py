@@ -0,0 +1,184 @@
+# -*- encoding: utf8 -*-
+import calendar
+import time
+
+from twisted.words.protocols import irc
+
+# Escapes used in IRCv3 message tag values.
+_tagEscapes = {
+    ":": ";",
+    "s": " ",
+    "\\": "\\",
+    "r": "\r",
+    "n": "\n",
+}
+
+
+def splitPrefix(prefix):
+    """Splits a message prefix like :code:`nick!user@host` into its parts.
+
+    :param prefix: The prefix to split.
+    :type prefix: str.
+
+    :returns: A :code:`(nickname, username, hostname)` tuple. The username
+        and hostname are None if they aren't in the prefix.
+    """
+    bang = prefix.find("!")
+    if bang == -1:
+        at = prefix.find("@")
+        if at == -1:
+            return prefix, None, None
+        return prefix[:at], None, prefix[at + 1:]
+    at = prefix.find("@", bang)
+    if at == -1:
+        return prefix[:bang], prefix[bang + 1:], None
+    return prefix[:bang], prefix[bang + 1:at], prefix[at + 1:]
+
+
+def unescapeTag(value):
+    if "\\" not in value:
+        return value
+    out = []
+    i = 0
+    length = len(value)
+    while i < length:
+        char = value[i]
+        if char == "\\":
+            i += 1
+            if i < length:
+                out.append(_tagEscapes.get(value[i], value[i]))
+        else:
+            out.append(char)
+        i += 1
+    return "".join(out)
+
+
+class Message(object):
+    """A line received from an IRC server.
+
+    Only the command is split off the line when the message is created,
+    which is all that's needed to find the handler of the message. The tags,
+    the parts of the prefix and the parameters are parsed the first time
+    they're used, and only once.
+
+    :param line: The line, without the line ending.
+    :type line: str.
+
+    :raises: :class:`twisted.words.protocols.irc.IRCBadMessage` if the line
+        has no command.
+
+    .. attribute:: line
+
+        The line the message was parsed from.
+
+    .. attribute:: command
+
+        The command of the message, like :code:`PRIVMSG` or :code:`001`.
+
+    .. attribute:: prefix
+
+        The prefix of the message, usually a hostmask like
+        :code:`nick!user@host` or a server name, or an empty string if the
+        message has no prefix.
+    """
+    __slots__ = ("line", "command", "prefix", "_rawTags", "_rest", "_tags",
+                 "_parts", "_params")
+
+    def __init__(self, line):
+        self.line = line
+        self._tags = self._parts = self._params = None
+        # IRCv3 message tags, "@key=value;key2 :nick!user@host COMMAND"
+        if line[:1] == "@":
+            self._rawTags, _, line = line[1:].partition(" ")
+            line = line.lstrip(" ")
+        else:
+            self._rawTags = None
+        if line[:1] == ":":
+            parts = line[1:].split(" ", 2)
+            self.prefix = parts[0]
+            del parts[0]
+        else:
+            self.prefix = ""
+            parts = line.split(" ", 1)
+        self.command = parts[0] if parts else ""
+        self._rest = parts[1] if len(parts) > 1 else ""
+        if not self.command:
+            # Extra spaces between the parts; parse it the slow way.
+            line = line.lstrip(" ")
+            if line[:1] == ":":
+                self.prefix, _, line = line[1:].partition(" ")
+            self.command, _, self._rest = line.lstrip(" ").partition(" ")
+            if not self.command:
+                raise irc.IRCBadMessage("No command in %r" % self.line)
+
+    def __repr__(self):
+        return "<Message %r>" % self.line
+
+    @property
+    def tags(self):
+        """A dictionary of the IRCv3 message tags of the message. Tags
+        without a value are set to True."""
+        if self._tags is None:
+            tags = {}
+            if self._rawTags:
+                for tag in self._rawTags.split(";"):
+                    if not tag:
+                        continue
+                    key, sep, value = tag.partition("=")
+                    tags[key] = unescapeTag(value) if sep else True
+            self._tags = tags
+        return self._tags
+
+    @property
+    def time(self):
+        """The time the message was sent at according to the
+        :code:`server-time` tag, as a Unix timestamp, or None if the message
+        has no such tag."""
+        value = self.tags.get("time")
+        if not value or value is True:
+            return None
+        value, _, fraction = value.rstrip("Z").partition(".")
+        try:
+            stamp = calendar.timegm(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+            if fraction:
+                stamp += float("0." + fraction)
+        except ValueError:
+            return None
+        return stamp
+
+    @property
+    def nick(self):
+        """The nickname in the prefix."""
+        if self._parts is None:
+            self._parts = splitPrefix(self.prefix)
+        return self._parts[0]
+
+    @property
+    def user(self):
+        """The username in the prefix, or None."""
+        if self._parts is None:
+            self._parts = splitPrefix(self.prefix)
+        return self._parts[1]
+
+    @property
+    def host(self):
+        """The hostname in the prefix, or None."""
+        if self._parts is None:
+            self._parts = splitPrefix(self.prefix)
+        return self._parts[2]
+
+    @property
+    def params(self):
+        """The parameters of the message as a list, with the trailing
+        parameter last."""
+        if self._params is None:
+            rest = self._rest
+            if rest[:1] == ":":
+                params = [rest[1:]]
+            else:
+                rest, trailing, last = rest.partition(" :")
+                params = rest.split()
+                if trailing:
+                    params.append(last)
+            self._params = params
+        return self._params
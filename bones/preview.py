@@ -0,0 +1,136 @@
+# -*- encoding: utf8 -*-
+import re
+
+from twisted.internet import defer
+
+import bones.event
+import bones.log
+from bones.web import canonicalizeURL
+
+log = bones.log.getLogger(__name__)
+
+# Matches anything that looks like a link, with or without a scheme. The
+# host name is looked up in the extractor table, so false positives like
+# "foo.bar" only cost a dictionary lookup.
+_reURL = re.compile(
+    r"(?:(https?)://)?((?:[a-z0-9-]+\.)+[a-z]{2,})(:\d+)?(/[^\s<>\"]*)?",
+    re.IGNORECASE
+)
+_trailingPunctuation = ".,;:!?)]}'\""
+
+
+class URLPreviewEngine(object):
+    """Looks for links in channel messages and sends previews of them to the
+    channel, available as :attr:`bones.bot.BonesBotFactory.previews`.
+
+    Every channel message is scanned for links once, and each link is handed
+    to the extractor registered for its host name. A link is only previewed
+    once per message, at most :attr:`maxPerMessage` links are previewed per
+    message and at most :attr:`maxPerChannel` previews are fetched at the
+    same time for each channel.
+
+    :param maxPerMessage: The maximum number of links previewed per message.
+    :type maxPerMessage: int
+    :param maxPerChannel: The maximum number of previews fetched concurrently
+        for a single channel. Additional previews are queued.
+    :type maxPerChannel: int
+    """
+
+    def __init__(self, maxPerMessage=3, maxPerChannel=2):
+        self.maxPerMessage = maxPerMessage
+        self.maxPerChannel = maxPerChannel
+        self.extractors = {}
+        self.channelLimits = {}
+
+    def register(self, hosts, extractor):
+        """Registers an extractor for links to the given hosts.
+
+        The extractor is called with the
+        :class:`~bones.event.ChannelMessageEvent` and the link, always
+        including a scheme. It should return a
+        :class:`~twisted.internet.defer.Deferred` firing with the preview
+        message to send to the channel, or None if the link isn't one the
+        extractor can preview.
+
+        :param hosts: The host names to handle links to. A leading
+            :code:`www.` is ignored when looking up hosts.
+        :type hosts: list
+        :param extractor: The extractor to call.
+        :type extractor: callable
+        """
+        for host in hosts:
+            self.extractors[host.lower()] = extractor
+
+    def unregister(self, owner):
+        """Removes all extractors that are methods of the given object, for
+        example a :term:`Bones module` that is being unloaded.
+        """
+        for host, extractor in self.extractors.items():
+            if getattr(extractor, "im_self", extractor) is owner:
+                del self.extractors[host]
+
+    def findLinks(self, message):
+        """Finds the links in a message that there are extractors for.
+
+        :param message: The message to scan.
+        :type message: str.
+
+        :returns: A list of :code:`(link, extractor)` tuples, without
+            duplicate links.
+        """
+        found = []
+        seen = set()
+        for match in _reURL.finditer(message):
+            host = match.group(2).lower()
+            extractor = self.extractors.get(host)
+            if extractor is None and host.startswith("www."):
+                extractor = self.extractors.get(host[4:])
+            if extractor is None:
+                continue
+            url = match.group(0).rstrip(_trailingPunctuation)
+            if not match.group(1):
+                url = "https://%s" % url
+            key = canonicalizeURL(url)
+            if key in seen:
+                continue
+            seen.add(key)
+            found.append((url, extractor))
+            if len(found) >= self.maxPerMessage:
+                break
+        return found
+
+    @bones.event.handler(event=bones.event.ChannelMessageEvent)
+    def checkMessage(self, event):
+        if not self.extractors or "." not in event.message:
+            return
+        for url, extractor in self.findLinks(event.message):
+            self.preview(event, url, extractor)
+
+    def preview(self, event, url, extractor):
+        channel = event.channel.name.lower()
+        limit = self.channelLimits.get(channel)
+        if limit is None:
+            limit = self.channelLimits[channel] = \
+                defer.DeferredSemaphore(self.maxPerChannel)
+
+        def send(message):
+            if message:
+                event.channel.msg(message)
+
+        def failed(failure):
+            log.error("Unable to preview %s: %s", url,
+                      failure.getErrorMessage())
+
+        def release(result):
+            limit.release()
+            if limit.tokens == limit.limit and not limit.waiting:
+                self.channelLimits.pop(channel, None)
+            return result
+
+        def start(_):
+            d = defer.maybeDeferred(extractor, event, url)
+            d.addCallback(send)
+            d.addErrback(failed)
+            d.addBoth(release)
+            return d
+        return limit.acquire().addCallback(start)
@@ -0,0 +1,262 @@
+# -*- encoding: utf8 -*-
+from collections import OrderedDict, deque
+
+from twisted.internet import reactor
+
+import bones.log
+
+log = bones.log.getLogger(__name__)
+
+# Line priorities, lower is sent first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_CHAT = 2
+
+# Commands that keep the connection alive or registered with the server.
+_highPriorityCommands = frozenset([
+    "PONG", "PING", "QUIT", "PASS", "NICK", "USER", "CAP", "AUTHENTICATE",
+])
+_chatCommands = frozenset(["PRIVMSG", "NOTICE"])
+_services = frozenset([
+    "nickserv", "chanserv", "hostserv", "memoserv", "operserv", "botserv",
+])
+
+
+def classify(line):
+    """Determines the priority and the queue target of an outgoing protocol
+    line.
+
+    :param line: The protocol line that is going to be sent.
+    :type line: str.
+
+    :returns: A tuple of the priority and the target name. Messages are
+        queued per message target, while all other lines share the target
+        :code:`""`.
+    """
+    command, _, rest = line.partition(" ")
+    command = command.upper()
+    if command in _highPriorityCommands:
+        return PRIORITY_HIGH, ""
+    if command in _chatCommands:
+        target = rest.partition(" ")[0].lower()
+        if target in _services:
+            return PRIORITY_NORMAL, target
+        return PRIORITY_CHAT, target
+    return PRIORITY_NORMAL, ""
+
+
+class SendQueue(object):
+    """Outbound flood control for a server connection.
+
+    Lines are rate limited by two token buckets, one counting lines and one
+    counting bytes. As long as there are tokens left, lines are sent right
+    away; when the buckets run dry, lines are queued and sent as the buckets
+    fill up again. Queued lines are sent by priority, so that for example
+    :code:`PONG` replies and messages to services are not held up by a long
+    reply to a channel, and messages to different targets are sent round-robin
+    so that one busy channel won't starve the others.
+
+    A line that is identical to a line that is already queued is dropped. When
+    the queue holds :attr:`maxLines` lines, room is made for a new line by
+    dropping the oldest line of the target with the most queued lines in the
+    lowest priority below the new line's. If no line of a lower priority is
+    queued, the new line is dropped instead, so that a flood of chat can never
+    push out for example a :code:`PONG`.
+
+    :param send: Callable that sends a single line to the server.
+    :type send: callable
+    :param linesPerSecond: The number of lines that may be sent per second.
+        Flood control is disabled if this is 0.
+    :type linesPerSecond: float
+    :param bytesPerSecond: The number of bytes that may be sent per second.
+    :type bytesPerSecond: float
+    :param burst: The number of lines that may be sent in a burst before the
+        rate limit kicks in.
+    :type burst: int
+    :param maxLines: The maximum number of lines kept in the queue.
+    :type maxLines: int
+    """
+
+    def __init__(self, send, linesPerSecond=2.0, bytesPerSecond=1024.0,
+                 burst=5, maxLines=1000, clock=reactor):
+        self.send = send
+        self.clock = clock
+        self.lineRate = float(linesPerSecond)
+        self.byteRate = float(bytesPerSecond)
+        self.lineCapacity = float(max(burst, 1))
+        self.byteCapacity = max(self.lineCapacity * 512, self.byteRate)
+        self.maxLines = maxLines
+
+        self.lineTokens = self.lineCapacity
+        self.byteTokens = self.byteCapacity
+        self.lastRefill = clock.seconds()
+
+        self.queues = [OrderedDict() for p in range(PRIORITY_CHAT + 1)]
+        self.queued = set()
+        self.size = 0
+        self.pending = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+        self.waited = 0
+
+    def put(self, line):
+        """Sends the line if the rate limit allows it, queues it otherwise.
+
+        :param line: The protocol line to be sent, without line endings.
+        :type line: str.
+        """
+        if self.lineRate <= 0:
+            self._send(line)
+            return
+        if not self.size:
+            self._refill()
+            if self._canSend(line):
+                self._take(line)
+                self._send(line)
+                return
+        if line in self.queued:
+            self.coalesced += 1
+            return
+
+        priority, target = classify(line)
+        if self.size >= self.maxLines and not self._evict(priority):
+            self.dropped += 1
+            log.warning("Send queue full, dropped line (%i dropped so far)",
+                        self.dropped)
+            return
+        queue = self.queues[priority].get(target)
+        if queue is None:
+            queue = self.queues[priority][target] = deque()
+        queue.append((line, self.clock.seconds()))
+        self.queued.add(line)
+        self.size += 1
+        self._schedule()
+
+    def clear(self):
+        """Drops all queued lines, for example when the connection has been
+        lost."""
+        if self.pending is not None and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
+        self.dropped += self.size
+        for queues in self.queues:
+            queues.clear()
+        self.queued.clear()
+        self.size = 0
+
+    def stats(self):
+        """Returns a dictionary with the current queue depth and counters that
+        may be used to tune the flood control settings.
+
+        :returns: A dictionary with the keys :code:`queued` (the number of
+            lines in the queue), :code:`targets` (the number of lines queued
+            per target), :code:`sent`, :code:`dropped`, :code:`coalesced`,
+            :code:`averageWait` and :code:`maxWait` (in seconds, for lines
+            that had to be queued).
+        """
+        targets = {}
+        for queues in self.queues:
+            for target, queue in queues.iteritems():
+                targets[target] = targets.get(target, 0) + len(queue)
+        return {
+            "queued": self.size,
+            "targets": targets,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "averageWait": self.waitTotal / self.waited if self.waited else 0.0,
+            "maxWait": self.waitMax,
+        }
+
+    def _send(self, line):
+        self.sent += 1
+        self.send(line)
+
+    def _refill(self):
+        now = self.clock.seconds()
+        elapsed = now - self.lastRefill
+        self.lastRefill = now
+        self.lineTokens = min(self.lineCapacity,
+                              self.lineTokens + elapsed * self.lineRate)
+        if self.byteRate > 0:
+            self.byteTokens = min(self.byteCapacity,
+                                  self.byteTokens + elapsed * self.byteRate)
+
+    def _canSend(self, line):
+        if self.lineTokens < 1:
+            return False
+        # Lines longer than the byte bucket are let through once it is full.
+        cost = min(len(line) + 2, self.byteCapacity)
+        return self.byteRate <= 0 or self.byteTokens >= cost
+
+    def _take(self, line):
+        self.lineTokens -= 1
+        self.byteTokens -= min(len(line) + 2, self.byteCapacity)
+
+    def _wait(self, line):
+        wait = (1 - self.lineTokens) / self.lineRate
+        if self.byteRate > 0:
+            cost = min(len(line) + 2, self.byteCapacity)
+            wait = max(wait, (cost - self.byteTokens) / self.byteRate)
+        return max(wait, 0.0)
+
+    def _peek(self):
+        for queues in self.queues:
+            for target, queue in queues.iteritems():
+                return queues, target, queue
+        return None, None, None
+
+    def _evict(self, priority):
+        for lowest in range(PRIORITY_CHAT, priority, -1):
+            queues = self.queues[lowest]
+            if queues:
+                target = max(queues, key=lambda t: len(queues[t]))
+                queue = queues[target]
+                line, queuedAt = queue.popleft()
+                if not queue:
+                    del queues[target]
+                self.queued.discard(line)
+                self.size -= 1
+                self.dropped += 1
+                log.warning("Send queue full, dropped queued line to %s (%i "
+                            "dropped so far)", target or "server",
+                            self.dropped)
+                return True
+        return False
+
+    def _schedule(self, delay=None):
+        if self.pending is not None and self.pending.active():
+            return
+        if delay is None:
+            queues, target, queue = self._peek()
+            self._refill()
+            delay = self._wait(queue[0][0])
+        self.pending = self.clock.callLater(delay, self._pump)
+
+    def _pump(self):
+        self.pending = None
+        self._refill()
+        while self.size:
+            queues, target, queue = self._peek()
+            line, queuedAt = queue[0]
+            if not self._canSend(line):
+                self._schedule(self._wait(line))
+                return
+            queue.popleft()
+            # Move the target to the back of the line so that the other
+            # targets with the same priority get their turn.
+            del queues[target]
+            if queue:
+                queues[target] = queue
+            self.queued.discard(line)
+            self.size -= 1
+            waited = self.clock.seconds() - queuedAt
+            self.waitTotal += waited
+            self.waitMax = max(self.waitMax, waited)
+            self.waited += 1
+            self._take(line)
+            self._send(line)
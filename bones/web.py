@@ -0,0 +1,430 @@
+# -*- encoding: utf8 -*-
+import codecs
+import json
+import re
+import urllib
+import urlparse
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python.failure import Failure
+from twisted.web.client import (
+    Agent,
+    BrowserLikeRedirectAgent,
+    ContentDecoderAgent,
+    GzipDecoder,
+    HTTPConnectionPool,
+    ResponseDone,
+)
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+import bones.log
+from bones.cache import LRUCache
+from bones.extract import StreamingExtractor
+
+log = bones.log.getLogger(__name__)
+
+_defaultPorts = {"http": 80, "https": 443}
+_reCharset = re.compile(r";\s*charset=[\"']?([^\s;\"']+)", re.IGNORECASE)
+_reMaxAge = re.compile(r"(?:^|,)\s*(s-maxage|max-age)\s*=\s*\"?(\d+)")
+
+
+def canonicalizeURL(url):
+    """Normalizes a URL so that different spellings of the same URL map to
+    the same cache entry: the scheme and host name are lowercased, default
+    ports and fragments are removed and query parameters are sorted.
+
+    :param url: The URL to normalize.
+    :type url: str.
+
+    :returns: The normalized URL.
+    """
+    parts = urlparse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").rstrip(".")
+    if parts.port and parts.port != _defaultPorts.get(scheme):
+        netloc = "%s:%i" % (netloc, parts.port)
+    if parts.username is not None:
+        netloc = "%s@%s" % (parts.netloc.rpartition("@")[0], netloc)
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(parts.query, True)))
+    return urlparse.urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+class HTTPError(Exception):
+    """Raised when a request didn't return a successful response.
+
+    .. attribute:: response
+
+        The :class:`HTTPResponse` that was returned by the server.
+    """
+    def __init__(self, response):
+        Exception.__init__(self, "HTTP %i from %s" % (response.code,
+                                                       response.url))
+        self.response = response
+
+
+class HTTPResponse(object):
+    """A response to a request made with :class:`HTTPClient`.
+
+    .. attribute:: url
+
+        The URL that was requested. If the request was redirected, this is
+        the URL of the final response.
+
+    .. attribute:: code
+
+        The HTTP status code of the response, as an integer.
+
+    .. attribute:: headers
+
+        A dictionary of the response headers, with lowercase header names.
+
+    .. attribute:: body
+
+        The response body as a string, with any gzip encoding removed.
+    """
+    def __init__(self, url, code, headers, body):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.body = body
+
+
+class _BodyReceiver(protocol.Protocol):
+    def __init__(self, finished, consume=None, maxBytes=None):
+        self.finished = finished
+        self.consume = consume
+        self.maxBytes = maxBytes
+        self.received = 0
+        self.stopped = False
+        self.data = []
+
+    def connectionMade(self):
+        if self.maxBytes == 0:
+            self.stop()
+
+    def dataReceived(self, data):
+        if self.stopped:
+            return
+        done = False
+        if self.maxBytes is not None \
+                and self.received + len(data) >= self.maxBytes:
+            data = data[:self.maxBytes - self.received]
+            done = True
+        self.received += len(data)
+        if self.consume is None:
+            self.data.append(data)
+        elif self.consume(data):
+            done = True
+        if done:
+            self.stop()
+
+    def stop(self):
+        # Abort the download, the rest of the body isn't needed.
+        self.stopped = True
+        self.transport.stopProducing()
+        if not self.finished.called:
+            self.finished.callback("".join(self.data))
+
+    def connectionLost(self, reason):
+        if self.finished.called or self.stopped:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback("".join(self.data))
+        else:
+            self.finished.errback(reason)
+
+
+class HTTPClient(object):
+    """Non-blocking HTTP client shared by all the modules of a bot factory,
+    available as :attr:`bones.bot.BonesBotFactory.http`.
+
+    Connections are kept alive and reused between requests, redirects are
+    followed and gzip encoded responses are decoded. All requests return a
+    :class:`~twisted.internet.defer.Deferred`, so handlers using this client
+    don't need to be threaded.
+
+    :param userAgent: The User-Agent header sent with all requests.
+    :type userAgent: str.
+    :param maxPerHost: The maximum number of concurrent requests to a single
+        host. Requests exceeding this are queued.
+    :type maxPerHost: int
+    :param timeout: Time in seconds before a request is aborted, including
+        the time it takes to read the response body.
+    :type timeout: float
+    :param connectTimeout: Time in seconds before a connection attempt is
+        aborted.
+    :type connectTimeout: float
+    :param cacheSize: The maximum number of responses kept in
+        :attr:`cache`. Caching is disabled if this is 0.
+    :type cacheSize: int
+    :param cacheTTL: Time in seconds successful responses are cached for if
+        the server doesn't say otherwise.
+    :type cacheTTL: float
+    :param negativeTTL: Time in seconds :code:`404` and :code:`410`
+        responses are cached for.
+    :type negativeTTL: float
+    :param maxCacheTTL: The longest time in seconds a response is cached for,
+        regardless of what the server says.
+    :type maxCacheTTL: float
+    :param maxCacheBody: Responses with a body larger than this many bytes
+        are not cached.
+    :type maxCacheBody: int
+    :param maxExtractBytes: The default number of bytes :meth:`extract`
+        downloads before giving up.
+    :type maxExtractBytes: int
+
+    .. attribute:: cache
+
+        A :class:`bones.cache.LRUCache` holding the responses to GET
+        requests, keyed on the canonicalized URL. Its counters can be
+        inspected with :meth:`bones.cache.LRUCache.stats`.
+    """
+
+    def __init__(self, userAgent, maxPerHost=4, timeout=30.0,
+                 connectTimeout=10.0, cacheSize=1000, cacheTTL=300.0,
+                 negativeTTL=60.0, maxCacheTTL=86400.0, maxCacheBody=262144,
+                 maxExtractBytes=524288, reactor=reactor):
+        self.userAgent = userAgent
+        self.maxPerHost = maxPerHost
+        self.timeout = timeout
+        self.reactor = reactor
+        self.hostLimits = {}
+        self.cache = LRUCache(cacheSize, cacheTTL, clock=reactor.seconds)
+        self.negativeTTL = negativeTTL
+        self.maxCacheTTL = maxCacheTTL
+        self.maxCacheBody = maxCacheBody
+        self.maxExtractBytes = maxExtractBytes
+
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = maxPerHost
+        agent = Agent(reactor, connectTimeout=connectTimeout, pool=self.pool)
+        self.agent = ContentDecoderAgent(BrowserLikeRedirectAgent(agent),
+                                         [("gzip", GzipDecoder)])
+
+    def request(self, url, method="GET", headers=None):
+        """Makes an HTTP request.
+
+        :param url: The URL to request.
+        :type url: str.
+        :param method: The HTTP method to use.
+        :type method: str.
+        :param headers: Additional request headers.
+        :type headers: dict
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` firing with an
+            :class:`HTTPResponse` once the whole response has been read. Any
+            status code is considered a response; only connection errors and
+            timeouts result in a failure.
+        """
+        return self._limited(url, method, headers, self._readResponse)
+
+    def _limited(self, url, method, headers, reader):
+        host = urlparse.urlsplit(url).hostname or ""
+        limit = self.hostLimits.get(host)
+        if limit is None:
+            limit = self.hostLimits[host] = \
+                defer.DeferredSemaphore(self.maxPerHost)
+        acquired = []
+
+        def start(_):
+            acquired.append(True)
+            return self._request(url, method, headers, reader)
+
+        def release(result):
+            if acquired:
+                limit.release()
+                if limit.tokens == limit.limit and not limit.waiting:
+                    self.hostLimits.pop(host, None)
+            return result
+
+        d = limit.acquire()
+        d.addCallback(start)
+        d.addBoth(release)
+        return d
+
+    def get(self, url, headers=None, cache=True):
+        """Makes a GET request. See :meth:`request`.
+
+        Unless :code:`cache` is False, the response is looked up in and
+        stored in :attr:`cache`. Successful responses are cached for as long
+        as the :code:`Cache-Control` header allows, :code:`404` and
+        :code:`410` responses for a short while, and other responses aren't
+        cached at all.
+
+        :param cache: Whether a cached response may be used. Should be False
+            for resources that change from one request to the next.
+        :type cache: bool
+        """
+        if not cache or self.cache.maxSize <= 0:
+            return self.request(url, headers=headers)
+        key = canonicalizeURL(url)
+        response = self.cache.get(key)
+        if response is not None:
+            return defer.succeed(response)
+
+        def store(response):
+            ttl = self._cacheTTL(response)
+            if ttl > 0:
+                self.cache.set(key, response, ttl)
+            return response
+        return self.request(url, headers=headers).addCallback(store)
+
+    def getJSON(self, url, headers=None, cache=True):
+        """Makes a GET request and parses the response as JSON. See
+        :meth:`get`.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` firing with the
+            decoded JSON document. Fails with :class:`HTTPError` if the server
+            didn't respond with a 2xx status code, and with
+            :class:`ValueError` if the response isn't valid JSON.
+        """
+        def parse(response):
+            if not 200 <= response.code < 300:
+                raise HTTPError(response)
+            return json.loads(response.body)
+        return self.get(url, headers, cache).addCallback(parse)
+
+    def extract(self, url, fields, maxBytes=None, headers=None, cache=True):
+        """Makes a GET request and extracts elements from the HTML document
+        while it is being downloaded, using a
+        :class:`bones.extract.StreamingExtractor`. The download is aborted as
+        soon as all the fields have been found, or when :code:`maxBytes`
+        bytes have been read, so only the start of large pages is ever
+        downloaded.
+
+        The results are cached like responses to :meth:`get` are.
+
+        :param fields: A dictionary mapping names to
+            :class:`bones.extract.Field` instances or selectors.
+        :type fields: dict
+        :param maxBytes: The maximum number of bytes to download. Defaults
+            to :code:`maxExtractBytes`.
+        :type maxBytes: int
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` firing with the
+            results of :meth:`bones.extract.StreamingExtractor.close`. Fails
+            with :class:`HTTPError` if the server didn't respond with a 2xx
+            status code.
+        """
+        if maxBytes is None:
+            maxBytes = self.maxExtractBytes
+        key = None
+        if cache and self.cache.maxSize > 0:
+            key = (canonicalizeURL(url), tuple(sorted(
+                (name, getattr(field, "selector", field),
+                 getattr(field, "many", False))
+                for name, field in fields.iteritems())))
+            cached = self.cache.get(key)
+            if isinstance(cached, HTTPResponse):
+                return defer.fail(HTTPError(cached))
+            elif cached is not None:
+                return defer.succeed(cached)
+
+        def reader(response, url):
+            return self._extractResponse(response, url, fields, maxBytes)
+
+        def extracted(result):
+            response, results = result
+            if key is not None:
+                ttl = self._cacheTTL(response)
+                if ttl > 0:
+                    self.cache.set(key, results if response.code < 300
+                                   else response, ttl)
+            if not 200 <= response.code < 300:
+                raise HTTPError(response)
+            return results
+        d = self._limited(url, "GET", headers, reader)
+        return d.addCallback(extracted)
+
+    def close(self):
+        """Closes all connections kept alive for reuse.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` firing once the
+            connections are closed.
+        """
+        return self.pool.closeCachedConnections()
+
+    def _cacheTTL(self, response):
+        if len(response.body) > self.maxCacheBody:
+            return 0
+        if response.code in (404, 410):
+            return self.negativeTTL
+        if not 200 <= response.code < 300:
+            return 0
+        cacheControl = response.headers.get("cache-control", "").lower()
+        if "no-store" in cacheControl or "no-cache" in cacheControl:
+            return 0
+        maxAge = dict(_reMaxAge.findall(cacheControl))
+        if maxAge:
+            ttl = int(maxAge.get("s-maxage", maxAge.get("max-age")))
+        else:
+            ttl = self.cache.ttl
+        return min(ttl, self.maxCacheTTL)
+
+    def _request(self, url, method, headers, reader):
+        requestHeaders = Headers({"User-Agent": [self.userAgent]})
+        for name, value in (headers or {}).iteritems():
+            requestHeaders.setRawHeaders(name, [value])
+        d = self.agent.request(method, url, requestHeaders)
+        d.addCallback(reader, url)
+        timedOut = []
+
+        def timeoutRequest():
+            timedOut.append(True)
+            d.cancel()
+        timeout = self.reactor.callLater(self.timeout, timeoutRequest)
+
+        def finished(result):
+            if timeout.active():
+                timeout.cancel()
+            elif timedOut and isinstance(result, Failure):
+                raise error.TimeoutError(string="Request to %s timed out" % url)
+            return result
+        d.addBoth(finished)
+        return d
+
+    def _responseInfo(self, response, url):
+        if response.request is not None:
+            url = response.request.absoluteURI
+        headers = {}
+        for name, values in response.headers.getAllRawHeaders():
+            headers[name.lower()] = values[-1]
+        return url, headers
+
+    def _deliverBody(self, response, consume=None, maxBytes=None):
+        receiver = []
+        d = defer.Deferred(lambda d: receiver[0].transport.stopProducing())
+        receiver.append(_BodyReceiver(d, consume, maxBytes))
+        response.deliverBody(receiver[0])
+        return d
+
+    def _readResponse(self, response, url):
+        url, headers = self._responseInfo(response, url)
+        d = self._deliverBody(response)
+        d.addCallback(lambda body: HTTPResponse(url, response.code, headers,
+                                                body))
+        return d
+
+    def _extractResponse(self, response, url, fields, maxBytes):
+        url, headers = self._responseInfo(response, url)
+        info = HTTPResponse(url, response.code, headers, "")
+        if not 200 <= response.code < 300:
+            maxBytes = 0
+        charset = _reCharset.search(headers.get("content-type", ""))
+        try:
+            decoder = codecs.getincrementaldecoder(
+                charset.group(1) if charset else "utf-8")("replace")
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        extractor = StreamingExtractor(fields)
+
+        def consume(data):
+            extractor.feed(decoder.decode(data))
+            return extractor.done
+
+        def finished(_):
+            extractor.feed(decoder.decode("", True))
+            return info, extractor.close()
+        return self._deliverBody(response, consume, maxBytes) \
+            .addCallback(finished)
@@ -17,20 +17,15 @@ bot development using modules able to handle e.g. triggers and such.""",
     extras_require={
         'all': [
             'SQLAlchemy>=1.0.5',
-            'beautifulsoup4>=4.3.2',
             'pyOpenSSL>=0.15.1',
         ],
         'modules': [
             'SQLAlchemy>=1.0.5',
-            'beautifulsoup4>=4.3.2',
         ],
 
         'db': ['SQLAlchemy>=1.0.5'],
         'ssl': ['pyOpenSSL>=0.15.1'],
 
-        'qdb': ['beautifulsoup4>=4.3.2'],
-        'youtube': ['beautifulsoup4>=4.3.2'],
-        'twitter': ['beautifulsoup4>=4.3.2'],
         'lastfm': ['SQLAlchemy>=1.0.5'],
         'factoid': ['SQLAlchemy>=1.0.5'],
         'quotes': ['SQLAlchemy>=1.0.5'],
@@ -0,0 +1,4 @@
+import logging
+
+# Modules log errors that some tests provoke on purpose.
+logging.getLogger("bones").addHandler(logging.NullHandler())
@@ -0,0 +1,552 @@
+# -*- encoding: utf8 -*-
+import os
+import tempfile
+
+from twisted.internet import error, task, threads
+from twisted.python import failure, threadable
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+import bones.event
+from bones.bot import BonesBot, BonesBotFactory, Module
+from bones.config import BaseConfiguration
+
+
+def makeSettings(testCase, text):
+    """Writes the configuration to a temporary file and returns the
+    settings of its :code:`test` server."""
+    fd, path = tempfile.mkstemp(suffix=".ini")
+    os.write(fd, text)
+    os.close(fd)
+    testCase.addCleanup(os.remove, path)
+    return BaseConfiguration(path).server("test")
+
+
+def makeBot(testCase, capabilities=""):
+    """Returns a bot connected to a :class:`StringTransport` without flood
+    control, and the transport, with the lines sent while registering
+    cleared."""
+    settings = makeSettings(testCase, "\n".join([
+        "[bot]",
+        "nickname = bones",
+        "username = bones",
+        "capabilities = %s" % capabilities,
+        "sendqueue.linesPerSecond = 0",
+        "[server.test]",
+        "host = irc.example.net",
+    ]))
+    bot = BonesBot()
+    bot.factory = BonesBotFactory(settings)
+    transport = StringTransport()
+    bot.makeConnection(transport)
+    transport.clear()
+    return bot, transport
+
+
+def receive(bot, *lines):
+    for line in lines:
+        bot.lineReceived(line)
+
+
+class TriggerRecorder(Module):
+    """Remembers the trigger events it receives."""
+
+    def __init__(self, *args, **kwargs):
+        Module.__init__(self, *args, **kwargs)
+        self.events = []
+
+    @bones.event.handler(trigger="qdb")
+    def cmdQdb(self, event):
+        self.events.append(event)
+
+
+class TriggerTests(unittest.TestCase):
+
+    def setUp(self):
+        settings = makeSettings(self, "\n".join([
+            "[bot]",
+            "nickname = bones",
+            "username = bones",
+            "triggerPrefixes = +!",
+            "[server.test]",
+            "host = irc.example.net",
+        ]))
+        self.factory = BonesBotFactory(settings)
+        self.factory.loadModule("tests.test_bot.TriggerRecorder")
+        self.addCleanup(self.factory.unloadModule,
+                        "tests.test_bot.TriggerRecorder")
+        self.recorder = self.factory.modules[-1]
+        self.bot = BonesBot()
+        self.bot.factory = self.factory
+        self.bot.tag = self.factory.tag
+
+    def privmsg(self, msg):
+        self.bot.irc_PRIVMSG("someone!user@example.net", ["#bones", msg])
+        return self.recorder.events
+
+    def test_trigger(self):
+        events = self.privmsg("+qdb 42")
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].args, ["42"])
+        self.assertEqual(events[0].match.group(1), u"+")
+        self.assertEqual(events[0].match.group(2), u"qdb")
+
+    def test_triggerWithoutArguments(self):
+        events = self.privmsg("!QDB")
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].args, [])
+
+    def test_triggerWithTrailingSpace(self):
+        events = self.privmsg("+qdb ")
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].args, [])
+        self.assertEqual(events[0].match.group(2), u"qdb")
+
+    def test_triggerWithTrailingSpaceAfterArguments(self):
+        events = self.privmsg("+qdb search  ")
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].args, ["search"])
+
+    def test_notATrigger(self):
+        self.assertEqual(self.privmsg("qdb +qdb"), [])
+        self.assertEqual(self.privmsg("+qdbx"), [])
+        self.assertEqual(self.privmsg("+"), [])
+
+
+class SendLineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bot, self.transport = makeBot(self)
+
+    def test_sendLine(self):
+        self.bot.sendLine("PRIVMSG #bones :hello")
+        self.assertEqual(self.transport.value(), "PRIVMSG #bones :hello\r\n")
+
+    def test_sendLineFromThread(self):
+        """Lines sent from other threads are queued on the reactor thread,
+        in the order they were sent."""
+        def send():
+            for i in range(3):
+                self.bot.sendLine("PRIVMSG #bones :%d" % i)
+            return threadable.isInIOThread()
+
+        written = []
+        write = self.transport.write
+        def recordingWrite(data):
+            written.append(threadable.isInIOThread())
+            write(data)
+        self.transport.write = recordingWrite
+
+        def sent(inIOThread):
+            self.assertFalse(inIOThread)
+            self.assertEqual(written, [True] * 3)
+            self.assertEqual(
+                self.transport.value(),
+                "PRIVMSG #bones :0\r\nPRIVMSG #bones :1\r\n"
+                "PRIVMSG #bones :2\r\n"
+            )
+
+        d = threads.deferToThread(send)
+        d.addCallback(sent)
+        return d
+
+
+class ChannelStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bot, self.transport = makeBot(self)
+        receive(self.bot, ":bones!bones@bot.example.net JOIN #bones")
+
+    def test_casemapping(self):
+        """Users and channels are keyed by their names in lowercase, with
+        []\\ being the uppercase versions of {}| until the server tells
+        otherwise."""
+        receive(self.bot, ":Nick[a]!user@host JOIN #Bones")
+        user = self.bot.users["nick{a}"]
+        self.assertIdentical(self.bot.get_user("NICK{A}"), user)
+        self.assertIdentical(self.bot.get_channel("#BONES"),
+                             self.bot.channels["#bones"])
+        receive(self.bot, ":irc.example.net 005 bones CASEMAPPING=ascii "
+                          ":are supported by this server")
+        self.assertEqual(self.bot.users.keys(), ["nick[a]"])
+        self.assertIdentical(self.bot.get_user("NICK[A]"), user)
+
+    def test_hostChanged(self):
+        """The user's username and hostname follow its hostmask, which may
+        be a unicode string."""
+        user = self.bot.get_user("alice!alice@old.example.net")
+        self.assertIdentical(self.bot.get_user(u"alice!ali@new.example.net"),
+                             user)
+        self.assertEqual((user.username, user.hostname),
+                         (u"ali", u"new.example.net"))
+        self.bot.get_user("alice!ali@new.example.net")
+        self.assertEqual(user.hostname, "new.example.net")
+
+    def test_slots(self):
+        user = self.bot.get_user("alice!alice@example.net")
+        channel = self.bot.get_channel("#bones")
+        self.assertRaises(AttributeError, setattr, user, "extra", 1)
+        self.assertRaises(AttributeError, setattr, channel, "extra", 1)
+
+    def test_membership(self):
+        """Users in our channels are kept in :attr:`users`, and moved to the
+        orphans once they've left all of them."""
+        receive(self.bot,
+                ":alice!alice@example.net JOIN #bones",
+                ":alice!alice@example.net JOIN #other")
+        channel = self.bot.channels["#bones"]
+        user = self.bot.users["alice"]
+        self.assertEqual(channel.users, set([user]))
+        self.assertEqual(user.channels,
+                         set([channel, self.bot.channels["#other"]]))
+        receive(self.bot, ":alice!alice@example.net PART #bones")
+        self.assertEqual(channel.users, set())
+        self.assertIdentical(self.bot.users["alice"], user)
+        receive(self.bot, ":alice!alice@example.net PART #other :bye")
+        self.assertNotIn("alice", self.bot.users)
+        self.assertIdentical(self.bot.orphans.get("alice"), user)
+        self.assertEqual(user.channels, set())
+
+    def test_kicked(self):
+        """When the bot is kicked, the channel is forgotten, and users that
+        aren't in any of our other channels are moved to the orphans."""
+        receive(self.bot,
+                ":bones!bones@bot.example.net JOIN #other",
+                ":alice!alice@example.net JOIN #bones",
+                ":alice!alice@example.net JOIN #other",
+                ":bob!bob@example.net JOIN #bones",
+                ":alice!alice@example.net KICK #bones bones :out")
+        self.assertEqual(self.bot.channels.keys(), ["#other"])
+        alice = self.bot.users["alice"]
+        self.assertEqual(alice.channels, set([self.bot.channels["#other"]]))
+        self.assertNotIn("bob", self.bot.users)
+        self.assertEqual(self.bot.orphans.get("bob").channels, set())
+
+    def test_left(self):
+        receive(self.bot,
+                ":alice!alice@example.net JOIN #bones",
+                ":bones!bones@bot.example.net PART #bones")
+        self.assertEqual(self.bot.channels, {})
+        self.assertEqual(self.bot.users, {})
+        self.assertEqual(self.bot.orphans.get("alice").channels, set())
+
+    def test_quit(self):
+        receive(self.bot,
+                ":alice!alice@example.net JOIN #bones",
+                ":alice!alice@example.net QUIT :Quit: bye")
+        self.assertNotIn("alice", self.bot.users)
+        self.assertIdentical(self.bot.orphans.get("alice"), None)
+        self.assertEqual(self.bot.channels["#bones"].users, set())
+
+    def test_names(self):
+        """NAMES replies are collected until the end of the list, and users
+        already known are reused."""
+        alice = self.bot.get_user("alice!alice@example.net")
+        receive(self.bot,
+                ":irc.example.net 353 bones = #bones :@+Alice bob",
+                ":irc.example.net 353 bones = #bones "
+                ":+carol!carol@example.net")
+        channel = self.bot.channels["#bones"]
+        self.assertEqual(channel.users, set())
+        receive(self.bot, ":irc.example.net 366 bones #bones :End of /NAMES")
+        self.assertEqual(len(channel.users), 3)
+        self.assertIn(alice, channel.users)
+        self.assertEqual(alice.nickname, "Alice")
+        self.assertEqual(self.bot.users["carol"].hostname, "example.net")
+        self.assertEqual(channel.modes, {"o": set(["Alice"]),
+                                         "v": set(["Alice", "carol"])})
+        self.assertEqual(self.bot.pendingNames, {})
+
+    def test_isupport(self):
+        """The mode and prefix tables are compiled from ISUPPORT."""
+        receive(self.bot, ":irc.example.net 005 bones PREFIX=(qov)~@+ "
+                          "CHANMODES=beI,k,l,imnst CHANTYPES=#& "
+                          ":are supported by this server")
+        self.assertEqual(self.bot.prefixModes, {"~": "q", "@": "o", "+": "v"})
+        self.assertEqual(self.bot.prefixModeSet, frozenset("qov"))
+        self.assertEqual(self.bot.channelTypes, frozenset("#&"))
+        self.assertEqual(
+            dict((mode, self.bot.modeKinds[mode]) for mode in "qbkli"),
+            {"q": "prefix", "b": "list", "k": "always", "l": "set",
+             "i": "never"})
+        receive(self.bot,
+                ":irc.example.net 353 bones = #bones :~alice",
+                ":irc.example.net 366 bones #bones :End of /NAMES",
+                ":alice!alice@example.net MODE #bones +bkl-q *!*@spam key 10 "
+                "alice")
+        modes = self.bot.channels["#bones"].modes
+        self.assertEqual(modes, {"q": set(), "b": set(["*!*@spam"]),
+                                 "k": "key", "l": "10"})
+
+
+class CapabilityTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bot, self.transport = makeBot(
+            self, capabilities="multi-prefix away-notify batch")
+
+    def sent(self):
+        lines = self.transport.value().splitlines()
+        self.transport.clear()
+        return lines
+
+    def test_registration(self):
+        """Capabilities are listed before registering, so that the server
+        waits for them to be negotiated."""
+        bot, transport = makeBot(self, capabilities="batch")
+        self.assertEqual(transport.value(), "")
+        transport = StringTransport()
+        bot.makeConnection(transport)
+        self.assertEqual(transport.value().splitlines()[0], "CAP LS 302")
+        self.assertTrue(bot.negotiatingCapabilities)
+
+    def test_withoutCapabilities(self):
+        bot, transport = makeBot(self)
+        bot.makeConnection(transport)
+        self.assertNotIn("CAP", transport.value())
+        self.assertFalse(bot.negotiatingCapabilities)
+
+    def test_acknowledged(self):
+        receive(self.bot, ":irc.example.net CAP * LS :multi-prefix "
+                          "sasl=PLAIN,EXTERNAL batch")
+        self.assertEqual(self.bot.serverCapabilities,
+                         {"multi-prefix": "", "sasl": "PLAIN,EXTERNAL",
+                          "batch": ""})
+        self.assertEqual(self.sent(), ["CAP REQ :batch multi-prefix"])
+        receive(self.bot, ":irc.example.net CAP bones ACK :batch "
+                          "multi-prefix")
+        self.assertEqual(self.bot.capabilities,
+                         set(["batch", "multi-prefix"]))
+        self.assertEqual(self.sent(), ["CAP END"])
+        self.assertFalse(self.bot.negotiatingCapabilities)
+
+    def test_multilineList(self):
+        """Capabilities are only requested once the whole list has been
+        received."""
+        receive(self.bot, ":irc.example.net CAP * LS * :multi-prefix sasl")
+        self.assertEqual(self.sent(), [])
+        receive(self.bot, ":irc.example.net CAP * LS :away-notify")
+        self.assertEqual(self.sent(), ["CAP REQ :away-notify multi-prefix"])
+
+    def test_nothingToRequest(self):
+        receive(self.bot, ":irc.example.net CAP * LS :sasl")
+        self.assertEqual(self.sent(), ["CAP END"])
+
+    def test_refused(self):
+        receive(self.bot, ":irc.example.net CAP * LS :multi-prefix batch",
+                ":irc.example.net CAP bones NAK :batch multi-prefix")
+        self.assertEqual(self.sent(),
+                         ["CAP REQ :batch multi-prefix", "CAP END"])
+        self.assertEqual(self.bot.capabilities, set())
+
+    def test_newAndDeleted(self):
+        """Capabilities the server offers after registration are requested
+        without ending the negotiation again, and capabilities it takes back
+        are disabled."""
+        receive(self.bot, ":irc.example.net CAP * LS :batch",
+                ":irc.example.net CAP bones ACK :batch")
+        self.assertEqual(self.sent(), ["CAP REQ :batch", "CAP END"])
+        receive(self.bot, ":irc.example.net CAP bones NEW :away-notify sasl")
+        self.assertEqual(self.sent(), ["CAP REQ :away-notify"])
+        receive(self.bot, ":irc.example.net CAP bones ACK :away-notify")
+        self.assertEqual(self.sent(), [])
+        self.assertEqual(self.bot.capabilities, set(["batch", "away-notify"]))
+        receive(self.bot, ":irc.example.net CAP bones DEL :batch")
+        self.assertEqual(self.bot.capabilities, set(["away-notify"]))
+        self.assertNotIn("batch", self.bot.serverCapabilities)
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bot, self.transport = makeBot(self)
+        self.handled = []
+        self.bot.irc_PRIVMSG = self.privmsg
+
+    def privmsg(self, prefix, params):
+        batch = self.bot.currentBatch
+        self.handled.append((params[1], batch and batch.reference))
+
+    def message(self, text, batch=None):
+        line = ":alice!alice@example.net PRIVMSG #bones :%s" % text
+        if batch is not None:
+            line = "@batch=%s %s" % (batch, line)
+        return line
+
+    def test_batch(self):
+        """Messages in a batch are held back until the batch ends."""
+        receive(self.bot, ":irc.example.net BATCH +a example",
+                self.message("1", "a"), self.message("outside"),
+                self.message("2", "a"))
+        self.assertEqual(self.handled, [("outside", None)])
+        receive(self.bot, ":irc.example.net BATCH -a")
+        self.assertEqual(self.handled, [("outside", None), ("1", "a"),
+                                        ("2", "a")])
+        self.assertEqual(self.bot.batches, {})
+
+    def test_nested(self):
+        """Messages of a batch nested in another are held back until the
+        outer batch ends, and handled where the nested batch ends."""
+        receive(self.bot, ":irc.example.net BATCH +a outer",
+                "@batch=a :irc.example.net BATCH +b inner",
+                self.message("1", "b"),
+                self.message("2", "a"),
+                "@batch=a :irc.example.net BATCH -b",
+                self.message("3", "a"))
+        self.assertEqual(self.handled, [])
+        receive(self.bot, ":irc.example.net BATCH -a")
+        self.assertEqual(self.handled, [("2", "a"), ("1", "b"), ("3", "a")])
+        self.assertEqual(self.bot.batches, {})
+
+    def test_tooManyBatches(self):
+        """The oldest batch is ended early when too many are open."""
+        self.bot.maxBatches = 2
+        receive(self.bot, ":irc.example.net BATCH +a example",
+                self.message("1", "a"),
+                ":irc.example.net BATCH +b example",
+                ":irc.example.net BATCH +c example")
+        self.assertEqual(self.handled, [("1", "a")])
+        self.assertEqual(self.bot.batches.keys(), ["b", "c"])
+
+    def test_tooLong(self):
+        """A batch is ended early when it holds too many messages."""
+        self.bot.maxBatchMessages = 2
+        receive(self.bot, ":irc.example.net BATCH +a example",
+                self.message("1", "a"), self.message("2", "a"),
+                self.message("3", "a"))
+        self.assertEqual(self.handled, [("1", "a"), ("2", "a"),
+                                        ("3", None)])
+
+    def test_connectionLost(self):
+        receive(self.bot, ":irc.example.net BATCH +a example",
+                self.message("1", "a"))
+        self.bot.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(self.bot.batches, {})
+
+
+class NetsplitRecorder(object):
+    """Remembers the netsplit, netjoin, join and quit events it receives."""
+
+    def __init__(self):
+        self.events = []
+
+    @bones.event.handler(event=bones.event.NetsplitEvent)
+    @bones.event.handler(event=bones.event.NetjoinEvent)
+    @bones.event.handler(event=bones.event.UserJoinEvent)
+    @bones.event.handler(event=bones.event.UserQuitEvent)
+    def record(self, event):
+        self.events.append(event)
+
+    def take(self):
+        events, self.events = self.events, []
+        return [event.__class__.__name__ for event in events], events
+
+
+class NetsplitTests(unittest.TestCase):
+
+    split = "hub.example.net leaf.example.net"
+
+    def setUp(self):
+        self.bot, self.transport = makeBot(self)
+        self.clock = self.bot.clock = task.Clock()
+        self.recorder = NetsplitRecorder()
+        bones.event.register(self.recorder, self.bot.tag)
+        self.addCleanup(bones.event.unregister, self.recorder, self.bot.tag)
+        receive(self.bot,
+                ":bones!bones@bot.example.net JOIN #bones",
+                ":alice!alice@example.net JOIN #bones",
+                ":bob!bob@example.net JOIN #bones")
+        self.channel = self.bot.channels["#bones"]
+        self.alice = self.bot.users["alice"]
+        self.bob = self.bot.users["bob"]
+        self.recorder.take()
+
+    def splitUsers(self):
+        receive(self.bot,
+                ":alice!alice@example.net QUIT :%s" % self.split,
+                ":bob!bob@example.net QUIT :%s" % self.split)
+        self.clock.advance(self.bot.netsplitDelay)
+        self.recorder.take()
+
+    def test_netsplit(self):
+        """The quits of a netsplit are reported in one event once they've
+        stopped coming in."""
+        receive(self.bot,
+                ":alice!alice@example.net QUIT :%s" % self.split,
+                ":bob!bob@example.net QUIT :%s" % self.split)
+        self.assertEqual(self.recorder.take()[0], [])
+        self.clock.advance(self.bot.netsplitDelay)
+        names, events = self.recorder.take()
+        self.assertEqual(names, ["NetsplitEvent"])
+        self.assertEqual(events[0].servers,
+                         ("hub.example.net", "leaf.example.net"))
+        self.assertEqual(events[0].users, set([self.alice, self.bob]))
+        self.assertEqual(events[0].channels, set([self.channel]))
+        self.assertEqual(self.channel.users, set())
+        self.assertEqual(self.bot.users, {})
+
+    def test_quit(self):
+        receive(self.bot, ":alice!alice@example.net QUIT :Quit: %s"
+                % self.split)
+        self.assertEqual(self.recorder.take()[0], ["UserQuitEvent"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_netjoin(self):
+        """Users lost in a netsplit that come back are reported in one
+        event."""
+        self.splitUsers()
+        receive(self.bot,
+                ":alice!alice@example.net JOIN #bones",
+                ":Bob!bob@example.net JOIN #bones")
+        self.assertEqual(self.recorder.take()[0], [])
+        self.assertEqual(len(self.channel.users), 2)
+        self.clock.advance(self.bot.netsplitDelay)
+        names, events = self.recorder.take()
+        self.assertEqual(names, ["NetjoinEvent"])
+        self.assertEqual(len(events[0].users), 2)
+        self.assertEqual(self.bot.splitUsers, {})
+
+    def test_nicknameTaken(self):
+        """Someone else joining with the nickname of a user lost in a
+        netsplit isn't part of the netjoin."""
+        self.splitUsers()
+        receive(self.bot, ":alice!mallory@elsewhere.example.net JOIN #bones")
+        self.assertEqual(self.recorder.take()[0], ["UserJoinEvent"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_forgotten(self):
+        """Users that come back long after the netsplit just join."""
+        self.splitUsers()
+        self.clock.advance(self.bot.netsplitMemory)
+        receive(self.bot, ":alice!alice@example.net JOIN #bones")
+        self.assertEqual(self.recorder.take()[0], ["UserJoinEvent"])
+
+    def test_backBeforeReported(self):
+        """A netsplit is reported before the netjoin of users that come back
+        while it's being collected."""
+        receive(self.bot,
+                ":alice!alice@example.net QUIT :%s" % self.split,
+                ":alice!alice@example.net JOIN #bones")
+        self.assertEqual(self.recorder.take()[0], ["NetsplitEvent"])
+        self.clock.advance(self.bot.netsplitDelay)
+        self.assertEqual(self.recorder.take()[0], ["NetjoinEvent"])
+        self.assertEqual(sorted(user.nickname for user in self.channel.users),
+                         ["alice", "bob"])
+
+    def test_batches(self):
+        """Netsplit and netjoin batches are reported when they end."""
+        receive(self.bot,
+                ":irc.example.net BATCH +s netsplit hub.example.net "
+                "leaf.example.net",
+                "@batch=s :alice!alice@example.net QUIT :Ping timeout",
+                ":irc.example.net BATCH -s")
+        names, events = self.recorder.take()
+        self.assertEqual(names, ["NetsplitEvent"])
+        self.assertEqual(events[0].users, set([self.alice]))
+        receive(self.bot,
+                ":irc.example.net BATCH +j netjoin hub.example.net "
+                "leaf.example.net",
+                "@batch=j :alice!alice@example.net JOIN #bones",
+                ":irc.example.net BATCH -j")
+        self.assertEqual(self.recorder.take()[0], ["NetjoinEvent"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,335 @@
+# -*- encoding: utf8 -*-
+import socket
+
+from twisted.internet import error, protocol, reactor, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from bones import connect
+from bones.bot import BonesBotFactory
+from tests.test_bot import makeSettings
+
+
+class ReconnectDelayTests(unittest.TestCase):
+
+    def test_firstAttempt(self):
+        """The first reconnect happens right away."""
+        self.assertEqual(connect.reconnectDelay(0), 0.0)
+
+    def test_doubles(self):
+        delays = [connect.reconnectDelay(attempt, random=lambda: 1.0)
+                  for attempt in range(1, 6)]
+        self.assertEqual(delays, [5.0, 10.0, 20.0, 40.0, 80.0])
+
+    def test_bounds(self):
+        """Half of the delay is random, and it never exceeds the maximum
+        delay."""
+        self.assertEqual(connect.reconnectDelay(3, random=lambda: 0.0), 10.0)
+        for attempt in (9, 1000):
+            self.assertEqual(connect.reconnectDelay(attempt,
+                                                    random=lambda: 1.0),
+                             300.0)
+        self.assertEqual(connect.reconnectDelay(2, minDelay=1, maxDelay=60,
+                                                random=lambda: 0.5), 1.5)
+
+    def test_jitter(self):
+        delays = set(connect.reconnectDelay(4) for i in range(20))
+        self.assertTrue(len(delays) > 1)
+        for delay in delays:
+            self.assertTrue(20.0 <= delay <= 40.0, delay)
+
+
+class ParseHostsTests(unittest.TestCase):
+
+    def test_parseHosts(self):
+        value = "\n".join([
+            "irc.example.net",
+            "  irc2.example.net:6697  ",
+            "",
+            "192.0.2.1:7000",
+            "[2001:db8::1]:6697",
+            "[2001:db8::2]",
+            "2001:db8::3",
+        ])
+        self.assertEqual(connect.parseHosts(value, 6667), [
+            ("irc.example.net", 6667),
+            ("irc2.example.net", 6697),
+            ("192.0.2.1", 7000),
+            ("2001:db8::1", 6697),
+            ("2001:db8::2", 6667),
+            ("2001:db8::3", 6667),
+        ])
+
+    def test_empty(self):
+        self.assertEqual(connect.parseHosts("", 6667), [])
+
+
+class InterleaveTests(unittest.TestCase):
+
+    def test_interleave(self):
+        v4, v6 = socket.AF_INET, socket.AF_INET6
+        addresses = [(v6, "a"), (v6, "b"), (v6, "c"), (v4, "d"), (v4, "e")]
+        self.assertEqual(connect.interleave(addresses), [
+            (v6, "a"), (v4, "d"), (v6, "b"), (v4, "e"), (v6, "c"),
+        ])
+        self.assertEqual(connect.interleave(addresses[3:] + addresses[:1]),
+                         [(v4, "d"), (v6, "a"), (v4, "e")])
+
+    def test_oneFamily(self):
+        addresses = [(socket.AF_INET, "a"), (socket.AF_INET, "b")]
+        self.assertEqual(connect.interleave(addresses), addresses)
+        self.assertEqual(connect.interleave([]), [])
+
+
+class ResolverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.resolver = connect.Resolver(ttl=300)
+        self.resolver.cache.clock = self.clock.seconds
+        self.lookups = []
+        self.results = [
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, "",
+             ("2001:db8::1", 6667, 0, 0)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", 6667)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", 6667)),
+        ]
+        self.patch(socket, "getaddrinfo", self.getaddrinfo)
+
+    def getaddrinfo(self, host, port, family, socktype):
+        self.lookups.append(host)
+        return self.results
+
+    def resolve(self, host="irc.example.net"):
+        return self.resolver.resolve(host, 6667)
+
+    def test_addresses(self):
+        """Addresses are returned in the order the system prefers them,
+        each only once."""
+        d = self.resolve()
+        d.addCallback(self.assertEqual, [(socket.AF_INET6, "2001:db8::1"),
+                                         (socket.AF_INET, "192.0.2.1")])
+        return d
+
+    def test_ipAddresses(self):
+        results = []
+        self.resolve("192.0.2.2").addCallback(results.append)
+        self.resolve("2001:db8::2").addCallback(results.append)
+        self.assertEqual(results, [[(socket.AF_INET, "192.0.2.2")],
+                                   [(socket.AF_INET6, "2001:db8::2")]])
+        self.assertEqual(self.lookups, [])
+
+    def test_cached(self):
+        """Addresses are remembered until the TTL runs out."""
+        def again(_):
+            results = []
+            self.resolve().addCallback(results.append)
+            self.assertEqual(len(results), 1)
+            self.assertEqual(self.lookups, ["irc.example.net"])
+            self.clock.advance(301)
+            return self.resolve()
+
+        def check(_):
+            self.assertEqual(self.lookups, ["irc.example.net"] * 2)
+        d = self.resolve()
+        d.addCallback(again)
+        return d.addCallback(check)
+
+    def test_forget(self):
+        def forget(_):
+            self.resolver.forget("irc.example.net")
+            return self.resolve()
+
+        def check(_):
+            self.assertEqual(self.lookups, ["irc.example.net"] * 2)
+        d = self.resolve()
+        d.addCallback(forget)
+        return d.addCallback(check)
+
+    def test_noAddresses(self):
+        self.results = [(socket.AF_UNIX, socket.SOCK_STREAM, 0, "",
+                         "/tmp/socket")]
+        return self.assertFailure(self.resolve(), error.DNSLookupError)
+
+
+class FakeConnector(object):
+    def __init__(self, address, port, factory):
+        self.address = address
+        self.port = port
+        self.factory = factory
+        self.stopped = False
+
+    def stopConnecting(self):
+        if self.stopped:
+            raise error.NotConnectingError()
+        self.stopped = True
+
+    def fail(self):
+        self.stopped = True
+        reason = failure.Failure(error.ConnectionRefusedError())
+        self.factory.clientConnectionFailed(self, reason)
+        return reason
+
+
+class RecordingFactory(protocol.ClientFactory):
+    protocol = protocol.Protocol
+
+    def __init__(self):
+        self.built = []
+        self.failures = []
+        self.lost = []
+
+    def buildProtocol(self, addr):
+        self.built.append(addr)
+        return protocol.ClientFactory.buildProtocol(self, addr)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failures.append(reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self.lost.append(reason)
+
+
+class HappyEyeballsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = RecordingFactory()
+        self.connectors = []
+        self.eyeballs = connect.HappyEyeballs(
+            self.factory,
+            [("2001:db8::1", 6667), ("192.0.2.1", 6667),
+             ("2001:db8::2", 6667)],
+            self.connect, delay=0.25, clock=self.clock)
+
+    def connect(self, address, port, factory):
+        connector = FakeConnector(address, port, factory)
+        self.connectors.append(connector)
+        return connector
+
+    def addresses(self):
+        return [connector.address for connector in self.connectors]
+
+    def test_staggered(self):
+        """An attempt to connect to the next address is started every
+        delay."""
+        self.eyeballs.start()
+        self.assertEqual(self.addresses(), ["2001:db8::1"])
+        self.clock.advance(0.24)
+        self.assertEqual(len(self.connectors), 1)
+        self.clock.advance(0.01)
+        self.assertEqual(self.addresses(), ["2001:db8::1", "192.0.2.1"])
+        self.clock.advance(0.25)
+        self.assertEqual(len(self.connectors), 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failedAttempt(self):
+        """The next attempt is started right away when one fails."""
+        self.eyeballs.start()
+        self.connectors[0].fail()
+        self.assertEqual(len(self.connectors), 2)
+        self.clock.advance(0.24)
+        self.assertEqual(len(self.connectors), 2)
+        self.clock.advance(0.01)
+        self.assertEqual(len(self.connectors), 3)
+
+    def test_firstConnectionWins(self):
+        """The first attempt to connect wins, and the other attempts are
+        abandoned."""
+        self.eyeballs.start()
+        self.clock.advance(0.25)
+        first, second = self.connectors
+        protocol = second.factory.buildProtocol("address")
+        self.assertNotIdentical(protocol, None)
+        self.assertEqual(self.factory.built, ["address"])
+        self.assertTrue(first.stopped)
+        self.assertFalse(second.stopped)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        # An attempt that connects after the winner is dropped.
+        self.assertIdentical(first.factory.buildProtocol("late"), None)
+        self.assertEqual(self.factory.built, ["address"])
+        self.clock.advance(1)
+        self.assertEqual(len(self.connectors), 2)
+
+    def test_loserAlreadyFailed(self):
+        self.eyeballs.start()
+        self.connectors[0].fail()
+        self.connectors[1].factory.buildProtocol("address")
+        self.assertEqual(self.factory.failures, [])
+
+    def test_connectionLost(self):
+        """Only the connection of the winner is reported as lost."""
+        self.eyeballs.start()
+        self.clock.advance(0.25)
+        first, second = self.connectors
+        second.factory.buildProtocol("address")
+        lost = failure.Failure(error.ConnectionDone())
+        first.factory.clientConnectionLost(first, lost)
+        self.assertEqual(self.factory.lost, [])
+        second.factory.clientConnectionLost(second, lost)
+        self.assertEqual(self.factory.lost, [lost])
+
+    def test_allFailed(self):
+        """The factory is told once every attempt has failed, with the
+        reason the last one failed."""
+        self.eyeballs.start()
+        self.clock.advance(0.5)
+        self.connectors[1].fail()
+        self.connectors[0].fail()
+        self.assertEqual(self.factory.failures, [])
+        reason = self.connectors[2].fail()
+        self.assertEqual(self.factory.failures, [reason])
+
+
+class FactoryHostsTests(unittest.TestCase):
+
+    def setUp(self):
+        settings = makeSettings(self, "\n".join([
+            "[bot]",
+            "nickname = bones",
+            "username = bones",
+            "[server.test]",
+            "host = 192.0.2.1",
+            "    [2001:db8::1]:6697",
+            "port = 7000",
+        ]))
+        self.factory = BonesBotFactory(settings)
+        self.connections = []
+        self.patch(reactor, "connectTCP", self.connectTCP)
+
+    def connectTCP(self, host, port, factory, bindAddress=None):
+        self.connections.append((host, port))
+
+    def fail(self):
+        self.factory.clientConnectionFailed(
+            None, failure.Failure(error.ConnectionRefusedError()))
+        # The reconnect is tested here, not scheduled.
+        self.factory.reconnectCall.cancel()
+
+    def test_hosts(self):
+        self.assertEqual(self.factory.hosts,
+                         [("192.0.2.1", 7000), ("2001:db8::1", 6697)])
+
+    def test_rotation(self):
+        """The next host is tried whenever connecting fails, waiting longer
+        after every attempt."""
+        self.factory.connect()
+        self.fail()
+        self.factory.connect()
+        self.fail()
+        self.factory.connect()
+        self.assertEqual(self.connections, [
+            ("192.0.2.1", 7000), ("2001:db8::1", 6697), ("192.0.2.1", 7000),
+        ])
+        self.assertEqual(self.factory.reconnectAttempts, 2)
+
+    def test_forgetsAddresses(self):
+        """The addresses of a host that couldn't be connected to are looked
+        up again next time."""
+        self.factory.hosts = [("irc.example.net", 6667)]
+        self.factory.resolver.cache.set("irc.example.net",
+                                        [(socket.AF_INET, "192.0.2.1")])
+        self.factory.connect()
+        self.fail()
+        self.assertNotIn("irc.example.net", self.factory.resolver.cache)
+        self.assertEqual(self.connections, [("192.0.2.1", 6667)])
@@ -0,0 +1,161 @@
+# -*- encoding: utf8 -*-
+from twisted.internet import defer, threads
+from twisted.python import threadable
+from twisted.trial import unittest
+
+import bones.event
+
+
+class BaseEvent(bones.event.Event):
+    pass
+
+
+class SubEvent(BaseEvent):
+    pass
+
+
+class Recorder(object):
+    """Records the handlers called, along with whether they were called on
+    the reactor thread."""
+
+    def __init__(self):
+        self.calls = []
+
+    def record(self, name):
+        self.calls.append((name, threadable.isInIOThread()))
+
+    @bones.event.handler(event=BaseEvent)
+    def onBase(self, event):
+        self.record("base")
+
+    @bones.event.handler(event=SubEvent)
+    def onSub(self, event):
+        self.record("sub")
+
+    @bones.event.handler(event=BaseEvent)
+    @bones.event.handler(event=SubEvent)
+    def onBoth(self, event):
+        self.record("both")
+
+    @bones.event.handler(event=SubEvent, threaded=True)
+    def onSubThreaded(self, event):
+        self.record("threaded")
+
+    @bones.event.handler(trigger="Ping")
+    def onPing(self, event):
+        self.record("ping")
+
+
+class DispatchTests(unittest.TestCase):
+
+    server = "test.event"
+
+    def setUp(self):
+        self.recorder = Recorder()
+        bones.event.register(self.recorder, self.server)
+        self.addCleanup(bones.event.unregister, self.recorder, self.server)
+
+    def fire(self, event, *args):
+        """Fires an event and returns a Deferred firing once all the
+        handlers, including the threaded ones, have been called."""
+        d = defer.Deferred()
+        bones.event.fire(self.server, event, *args, callback=d.callback)
+        return d
+
+    def names(self):
+        return [name for name, inIOThread in self.recorder.calls]
+
+    def test_baseEvent(self):
+        """Handlers for subclasses of an event aren't called for it."""
+        d = self.fire(BaseEvent())
+        d.addCallback(lambda _: self.assertEqual(self.names(),
+                                                 ["base", "both"]))
+        return d
+
+    def test_subclassedEvent(self):
+        """Handlers for the base classes of an event are called for it too,
+        in the order they were registered, and a handler registered for both
+        an event and its base class is only called once."""
+        def check(_):
+            # register() finds the handlers in alphabetical order.
+            self.assertEqual(self.names(),
+                             ["base", "both", "sub", "threaded"])
+        return self.fire(SubEvent()).addCallback(check)
+
+    def test_threadedAfterInline(self):
+        """Threaded handlers are called in the thread pool, after all inline
+        handlers were called on the reactor thread."""
+        def check(_):
+            calls = self.recorder.calls
+            self.assertEqual(calls[-1], ("threaded", False))
+            self.assertTrue(all(inIOThread for name, inIOThread
+                                in calls[:-1]))
+        return self.fire(SubEvent()).addCallback(check)
+
+    def test_callbackEvent(self):
+        """The callback is called with the event."""
+        event = SubEvent()
+        d = self.fire(event)
+        d.addCallback(self.assertIdentical, event)
+        return d
+
+    def test_fireFromThread(self):
+        """Events fired from other threads are handed over to the reactor
+        thread."""
+        done = defer.Deferred()
+
+        def fire():
+            bones.event.fire(self.server, BaseEvent(),
+                             callback=lambda event: done.callback(None))
+
+        def check(_):
+            self.assertEqual(self.recorder.calls,
+                             [("base", True), ("both", True)])
+        d = threads.deferToThread(fire)
+        d.addCallback(lambda _: done)
+        return d.addCallback(check)
+
+    def test_handlerException(self):
+        """An exception raised by a handler doesn't keep the other handlers
+        from being called."""
+        def broken(event):
+            raise RuntimeError("broken")
+        self.patch(self.recorder, "onBase", broken)
+        bones.event.unregister(self.recorder, self.server)
+        bones.event.register(self.recorder, self.server)
+        d = self.fire(BaseEvent())
+        d.addCallback(lambda _: self.assertEqual(self.names(), ["both"]))
+        return d
+
+    def test_unregister(self):
+        """Unregistering a module invalidates the compiled dispatch tables."""
+        def unregister(_):
+            self.recorder.calls = []
+            bones.event.unregister(self.recorder, self.server)
+            return self.fire(BaseEvent())
+
+        d = self.fire(BaseEvent())
+        d.addCallback(unregister)
+        d.addCallback(lambda _: self.assertEqual(self.names(), []))
+        return d
+
+    def test_registerAfterFiring(self):
+        """Modules registered after an event was fired get it too."""
+        other = Recorder()
+
+        def register(_):
+            bones.event.register(other, self.server)
+            self.addCleanup(bones.event.unregister, other, self.server)
+            return self.fire(BaseEvent())
+
+        d = self.fire(BaseEvent())
+        d.addCallback(register)
+        d.addCallback(lambda _: self.assertEqual(
+            [name for name, inIOThread in other.calls], ["base", "both"]))
+        return d
+
+    def test_triggers(self):
+        self.assertEqual(bones.event.triggers(self.server),
+                         {"ping": "<Trigger: ping>"})
+        self.fire("<Trigger: ping>", None)
+        self.assertEqual(self.names(), ["ping"])
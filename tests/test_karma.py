@@ -0,0 +1,123 @@
+# -*- encoding: utf8 -*-
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from bones.modules import karma, storage
+from tests.test_bot import makeSettings
+
+
+class FakeDatabase(object):
+    """Stands in for :class:`bones.modules.storage.Database`, running
+    database work right away instead of in a thread."""
+
+    def __init__(self, path, tables=()):
+        self.engine = create_engine("sqlite:///%s" % path)
+        storage.Base.metadata.create_all(self.engine, tables=tables)
+        self.sessionmaker = sessionmaker(bind=self.engine, autocommit=True)
+        self.fail = False
+
+    def new_session(self):
+        return self.sessionmaker()
+
+    def run(self, fn, *args, **kwargs):
+        if self.fail:
+            return defer.fail(RuntimeError("Database unavailable"))
+        return defer.maybeDeferred(fn, *args, **kwargs)
+
+
+class DatabaseInitializedEvent(object):
+    def __init__(self, module):
+        self.module = module
+
+
+class KarmabotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.db = FakeDatabase(self.path, [karma.KarmaEntry.__table__,
+                                           karma.KarmaScore.__table__])
+        self.settings = makeSettings(self, "[server.test]\n")
+        self.addCleanup(karma.sharedScores.clear)
+
+    def makeBot(self):
+        bot = karma.Karmabot(settings=self.settings, factory=None)
+        bot.buffer.clock = task.Clock()
+        return bot
+
+    def score(self, bot, user):
+        scores = []
+        bot.getUserScore(user).addCallback(scores.append)
+        return scores[0]
+
+    def storedScores(self):
+        return dict(self.db.engine.execute(
+            "SELECT dest, score FROM bones_karma_scores").fetchall())
+
+    def test_sharedBetweenServers(self):
+        """Karma given on one server counts on the other servers using the
+        same database right away."""
+        first, second = self.makeBot(), self.makeBot()
+        first.gotDB(DatabaseInitializedEvent(self.db))
+        second.gotDB(DatabaseInitializedEvent(self.db))
+        first.addKarmaEntry("alice", "Bob", 0, None)
+        self.assertEqual(self.score(second, "bob"), 1)
+        second.buffer.flush()
+        first.buffer.flush()
+        self.assertEqual(self.storedScores(), {"bob": 1})
+
+    def test_loadedScores(self):
+        """Scores in the database are loaded once, and karma given before
+        the database was ready is added to them."""
+        self.db.engine.execute(
+            "INSERT INTO bones_karma_scores (dest, score) VALUES ('bob', 5)")
+        first, second = self.makeBot(), self.makeBot()
+        first.addKarmaEntry("alice", "bob", 0, None)
+        second.addKarmaEntry("carol", "bob", 0, None)
+        first.gotDB(DatabaseInitializedEvent(self.db))
+        second.gotDB(DatabaseInitializedEvent(self.db))
+        self.assertEqual(self.score(first, "bob"), 7)
+        self.assertEqual(self.score(second, "bob"), 7)
+        first.buffer.flush()
+        second.buffer.flush()
+        self.assertEqual(self.storedScores(), {"bob": 7})
+
+    def test_loadFailed(self):
+        """If the scores can't be loaded, karma is still written and scores
+        are read from the database."""
+        bot = self.makeBot()
+        bot.addKarmaEntry("alice", "bob", 0, None)
+        self.db.fail = True
+        bot.gotDB(DatabaseInitializedEvent(self.db))
+        self.assertFalse(bot.buffer.paused)
+        self.assertTrue(bot.shared.failed)
+        self.db.fail = False
+        self.db.engine.execute(
+            "INSERT INTO bones_karma_scores (dest, score) VALUES ('bob', 5)")
+        self.assertEqual(self.score(bot, "bob"), 6)
+        bot.buffer.flush()
+        self.assertEqual(self.score(bot, "bob"), 6)
+        self.assertEqual(self.storedScores(), {"bob": 6})
+
+    def test_writeRetried(self):
+        """A batch is written again if another server inserted the score of
+        one of its users at the same time."""
+        bot = self.makeBot()
+        bot.gotDB(DatabaseInitializedEvent(self.db))
+        write = bot.writeEntriesInSession
+        attempts = []
+
+        def conflictingWrite(session, entries, counts):
+            write(session, entries, counts)
+            attempts.append(True)
+            if len(attempts) == 1:
+                raise IntegrityError("INSERT", {}, Exception("conflict"))
+        bot.writeEntriesInSession = conflictingWrite
+        bot.addKarmaEntry("alice", "bob", 0, None)
+        bot.buffer.flush()
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.storedScores(), {"bob": 1})
+        self.assertEqual(self.db.engine.execute(
+            "SELECT COUNT(*) FROM bones_karma").scalar(), 1)
@@ -0,0 +1,142 @@
+# -*- encoding: utf8 -*-
+import logging
+import weakref
+
+from twisted.trial import unittest
+
+import bones.log
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class BonesLoggerTests(unittest.TestCase):
+
+    def setUp(self):
+        # A plain logger as the parent, like the root logger.
+        self.parent = logging.getLogger("bonestest%i" % id(self))
+        self.parent.propagate = False
+        self.handler = RecordingHandler()
+        self.parent.addHandler(self.handler)
+        self.setLevel(self.parent, logging.INFO)
+        self.log = bones.log.getLogger(self.parent.name + ".child")
+
+    def setLevel(self, logger, level):
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(level)
+
+    def messages(self):
+        return [(record.levelname, record.getMessage())
+                for record in self.handler.records]
+
+    def test_getLogger(self):
+        """Loggers created before Bones got to them become Bones loggers."""
+        plain = logging.getLogger(self.parent.name + ".plain")
+        self.assertNotIsInstance(plain, bones.log.BonesLogger)
+        self.assertIdentical(bones.log.getLogger(plain.name), plain)
+        self.assertIsInstance(plain, bones.log.BonesLogger)
+        self.assertFalse(plain.isEnabledFor(logging.DEBUG))
+
+    def test_levels(self):
+        self.log.raw("raw %s", "line")
+        self.log.debug("debug")
+        self.log.info("info %i", 1)
+        self.assertEqual(self.messages(), [("INFO", "info 1")])
+        self.assertEqual(self.log._enabledLevels,
+                         {bones.log.RAW: False, logging.DEBUG: False,
+                          logging.INFO: True})
+
+    def test_setLevel(self):
+        self.assertFalse(self.log.isEnabledFor(logging.DEBUG))
+        self.setLevel(self.log, bones.log.RAW)
+        self.log.raw("raw")
+        self.assertEqual(self.messages(), [("RAW", "raw")])
+
+    def test_parentLevelChanged(self):
+        """Changing the level of a parent that isn't a Bones logger changes
+        the levels enabled for its children."""
+        self.log.debug("hidden")
+        self.setLevel(self.parent, logging.DEBUG)
+        self.log.debug("shown")
+        self.setLevel(self.parent, logging.WARNING)
+        self.log.info("hidden")
+        self.assertEqual(self.messages(), [("DEBUG", "shown")])
+
+    def test_rootLevelChanged(self):
+        self.setLevel(self.parent, logging.NOTSET)
+        self.setLevel(logging.root, logging.WARNING)
+        self.assertFalse(self.log.isEnabledFor(logging.INFO))
+        logging.root.setLevel(logging.DEBUG)
+        self.assertTrue(self.log.isEnabledFor(logging.INFO))
+
+    def test_disable(self):
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.assertTrue(self.log.isEnabledFor(logging.INFO))
+        logging.disable(logging.INFO)
+        self.assertFalse(self.log.isEnabledFor(logging.INFO))
+        logging.disable(logging.NOTSET)
+        self.assertTrue(self.log.isEnabledFor(logging.INFO))
+
+
+class AsyncFileHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.handler = bones.log.AsyncFileHandler(self.path)
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self.addCleanup(self.handler.close)
+        self.log = logging.getLogger("bonestest%i" % id(self))
+        self.log.propagate = False
+        self.log.addHandler(self.handler)
+        self.addCleanup(self.log.removeHandler, self.handler)
+
+    def written(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_close(self):
+        """Closing the handler writes all queued records."""
+        for i in range(1000):
+            self.log.warning("line %i", i)
+        self.handler.close()
+        self.assertFalse(self.handler.writer.is_alive())
+        self.assertEqual(self.written(),
+                         "".join("line %i\n" % i for i in range(1000)))
+
+    def test_shutdown(self):
+        """Records queued when logging is shut down at exit are written."""
+        for i in range(1000):
+            self.log.warning("line %i", i)
+        logging.shutdown([weakref.ref(self.handler)])
+        self.assertEqual(len(self.written().splitlines()), 1000)
+
+    def test_formattedWhenLogged(self):
+        """Messages are formatted when they're logged, not when they're
+        written."""
+        items = ["before"]
+        self.log.warning("%s", items)
+        items[0] = "after"
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            self.log.exception("failed")
+        self.handler.close()
+        written = self.written()
+        self.assertTrue(written.startswith("['before']\nfailed\nTraceback"))
+        self.assertIn("ValueError: broken", written)
+
+    def test_dropped(self):
+        """Records are dropped rather than waited for when the queue is
+        full."""
+        def full(record):
+            raise bones.log.Queue.Full()
+        self.patch(self.handler.queue, "put_nowait", full)
+        self.log.warning("dropped")
+        self.log.warning("dropped")
+        self.assertEqual(self.handler.dropped, 2)
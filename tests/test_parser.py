@@ -0,0 +1,122 @@
+# -*- encoding: utf8 -*-
+from twisted.trial import unittest
+from twisted.words.protocols import irc
+
+from bones.parser import Message, splitPrefix, unescapeTag
+
+
+class MessageTests(unittest.TestCase):
+
+    def test_message(self):
+        message = Message(":nick!user@host PRIVMSG #bones :hello there")
+        self.assertEqual(message.prefix, "nick!user@host")
+        self.assertEqual(message.command, "PRIVMSG")
+        self.assertEqual(message.params, ["#bones", "hello there"])
+        self.assertEqual((message.nick, message.user, message.host),
+                         ("nick", "user", "host"))
+        self.assertEqual(message.tags, {})
+        self.assertIdentical(message.time, None)
+
+    def test_withoutPrefix(self):
+        message = Message("PING :irc.example.net")
+        self.assertEqual(message.prefix, "")
+        self.assertEqual(message.command, "PING")
+        self.assertEqual(message.params, ["irc.example.net"])
+        self.assertEqual(message.nick, "")
+
+    def test_withoutParams(self):
+        message = Message(":irc.example.net QUIT")
+        self.assertEqual(message.command, "QUIT")
+        self.assertEqual(message.params, [])
+
+    def test_withoutTrailing(self):
+        message = Message(":irc.example.net MODE #bones +o nick")
+        self.assertEqual(message.params, ["#bones", "+o", "nick"])
+
+    def test_emptyTrailing(self):
+        message = Message(":nick!user@host PRIVMSG #bones :")
+        self.assertEqual(message.params, ["#bones", ""])
+
+    def test_trailingWithColons(self):
+        message = Message(":nick!user@host PRIVMSG #bones :a :b: c")
+        self.assertEqual(message.params, ["#bones", "a :b: c"])
+
+    def test_onlyTrailing(self):
+        message = Message("ERROR :Closing link")
+        self.assertEqual(message.params, ["Closing link"])
+
+    def test_extraSpaces(self):
+        message = Message(":nick!user@host  PRIVMSG   #bones  :hi  there")
+        self.assertEqual(message.prefix, "nick!user@host")
+        self.assertEqual(message.command, "PRIVMSG")
+        self.assertEqual(message.params, ["#bones", "hi  there"])
+
+    def test_leadingSpaces(self):
+        message = Message("  PING :irc.example.net")
+        self.assertEqual(message.prefix, "")
+        self.assertEqual(message.command, "PING")
+        self.assertEqual(message.params, ["irc.example.net"])
+
+    def test_tags(self):
+        message = Message("@aaa=bbb;ccc;example.com/ddd=eee "
+                          ":nick!user@host PRIVMSG #bones :hi")
+        self.assertEqual(message.tags, {"aaa": "bbb", "ccc": True,
+                                        "example.com/ddd": "eee"})
+        self.assertEqual(message.prefix, "nick!user@host")
+        self.assertEqual(message.command, "PRIVMSG")
+        self.assertEqual(message.params, ["#bones", "hi"])
+
+    def test_tagsWithoutPrefix(self):
+        message = Message("@msgid=42  PING :irc.example.net")
+        self.assertEqual(message.tags, {"msgid": "42"})
+        self.assertEqual(message.prefix, "")
+        self.assertEqual(message.command, "PING")
+
+    def test_tagsEmpty(self):
+        message = Message("@a=;;b PING x")
+        self.assertEqual(message.tags, {"a": "", "b": True})
+
+    def test_tagEscapes(self):
+        message = Message("@note=a\\:b\\sc\\\\d\\re\\nf\\x\\ PING x")
+        self.assertEqual(message.tags["note"], "a;b c\\d\re\nfx")
+
+    def test_unescapeTag(self):
+        self.assertEqual(unescapeTag("plain"), "plain")
+        self.assertEqual(unescapeTag("\\s\\:"), " ;")
+        # A lone backslash at the end is dropped.
+        self.assertEqual(unescapeTag("end\\"), "end")
+
+    def test_time(self):
+        message = Message("@time=2011-10-19T16:40:51.620Z "
+                          ":nick!user@host PRIVMSG #bones :hi")
+        self.assertAlmostEqual(message.time, 1319042451.62)
+
+    def test_timeWithoutFraction(self):
+        message = Message("@time=2011-10-19T16:40:51Z PING x")
+        self.assertEqual(message.time, 1319042451)
+
+    def test_timeInvalid(self):
+        self.assertIdentical(Message("@time=yesterday PING x").time, None)
+        self.assertIdentical(Message("@time PING x").time, None)
+
+    def test_noCommand(self):
+        for line in ["", "   ", ":nick!user@host", ":nick!user@host   ",
+                     "@tag=value", "@tag=value :nick!user@host "]:
+            self.assertRaises(irc.IRCBadMessage, Message, line)
+
+
+class SplitPrefixTests(unittest.TestCase):
+
+    def test_splitPrefix(self):
+        self.assertEqual(splitPrefix("nick!user@host"),
+                         ("nick", "user", "host"))
+
+    def test_nickOnly(self):
+        self.assertEqual(splitPrefix("irc.example.net"),
+                         ("irc.example.net", None, None))
+
+    def test_withoutUser(self):
+        self.assertEqual(splitPrefix("nick@host"), ("nick", None, "host"))
+
+    def test_withoutHost(self):
+        self.assertEqual(splitPrefix("nick!user"), ("nick", "user", None))
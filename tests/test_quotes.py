@@ -0,0 +1,137 @@
+# -*- encoding: utf8 -*-
+import random
+
+from twisted.internet import task
+from twisted.trial import unittest
+from sqlalchemy import inspect
+
+from bones.modules import quotes
+from tests.test_bot import makeSettings
+from tests.test_karma import DatabaseInitializedEvent, FakeDatabase
+
+
+class Target(object):
+    def __init__(self, name):
+        self.name = self.nickname = name
+        self.messages = []
+
+    def msg(self, message):
+        self.messages.append(message)
+
+    notice = msg
+
+
+class TriggerEvent(object):
+    def __init__(self, *args):
+        self.args = list(args)
+        self.user = Target("alice")
+        self.channel = Target("#bones")
+
+
+class ChannelQuotesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase(self.mktemp())
+        self.module = quotes.ChannelQuotes(
+            settings=makeSettings(self, "[server.test]\n"), factory=None)
+        self.clock = self.module.clock = task.Clock()
+
+    def addAndSearch(self):
+        self.module.cmdQuoteAdd(TriggerEvent("add", "the", "quick", "fox"))
+        self.module.cmdQuoteAdd(TriggerEvent("add", "a", "lazy", "dog"))
+        event = TriggerEvent("search", "LAZY")
+        self.module.cmdQuoteSearch(event)
+        self.assertEqual(event.channel.messages[0][:17],
+                         "[Quote] Quote #2 ")
+        self.assertEqual(event.channel.messages[1], "[Quote] a lazy dog")
+
+    def test_indexBuiltOnNewDatabase(self):
+        """The quote table is created if it doesn't exist yet, so that the
+        search index can be built in a database that hasn't been
+        migrated."""
+        self.module.gotDB(DatabaseInitializedEvent(self.db))
+        self.assertIn(quotes.ChannelQuote.__tablename__,
+                      inspect(self.db.engine).get_table_names())
+        self.assertIsInstance(self.module.index, quotes.FTS5Index)
+        self.addAndSearch()
+    if not quotes.supportsFTS5(FakeDatabase(":memory:").engine):
+        test_indexBuiltOnNewDatabase.skip = "SQLite lacks FTS5"
+
+    def test_invertedIndex(self):
+        self.patch(quotes, "supportsFTS5", lambda engine: False)
+        self.module.gotDB(DatabaseInitializedEvent(self.db))
+        self.assertIsInstance(self.module.index, quotes.InvertedIndex)
+        self.addAndSearch()
+
+    def test_indexBuildRetried(self):
+        self.db.fail = True
+        self.module.gotDB(DatabaseInitializedEvent(self.db))
+        self.assertIdentical(self.module.index, None)
+        event = TriggerEvent("search", "fox")
+        self.module.cmdQuoteSearch(event)
+        self.assertIn("isn't ready yet", event.user.messages[0])
+
+        self.db.fail = False
+        self.clock.advance(self.module.indexRetryDelay)
+        self.assertNotIdentical(self.module.index, None)
+        self.addAndSearch()
+
+    def test_shutdownCancelsRetry(self):
+        self.db.fail = True
+        self.module.gotDB(DatabaseInitializedEvent(self.db))
+        self.module.shutdown(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class RandomPickerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase(self.mktemp(), [quotes.UserQuote.__table__])
+        self.session = self.db.new_session()
+        self.addCleanup(self.session.close)
+        self.picker = quotes.RandomPicker(quotes.UserQuote,
+                                          quotes.UserQuote.nickname)
+        self.patch(quotes, "random", random.Random(0))
+        # Alice said little, and went quiet for a long time after their first
+        # line while others kept talking.
+        self.insert(1, "alice")
+        for id in range(2, 1000):
+            self.insert(id, "bob")
+        for id in range(1000, 1004):
+            self.insert(id, "alice")
+
+    def insert(self, id, nickname):
+        self.db.engine.execute(
+            quotes.UserQuote.__table__.insert(),
+            id=id, nickname=nickname, quote=u"line %i" % id)
+
+    def test_uniform(self):
+        """Every row is about as likely to be picked, regardless of the gaps
+        between their ids."""
+        picks = {}
+        for i in range(5000):
+            row = self.picker.pick(self.session, "alice")
+            picks[row.id] = picks.get(row.id, 0) + 1
+        self.assertEqual(sorted(picks), [1, 1000, 1001, 1002, 1003])
+        for id, count in picks.iteritems():
+            self.assertTrue(800 < count < 1200, (id, count))
+
+    def test_noRows(self):
+        self.assertIdentical(self.picker.pick(self.session, "carol"), None)
+
+    def test_rowsDeleted(self):
+        """Rows that were deleted after they were counted aren't missed."""
+        self.assertEqual(self.picker.count(self.session, "alice"), 5)
+        self.db.engine.execute("DELETE FROM bones_quotes_user "
+                               "WHERE nickname = 'alice' AND id > 1")
+        for i in range(10):
+            self.assertEqual(self.picker.pick(self.session, "alice").id, 1)
+        self.db.engine.execute("DELETE FROM bones_quotes_user")
+        self.assertIdentical(self.picker.pick(self.session, "alice"), None)
+
+    def test_invalidate(self):
+        self.assertEqual(self.picker.count(self.session, "alice"), 5)
+        self.insert(2000, "alice")
+        self.assertEqual(self.picker.count(self.session, "alice"), 5)
+        self.picker.invalidate("alice")
+        self.assertEqual(self.picker.count(self.session, "alice"), 6)
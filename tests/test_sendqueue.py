@@ -0,0 +1,164 @@
+# -*- encoding: utf8 -*-
+from twisted.internet import task
+from twisted.trial import unittest
+
+from bones import sendqueue
+from bones.sendqueue import SendQueue
+
+
+class ClassifyTests(unittest.TestCase):
+
+    def test_classify(self):
+        self.assertEqual(sendqueue.classify("PONG :irc.example.net"),
+                         (sendqueue.PRIORITY_HIGH, ""))
+        self.assertEqual(sendqueue.classify("MODE #bones +o nick"),
+                         (sendqueue.PRIORITY_NORMAL, ""))
+        self.assertEqual(sendqueue.classify("PRIVMSG #Bones :hi"),
+                         (sendqueue.PRIORITY_CHAT, "#bones"))
+        self.assertEqual(sendqueue.classify("PRIVMSG NickServ :identify"),
+                         (sendqueue.PRIORITY_NORMAL, "nickserv"))
+
+
+class SendQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.lines = []
+
+    def makeQueue(self, **kwargs):
+        return SendQueue(self.lines.append, clock=self.clock, **kwargs)
+
+    def test_burst(self):
+        """Lines are sent right away until the burst is used up, and then at
+        the configured rate."""
+        queue = self.makeQueue(linesPerSecond=2, burst=3)
+        for i in range(5):
+            queue.put("PRIVMSG #bones :%i" % i)
+        self.assertEqual(len(self.lines), 3)
+        self.clock.advance(0.49)
+        self.assertEqual(len(self.lines), 3)
+        self.clock.advance(0.01)
+        self.assertEqual(len(self.lines), 4)
+        self.clock.advance(0.5)
+        self.assertEqual(self.lines, ["PRIVMSG #bones :%i" % i
+                                      for i in range(5)])
+        self.assertEqual(queue.stats()["queued"], 0)
+        self.assertEqual(queue.stats()["maxWait"], 1.0)
+
+    def test_bucketRefills(self):
+        """The line bucket fills up again while nothing is sent."""
+        queue = self.makeQueue(linesPerSecond=1, burst=2)
+        for i in range(2):
+            queue.put("PRIVMSG #bones :%i" % i)
+        self.clock.advance(10)
+        for i in range(2, 5):
+            queue.put("PRIVMSG #bones :%i" % i)
+        self.assertEqual(len(self.lines), 4)
+
+    def test_byteLimit(self):
+        """Long lines are held back by the byte bucket even when the line
+        bucket has tokens left."""
+        queue = self.makeQueue(linesPerSecond=100, bytesPerSecond=100,
+                               burst=2)
+        line = "PRIVMSG #bones :" + "x" * 484
+        for i in range(3):
+            queue.put(line + str(i))
+        self.assertEqual(len(self.lines), 2)
+        # 1024 bytes of tokens minus two lines of 503 bytes leaves 18, and
+        # the third line needs 503, which takes 4.85 seconds to refill.
+        self.clock.advance(4.84)
+        self.assertEqual(len(self.lines), 2)
+        self.clock.advance(0.02)
+        self.assertEqual(len(self.lines), 3)
+
+    def test_disabled(self):
+        queue = self.makeQueue(linesPerSecond=0)
+        for i in range(20):
+            queue.put("PRIVMSG #bones :%i" % i)
+        self.assertEqual(len(self.lines), 20)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_priority(self):
+        """Queued lines are sent by priority, then in the order they were
+        queued."""
+        queue = self.makeQueue(linesPerSecond=1, burst=1)
+        queue.put("PRIVMSG #bones :first")
+        queue.put("PRIVMSG #bones :chat")
+        queue.put("MODE #bones +o nick")
+        queue.put("PRIVMSG NickServ :identify")
+        queue.put("PONG :irc.example.net")
+        self.clock.pump([1] * 4)
+        self.assertEqual(self.lines, [
+            "PRIVMSG #bones :first",
+            "PONG :irc.example.net",
+            "MODE #bones +o nick",
+            "PRIVMSG NickServ :identify",
+            "PRIVMSG #bones :chat",
+        ])
+
+    def test_roundRobin(self):
+        """Messages to different targets take turns."""
+        queue = self.makeQueue(linesPerSecond=1, burst=1)
+        queue.put("PRIVMSG #a :0")
+        for i in range(1, 4):
+            queue.put("PRIVMSG #a :%i" % i)
+        queue.put("PRIVMSG #b :1")
+        self.assertEqual(queue.stats()["targets"], {"#a": 3, "#b": 1})
+        self.clock.pump([1] * 4)
+        self.assertEqual(self.lines, [
+            "PRIVMSG #a :0", "PRIVMSG #a :1", "PRIVMSG #b :1",
+            "PRIVMSG #a :2", "PRIVMSG #a :3",
+        ])
+
+    def test_coalesced(self):
+        """A line that is already queued isn't queued again."""
+        queue = self.makeQueue(linesPerSecond=1, burst=1)
+        queue.put("PRIVMSG #bones :spam")
+        queue.put("PRIVMSG #bones :spam")
+        queue.put("PRIVMSG #bones :spam")
+        self.clock.pump([1] * 3)
+        self.assertEqual(self.lines, ["PRIVMSG #bones :spam"] * 2)
+        self.assertEqual(queue.stats()["coalesced"], 1)
+        self.assertEqual(queue.stats()["sent"], 2)
+
+    def test_evictLowerPriority(self):
+        """When the queue is full, the oldest line of the busiest target of a
+        lower priority is dropped to make room."""
+        queue = self.makeQueue(linesPerSecond=1, burst=1, maxLines=3)
+        queue.put("PRIVMSG #a :0")
+        queue.put("PRIVMSG #a :1")
+        queue.put("PRIVMSG #b :1")
+        queue.put("PRIVMSG #b :2")
+        queue.put("PONG :irc.example.net")
+        self.assertEqual(queue.stats()["dropped"], 1)
+        self.clock.pump([1] * 3)
+        self.assertEqual(self.lines, [
+            "PRIVMSG #a :0", "PONG :irc.example.net", "PRIVMSG #a :1",
+            "PRIVMSG #b :2",
+        ])
+
+    def test_dropNewLine(self):
+        """When the queue is full of lines of the same or a higher priority,
+        the new line is dropped."""
+        queue = self.makeQueue(linesPerSecond=1, burst=1, maxLines=2)
+        queue.put("PRIVMSG #a :0")
+        queue.put("PING :one")
+        queue.put("PRIVMSG #a :1")
+        queue.put("PRIVMSG #b :1")
+        self.assertEqual(queue.stats()["dropped"], 1)
+        self.clock.pump([1] * 3)
+        self.assertEqual(self.lines,
+                         ["PRIVMSG #a :0", "PING :one", "PRIVMSG #a :1"])
+
+    def test_clear(self):
+        """Clearing the queue counts the queued lines as dropped and stops
+        sending."""
+        queue = self.makeQueue(linesPerSecond=1, burst=1)
+        for i in range(4):
+            queue.put("PRIVMSG #bones :%i" % i)
+        queue.clear()
+        self.assertEqual(queue.stats()["dropped"], 3)
+        self.assertEqual(queue.stats()["queued"], 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(10)
+        self.assertEqual(len(self.lines), 1)
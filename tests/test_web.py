@@ -0,0 +1,222 @@
+# -*- encoding: utf8 -*-
+from twisted.internet import error, reactor, task
+from twisted.trial import unittest
+from twisted.web import resource, server, util
+
+from bones.extract import Field
+from bones.web import HTTPClient, HTTPError, canonicalizeURL
+
+
+class CountingResource(resource.Resource):
+    """Serves a fixed body and counts the requests made to it, remembering
+    the client port of each one."""
+    isLeaf = True
+
+    def __init__(self, body, code=200, headers=None):
+        resource.Resource.__init__(self)
+        self.body = body
+        self.code = code
+        self.headers = headers or {}
+        self.ports = []
+
+    def render_GET(self, request):
+        self.ports.append(request.getClientAddress().port)
+        request.setResponseCode(self.code)
+        for name, value in self.headers.iteritems():
+            request.setHeader(name, value)
+        return self.body
+
+
+class StallingResource(resource.Resource):
+    """Never responds."""
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.requests = []
+
+    def render_GET(self, request):
+        self.requests.append(request)
+        return server.NOT_DONE_YET
+
+
+class StandInServer(object):
+    """A local HTTP server serving a few resources for
+    :class:`HTTPClientTests`."""
+
+    def __init__(self):
+        self.root = resource.Resource()
+        self.hello = CountingResource("hello")
+        self.cached = CountingResource(
+            "cached", headers={"Cache-Control": "max-age=60"})
+        self.uncached = CountingResource(
+            "uncached", headers={"Cache-Control": "no-store"})
+        self.missing = CountingResource("missing", code=404)
+        self.error = CountingResource("error", code=500)
+        self.page = CountingResource(
+            "<html><head><title>A page</title></head><body>"
+            "<p class=\"text\">Text</p></body></html>",
+            headers={"Content-Type": "text/html; charset=utf-8"})
+        self.stalling = StallingResource()
+        self.root.putChild("hello", self.hello)
+        self.root.putChild("cached", self.cached)
+        self.root.putChild("uncached", self.uncached)
+        self.root.putChild("missing", self.missing)
+        self.root.putChild("error", self.error)
+        self.root.putChild("page", self.page)
+        self.root.putChild("stalling", self.stalling)
+        self.root.putChild("gzip", resource.EncodingResourceWrapper(
+            CountingResource("compressed " * 100),
+            [server.GzipEncoderFactory()]))
+        self.root.putChild("redirect", util.Redirect("/hello"))
+        self.root.putChild("redirect-twice", util.Redirect("/redirect"))
+        self.port = reactor.listenTCP(0, server.Site(self.root),
+                                      interface="127.0.0.1")
+        self.portNumber = self.port.getHost().port
+
+    def url(self, path):
+        return "http://127.0.0.1:%i/%s" % (self.portNumber, path)
+
+    def stop(self):
+        return self.port.stopListening()
+
+
+class HTTPClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.addCleanup(self.server.stop)
+        self.client = HTTPClient("BonesTest/1.0", timeout=5.0)
+        # Connections of aborted downloads are returned to the pool after
+        # the results have been delivered, so give them a moment.
+        self.addCleanup(task.deferLater, reactor, 0, self.client.close)
+
+    def test_request(self):
+        def check(response):
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, "hello")
+            self.assertEqual(response.url, self.server.url("hello"))
+        return self.client.request(self.server.url("hello")).addCallback(check)
+
+    def test_connectionReused(self):
+        """Consecutive requests to the same host are made over the same
+        connection."""
+        def second(_):
+            return self.client.request(self.server.url("hello"))
+
+        def check(_):
+            self.assertEqual(len(self.server.hello.ports), 2)
+            self.assertEqual(self.server.hello.ports[0],
+                             self.server.hello.ports[1])
+        d = self.client.request(self.server.url("hello"))
+        d.addCallback(second)
+        return d.addCallback(check)
+
+    def test_redirect(self):
+        def check(response):
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, "hello")
+            self.assertEqual(response.url, self.server.url("hello"))
+        d = self.client.request(self.server.url("redirect-twice"))
+        return d.addCallback(check)
+
+    def test_gzip(self):
+        def check(response):
+            self.assertEqual(response.body, "compressed " * 100)
+        d = self.client.request(self.server.url("gzip"),
+                                headers={"Accept-Encoding": "gzip"})
+        return d.addCallback(check)
+
+    def test_timeout(self):
+        self.client.timeout = 0.1
+        d = self.client.request(self.server.url("stalling"))
+        return self.assertFailure(d, error.TimeoutError)
+
+    def test_connectionRefused(self):
+        d = self.server.stop()
+        d.addCallback(lambda _: self.client.request(self.server.url("hello")))
+        return self.assertFailure(d, error.ConnectionRefusedError)
+
+    def test_getCached(self):
+        """Successful responses are cached for as long as the server says,
+        and the cache is shared by all spellings of the URL."""
+        def second(_):
+            return self.client.get(self.server.url("cached?b=2&a=1#top"))
+
+        def check(response):
+            self.assertEqual(response.body, "cached")
+            self.assertEqual(len(self.server.cached.ports), 1)
+        d = self.client.get(self.server.url("cached?a=1&b=2"))
+        d.addCallback(second)
+        return d.addCallback(check)
+
+    def test_getUncacheable(self):
+        def second(_):
+            return self.client.get(self.server.url("uncached"))
+
+        def check(response):
+            self.assertEqual(len(self.server.uncached.ports), 2)
+        d = self.client.get(self.server.url("uncached"))
+        d.addCallback(second)
+        return d.addCallback(check)
+
+    def test_getWithoutCache(self):
+        def second(_):
+            return self.client.get(self.server.url("cached"), cache=False)
+
+        def check(response):
+            self.assertEqual(len(self.server.cached.ports), 2)
+        d = self.client.get(self.server.url("cached"))
+        d.addCallback(second)
+        return d.addCallback(check)
+
+    def test_getNotFoundCached(self):
+        """404 responses are cached, other errors aren't."""
+        def again(_):
+            return self.client.get(self.server.url("missing"))
+
+        def errors(_):
+            d = self.client.get(self.server.url("error"))
+            return d.addCallback(lambda _:
+                                 self.client.get(self.server.url("error")))
+
+        def check(response):
+            self.assertEqual(response.code, 500)
+            self.assertEqual(len(self.server.missing.ports), 1)
+            self.assertEqual(len(self.server.error.ports), 2)
+        d = self.client.get(self.server.url("missing"))
+        d.addCallback(again)
+        d.addCallback(errors)
+        return d.addCallback(check)
+
+    def test_getJSONError(self):
+        d = self.client.getJSON(self.server.url("error"))
+        return self.assertFailure(d, HTTPError)
+
+    def test_extract(self):
+        fields = {"title": "title", "text": Field("p.text")}
+
+        def second(results):
+            self.assertEqual(results["title"].text, u"A page")
+            self.assertEqual(results["text"].text, u"Text")
+            return self.client.extract(self.server.url("page"), fields)
+
+        def check(results):
+            self.assertEqual(results["title"].text, u"A page")
+            self.assertEqual(len(self.server.page.ports), 1)
+        d = self.client.extract(self.server.url("page"), fields)
+        d.addCallback(second)
+        return d.addCallback(check)
+
+
+class CanonicalizeURLTests(unittest.TestCase):
+
+    def test_canonicalizeURL(self):
+        self.assertEqual(
+            canonicalizeURL("HTTP://Example.COM:80/path?b=2&a=1#fragment"),
+            "http://example.com/path?a=1&b=2"
+        )
+
+    def test_canonicalizeURLKeepsPort(self):
+        self.assertEqual(canonicalizeURL("https://example.com:8443"),
+                         "https://example.com:8443/")